@@ -1,11 +1,24 @@
+import argparse
 import discord
-import json
+import aiohttp
 import random
 import asyncio
-import logging
-from logging.handlers import RotatingFileHandler
+import io
+import time
+import multiprocessing
+import threading
+from r6_logging import setup_logging, forward_logging
+from concurrent.futures import ThreadPoolExecutor
 from discord.ext import commands
-from os import path, walk
+from os import path
+from r6_media import MediaCache, ByteCache
+from r6_mastery import MasteryStore
+from r6_leaderboard import Leaderboard, METRICS, GLOBAL, format_top
+from r6_metrics import metrics_from_cfg, BYTES_BUCKETS
+from r6_catalog import CatalogLoader, CatalogWatcher, log_problems
+from r6_coordinator import LocalQuizCoordinator, SqliteQuizCoordinator, QuizSessions, CANCEL
+from r6_scheduler import AsyncSendScheduler, discord_send_queue, discord_retry_after, discord_reactions_key, URGENT, \
+    NORMAL, BULK
 
 
 """Discord bot to learn Rainbow Six Siege maps callouts"""
@@ -17,28 +30,126 @@ __version__ = "0.4"
 log_file = "files/log/discord_callouts_bot.log"
 max_log_file_size = 10  # max log file size in MB
 max_log_files = 5
-logger = logging.getLogger('discord_r6_callouts')
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s -  %(levelname)s - %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
-handler = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=max_log_file_size*1024*1024,
-                                               backupCount=max_log_files, encoding='utf-8', delay=False)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+log_json_lines = False  # one json object per line instead of plain text
+log_chat_rate = 1  # records per second a single chat can log at INFO and below, after a burst of log_chat_burst
+log_chat_burst = 20
+logger = setup_logging('discord_r6_callouts', log_file, max_log_file_size, max_log_files, json_lines=log_json_lines,
+                       chat_rate=log_chat_rate, chat_burst=log_chat_burst)
+
+
+class QuestionTally:
+    """Answers for one live quiz question. Fed by gateway reaction events, so nobody has to poll the message.
+    Only the first answer of every user counts, switching reactions afterwards won't change it"""
+    def __init__(self, chat_id, emoji_options, participants=None):
+        self.chat_id = chat_id
+        self.emoji_options = emoji_options
+        # close question as soon as all these users answered. None closes it on the very first answer (DMs)
+        self.participants = participants
+        self.started = time.monotonic()
+        self.reactions = {}  # user_id: set of option indexes user currently reacted with
+        self.first_answers = {}  # user_id: (option index, seconds since the question was sent)
+        self.answered = asyncio.Event()  # set when question can be closed early or quiz is cancelled
+
+    def add(self, user_id, emoji):
+        if emoji not in self.emoji_options:
+            return
+        option = self.emoji_options.index(emoji)
+        self.reactions.setdefault(user_id, set()).add(option)
+        if user_id not in self.first_answers:
+            self.first_answers[user_id] = (option, time.monotonic() - self.started)
+        if self.participants is None or (self.participants and self.participants <= self.first_answers.keys()):
+            self.answered.set()
+
+    def remove(self, user_id, emoji):
+        if emoji in self.emoji_options:
+            self.reactions.get(user_id, set()).discard(self.emoji_options.index(emoji))
+
+    def chosen_options(self):
+        """indexes of options that have at least one reaction"""
+        return set().union(*self.reactions.values())
+
+    def correct_users(self, correct_option):
+        """users whose first answer was correct, fastest first"""
+        correct = [(latency, user_id) for user_id, (option, latency) in self.first_answers.items()
+                   if option == correct_option]
+        return [user_id for latency, user_id in sorted(correct)]
+
+
+class PreparedQuestion:
+    """quiz question ready to go out: options shuffled, text composed, picture resolved and either its CDN url or its
+    bytes at hand. Built while the previous question is still live"""
+    __slots__ = ("options", "correct_answer", "emoji_options", "text", "pic_path", "url", "data")
+
+    def __init__(self, options, correct_answer, emoji_options, text, pic_path, url=None, data=None):
+        self.options = options
+        self.correct_answer = correct_answer
+        self.emoji_options = emoji_options
+        self.text = text
+        self.pic_path = pic_path
+        self.url = url
+        self.data = data
 
 
 class R6Callouts:
-    def __init__(self):
+    def __init__(self, shard_ids=None, shard_count=None):
         self.TOKEN = "your token"
         self.bot_cmd_prefix = "$"
         self.quiz_file = "files/quiz.txt"
+        self.quiz_dir = "files/quiz"
         self.maps_dir = "files/maps/"
-        try:
-            with open(self.quiz_file, "r") as of:
-                self.quiz_separate_data = json.load(of)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.quiz_separate_data = {}
-        self.bot = commands.Bot(command_prefix=self.bot_cmd_prefix)
-        self.active_quizzes = {}
+        self.not_found_pic = "files/misc/not_found.png"
+        self.attachment_urls_file = "files/discord_attachments.txt"
+        # sharding. shard_count None runs a single connection, see run_sharded() for multiple worker processes
+        self.shard_ids = shard_ids
+        self.shard_count = shard_count
+        self.coordinator_db = "files/discord_quizzes.db"
+        self.cancel_check_interval = 1  # seconds. How often we check for $stop handled by another worker
+        if self.shard_count:
+            self.bot = commands.AutoShardedBot(command_prefix=self.bot_cmd_prefix, shard_ids=self.shard_ids,
+                                               shard_count=self.shard_count)
+            # worker processes share quiz locks and cancel flags
+            self.quizzes = SqliteQuizCoordinator(self.coordinator_db)
+        else:
+            self.bot = commands.Bot(command_prefix=self.bot_cmd_prefix)
+            self.quizzes = LocalQuizCoordinator()
+        # a locked SQLite file can keep a quiz lock call waiting for seconds, so they never run on the event loop. One
+        # thread keeps them in the order they were made: a quiz is released before the next one in the chat starts
+        self.coordinator_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="r6_quizzes")
+        self.cancel_watcher = None
+        # handler timings, upload sizes, send queue and session counters on a local /metrics endpoint. Off by default.
+        # Sharded workers listen on PORT + their first shard id
+        self.metrics_cfg = {"ENABLED": False, "LISTEN": "127.0.0.1", "PORT": 9109}
+        self.metrics = metrics_from_cfg(self.metrics_cfg, port_offset=self.shard_ids[0] if self.shard_ids else 0)
+        self.lag_watcher = None
+        # quizzes of this process, each one is a task. The chat lock is released whenever the task ends
+        self.sessions = QuizSessions(on_end=lambda chat_id: self.coordinate(self.quizzes.release, chat_id),
+                                     logger=logger)
+        self.metrics.sampled("quiz_sessions", "Quizzes running in this process", lambda: len(self.sessions.running))
+        self.metrics.sampled("quizzes_ended_total", "Quizzes ended since start", lambda: {
+            (state,): count for state, count in self.sessions.counts.items()}, kind="counter", labels=("state",))
+        # every outgoing message and reaction goes through the send scheduler: rate limits, priorities, merging
+        self.sender = AsyncSendScheduler(discord_send_queue(), logger, retry_after=discord_retry_after)
+        self.metrics.send_stats(self.sender.queue.stats)
+        self.metrics.sampled("send_queue_length", "Sends waiting in the queue", lambda: len(self.sender.queue))
+        self.live_questions = {}  # message_id: QuestionTally for questions waiting for answers
+        # CDN urls of pictures we've already uploaded. Repeated sends just embed the url instead of uploading again
+        self.attachment_urls = MediaCache(self.attachment_urls_file)
+        self.attachment_recheck_time = 3600  # seconds. Older urls are checked with HEAD request before reuse
+        self.http_session = None
+        # which downscaled copy of pictures to send (see tools/build_variants.py). Discord renders webp embeds just fine
+        self.picture_tier = "webp"
+        self.max_attachments = 10  # discord limit of files per message
+        # disk reads (stat, hashing, picture bytes) never run on the event loop. Hot pictures are served from memory
+        self.io_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="r6_io")
+        self.picture_bytes = ByteCache(max_bytes=64 * 1024 * 1024)
+        self.upload_bytes = self.metrics.histogram("upload_bytes", "Bytes uploaded per message", ("kind",),
+                                                   buckets=BYTES_BUCKETS)
+        self.metrics.sampled("picture_cache_bytes", "Pictures held in memory", lambda: self.picture_bytes.size)
+        self.metrics.sampled("picture_cache_reads_total", "Picture reads by cache outcome",
+                             lambda: {("hit",): self.picture_bytes.hits, ("miss",): self.picture_bytes.misses},
+                             kind="counter", labels=("outcome",))
+        for name in ("prepare_question", "send_question"):
+            setattr(self, name, self.metrics.timed(name)(getattr(self, name)))
         self.emoji_dict = {0: "\U00000030\U000020E3",
                            1: "\U00000031\U000020E3",
                            2: "\U00000032\U000020E3",
@@ -51,52 +162,135 @@ class R6Callouts:
                            9: "\U00000039\U000020E3"
                            }
         self.emoji_dict.setdefault("cross", "\U0000274C")
-        self.b_all_maps = None
         self.all_maps_val = "all maps!"
+        # quiz content. Replaced as a whole when files change, see watch_catalog()
+        self.catalog_loader = CatalogLoader(self.quiz_file, self.quiz_dir, self.maps_dir, self.all_maps_val)
+        self.catalog = None
+        self.catalog_check_interval = 10  # seconds
+        self.catalog_watcher = None
         self.quiz_question_timer = 15
         self.quiz_start_timer = 3
         self.default_quiz_question_amount = 5
         self.max_quiz_timer = 30
-        try:
-            with open(self.quiz_file, "r") as of:
-                self.quiz_separate_data = json.load(of)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.quiz_separate_data = {}
+        self.max_sessions_listed = 20  # lines in $sessions output
+        # per-user answer stats: '$quiz KAFE 5 focus' asks more of the callouts the user usually gets wrong. Sharded
+        # workers share the db, but each keeps its own cache, so run it with a single worker
+        self.adaptive_quiz = False
+        self.mastery_db = "files/discord_mastery.db"
+        self.mastery = MasteryStore(self.mastery_db, logger=logger) if self.adaptive_quiz else None
+        self.focus_keyword = "focus"
+        # channel, server and global standings, updated with every answer
+        self.leaderboard_db = "files/discord_leaderboard.db"
+        self.leaderboard = Leaderboard(self.leaderboard_db, logger=logger)
         self.read_cfg()
         self.bot_name = "r6_callouts_bot"
 
+        @self.bot.listen()
+        async def on_ready():
+            logger.info("Connected as %s, shards %s", self.bot.user, self.shard_ids or 'all')
+            if self.shard_count and not self.cancel_watcher:
+                self.cancel_watcher = self.bot.loop.create_task(self.watch_cancels())
+            if not self.catalog_watcher:
+                self.catalog_watcher = self.bot.loop.create_task(self.watch_catalog())
+            if not self.lag_watcher:
+                self.lag_watcher = self.bot.loop.create_task(self.metrics.watch_loop_lag())
+
+        @self.bot.listen()
+        async def on_raw_reaction_add(payload):
+            """route reaction to the quiz question it belongs to"""
+            tally = self.live_questions.get(payload.message_id)
+            if tally and payload.user_id != self.bot.user.id:
+                tally.add(payload.user_id, str(payload.emoji))
+
+        @self.bot.listen()
+        async def on_raw_reaction_remove(payload):
+            tally = self.live_questions.get(payload.message_id)
+            if tally and payload.user_id != self.bot.user.id:
+                tally.remove(payload.user_id, str(payload.emoji))
+
         @self.bot.command(name="maps")
+        @self.metrics.timed("map_quiz")
         async def map_quiz(ctx):
             """List maps, available for quiz"""
             embed = discord.Embed(title="R6 callouts quiz")
             nm = "The following maps are available now"
-            val = "\n".join(list(self.b_all_maps)[:-1])
+            val = "\n".join(self.catalog.maps)
             embed.add_field(name=nm, value=val)
-            await ctx.send(embed=embed)
+            await self.send(ctx, embed=embed)
 
         @self.bot.command(name="view")
+        @self.metrics.timed("view_map_schematics")
         async def view_map_schematics(ctx):
             """shows schematics for a certain map"""
             message_split = ctx.message.content.split()
             map_name = self.list_get(message_split, 1, None)
             if not map_name:
-                await ctx.send(f"{ctx.message.author.mention}, please specify the map you need."
-                               f"\n Example: '{self.bot_cmd_prefix}view KANAL'")
+                await self.send(ctx, f"{ctx.message.author.mention}, please specify the map you need."
+                                     f"\n Example: '{self.bot_cmd_prefix}view KANAL'")
                 return
-            if map_name.upper() not in self.b_all_maps:
-                logger.info(f"{ctx.channel.id} requested non-existent map {map_name}")
-                await ctx.send(f"Yeah, sorry, {ctx.message.author.mention}, I've no idea what you mean. Pretty sure "
-                               f"there is no {map_name} or it has been misspelled somehow. Try {self.bot_cmd_prefix}maps "
-                               f"to list all available maps")
+            if map_name.upper() not in self.catalog.maps:
+                logger.info("%s requested non-existent map %s", ctx.channel.id, map_name,
+                            extra={"chat_id": ctx.channel.id})
+                await self.send(ctx, f"Yeah, sorry, {ctx.message.author.mention}, I've no idea what you mean. "
+                                     f"Pretty sure there is no {map_name} or it has been misspelled somehow. "
+                                     f"Try {self.bot_cmd_prefix}maps to list all available maps")
             else:
                 await self.view_map(ctx, map_name.upper())
 
         @self.bot.command(aliases=["stop", "cancel"])
+        @self.metrics.timed("stop_quiz")
         async def stop_quiz(ctx):
             """Cancel currently running quiz. Alias: stop, cancel"""
             await self.cancel_processor(ctx)
 
+        @self.bot.command(name="sessions")
+        @commands.is_owner()
+        @self.metrics.timed("list_sessions")
+        async def list_sessions(ctx):
+            """Quizzes run by this bot process: running ones and the ones that ended recently. Bot owner only"""
+            sessions = self.sessions.sessions()
+            if not sessions:
+                await self.send(ctx, "No quizzes lately")
+                return
+            now = time.monotonic()
+            lines = [f"{s.chat_id} {s.map_name} by {s.user}: {s.state}, {s.asked}/{len(s.questions)} questions, "
+                     f"{(s.ended or now) - s.started:.0f} s long"
+                     + (f", ended {now - s.ended:.0f} s ago" if s.ended else "")
+                     + f", {s.memory() / 1024:.1f} KB" for s in sessions[:self.max_sessions_listed]]
+            if len(sessions) > self.max_sessions_listed:
+                lines.append(f"... and {len(sessions) - self.max_sessions_listed} more")
+            counts = ", ".join(f"{state} {count}" for state, count in self.sessions.counts.items())
+            await self.send(ctx, f"{len(self.sessions.running)} running. Ended since start: {counts}\n"
+                                 + "\n".join(lines))
+
+        @self.bot.command(name="top")
+        @self.metrics.timed("leaderboard")
+        async def leaderboard(ctx):
+            """Quiz leaderboard. Usage: '$top [channel|server|global] [score|accuracy|streak|speed]'
+            Defaults to this channel and the number of correct answers"""
+            guild = getattr(ctx, "guild", None)
+            scope, scope_id, metric = ("channel", ctx.channel.id, "score") if guild else GLOBAL + ("score",)
+            for word in ctx.message.content.lower().split()[1:]:
+                if word in METRICS:
+                    metric = word
+                elif word in ("server", "guild") and guild:
+                    scope, scope_id = "guild", guild.id
+                elif word in ("global", "all"):
+                    scope, scope_id = GLOBAL
+                elif word != "channel":
+                    await self.send(ctx, f"Not sure what {word} is. Try '{self.bot_cmd_prefix}help top'")
+                    return
+            loop = asyncio.get_event_loop()
+            rows = await loop.run_in_executor(None, self.leaderboard.top, scope, scope_id, metric)
+            if not rows:
+                await self.send(ctx, "No one's on this leaderboard yet. Time for a quiz?")
+                return
+            embed = discord.Embed(title=f"Top by {metric}", color=0x00ff00)
+            embed.description = format_top(rows, mention=lambda user_id, name: f"<@{user_id}>")
+            await self.send(ctx, embed=embed)
+
         @self.bot.command(name="quiz")
+        @self.metrics.timed("start_quiz_polling")
         async def start_quiz_polling(ctx):
             """Try naming all spots on R6 maps. Use '$help quiz' for detailed info
             Usage: '$quiz KAFE 7'. You can pick any map from '$maps' pool
@@ -104,7 +298,8 @@ class R6Callouts:
             To answer a question just react on the emoji number you believe is correct.
             You'll have 10 seconds to answer each question, or if you pass the 3rd parameter
             you can set your own timer. E.g. '$quiz KANAL 10 5'
-            will start the quiz on KANAL for 10 questions and 5 second window to answer"""
+            will start the quiz on KANAL for 10 questions and 5 second window to answer.
+            Add 'focus' at the end to get more of the callouts you usually miss"""
             # Quiz polling only allowed in DM and text channels
             message_channel = ctx.channel
             if isinstance(message_channel, discord.channel.TextChannel):
@@ -112,38 +307,47 @@ class R6Callouts:
             elif isinstance(message_channel, discord.channel.DMChannel):
                 chat_type = "DM"
             else:
-                await ctx.send("Sorry, this command only supported in text channels and DMs")
-                logger.info(f"An attempt to use bot in {message_channel}")
+                await self.send(ctx, "Sorry, this command only supported in text channels and DMs")
+                logger.info("An attempt to use bot in %s", message_channel, extra={"chat_id": message_channel.id})
                 return
             message_split = ctx.message.content.split()
+            focus_user = None
+            if len(message_split) > 2 and message_split[-1].lower() == self.focus_keyword:
+                message_split.pop()
+                if self.mastery:
+                    focus_user = ctx.message.author.id
+                else:
+                    await self.send(ctx, "Focus mode is off on this bot, questions will be random")
             map_name = self.list_get(message_split, 1, None)
             amount_of_questions = self.list_get(message_split, 2, None)
             quiz_timer = self.list_get(message_split, 3, None)
             if not map_name:
-                await ctx.send(f"Not like this.\nThe bot has 2 parameters: map name (check out {self.bot_cmd_prefix}maps"
-                               f" command) and the amount of questions in the quiz.\nExample: '{self.bot_cmd_prefix}quiz"
-                               f" BANK 5'")
+                await self.send(ctx, f"Not like this.\nThe bot has 2 parameters: map name (check out "
+                                     f"{self.bot_cmd_prefix}maps command) and the amount of questions in the quiz."
+                                     f"\nExample: '{self.bot_cmd_prefix}quiz BANK 5'")
                 return
             # a bit more civil way to start quiz for the whole map pool
             elif map_name.upper() in ("RANDOM", "ALL", "ANY", "RND", "EVERYTHING"):
                 map_name = self.all_maps_val
-            elif map_name.upper() not in self.b_all_maps:
-                logger.info(f"{ctx.channel.id} attempted quiz on non-existent map {map_name}")
-                await ctx.send(f"Sorry, {ctx.message.author.mention} I don't know {map_name}.\n"
-                               f"{self.bot_cmd_prefix}maps command will list all the available quizzes")
+            elif map_name.upper() not in self.catalog.maps:
+                logger.info("%s attempted quiz on non-existent map %s", ctx.channel.id, map_name,
+                            extra={"chat_id": ctx.channel.id})
+                await self.send(ctx, f"Sorry, {ctx.message.author.mention} I don't know {map_name}.\n"
+                                     f"{self.bot_cmd_prefix}maps command will list all the available quizzes")
                 return
             else:
                 map_name = map_name.upper()
             if not amount_of_questions:  # notify user of the 2nd parameter
-                await ctx.send(f"By the way, you can also add 2nd parameter: the amount of questions in a quiz. "
-                               f"e.g. '{self.bot_cmd_prefix}quiz BANK 10'.\nFor now we'll start with {self.default_quiz_question_amount} "
-                               f"questions")
+                await self.send(ctx, f"By the way, you can also add 2nd parameter: the amount of questions in a quiz. "
+                                     f"e.g. '{self.bot_cmd_prefix}quiz BANK 10'.\nFor now we'll start with "
+                                     f"{self.default_quiz_question_amount} questions")
                 amount_of_questions = self.default_quiz_question_amount
             if self.is_positive_integer(amount_of_questions):
                 amount_of_questions = int(amount_of_questions)
             else:
-                await ctx.send(f"Kudos for exploratory testing, but no, the 2nd parameter should be"
-                               f"a positive integer\nWe'll start with {self.default_quiz_question_amount} questions")
+                await self.send(ctx, f"Kudos for exploratory testing, but no, the 2nd parameter should be"
+                                     f"a positive integer\nWe'll start with {self.default_quiz_question_amount} "
+                                     f"questions")
                 amount_of_questions = self.default_quiz_question_amount
             if self.is_positive_integer(quiz_timer):
                 quiz_timer = min(int(quiz_timer), self.max_quiz_timer)  # limit max question time
@@ -151,178 +355,326 @@ class R6Callouts:
                 quiz_timer = self.quiz_question_timer
             # check if quiz is already running in this channel
             chat_id = message_channel.id
-            if not self.active_quizzes.get(chat_id, False):
-                self.active_quizzes[chat_id] = True
-            else:
-                await ctx.send(f"{ctx.message.author.mention} chill! We already have a quiz running")
-                logger.info(f"{chat_id} attempted multiple instance of quiz! shame!")
+            if not await self.coordinate(self.quizzes.acquire, chat_id):
+                await self.send(ctx, f"{ctx.message.author.mention} chill! We already have a quiz running")
+                logger.info("%s attempted multiple instance of quiz! shame!", chat_id, extra={"chat_id": chat_id})
                 return
-            quiz_questions = self.create_list_of_quiz_questions(amount_of_questions, map_name, 5)
-            embed = discord.Embed(title="Starting quiz!", color=0x00ff00)
-            av = f"You're playing on {map_name}"
-            res = f" You'll have to answer {len(quiz_questions)} questions within {quiz_timer} seconds " \
-                f"timer window.\n Quiz starts in {self.quiz_start_timer} seconds.\nGood luck!"
-            embed.add_field(name=av, value=res, inline=False)
-            await ctx.send(embed=embed)
-            end_output = "Quiz done!"
+            # the quiz runs as its own task, $stop cancels it. The chat lock is released when the task ends
+            self.sessions.start(chat_id, lambda session: self.run_quiz(ctx, chat_id, chat_type, map_name,
+                                                                       amount_of_questions, quiz_timer, focus_user,
+                                                                       session),
+                                map_name=map_name, user=str(ctx.message.author))
+
+    async def run_quiz(self, ctx, chat_id, chat_type, map_name, amount_of_questions, quiz_timer, focus_user=None,
+                       session=None):
+        """send all quiz questions one by one until quiz is over or its task is cancelled. With focus_user set,
+        questions are weighted by that user's past mistakes. Returns True if the quiz was stopped"""
+        catalog = self.catalog  # the whole quiz is played on the content it started with, even if it's reloaded
+        # adaptive quizzes read the user's stats from the disk
+        quiz_questions = await self.run_io(self.create_list_of_quiz_questions, amount_of_questions, map_name, 5,
+                                           catalog, focus_user)
+        if session:
+            session.questions = quiz_questions
+        embed = discord.Embed(title="Starting quiz!", color=0x00ff00)
+        av = f"You're playing on {map_name}"
+        res = f" You'll have to answer {len(quiz_questions)} questions within {quiz_timer} seconds " \
+            f"timer window.\n Quiz starts in {self.quiz_start_timer} seconds.\nGood luck!"
+        embed.add_field(name=av, value=res, inline=False)
+        participants = set()  # everyone who answered at least once. Lets channel questions close early
+        total = len(quiz_questions)
+        upcoming = None
+        try:
+            await self.send(ctx, embed=embed)
+            # the next question is prepared while the current one is live, so it goes out right after the verdict
+            upcoming = asyncio.ensure_future(self.prepare_question(quiz_questions[0], map_name, (1, total),
+                                                                   catalog)) if quiz_questions else None
             await asyncio.sleep(self.quiz_start_timer)
-            logger.info(f"{ctx.message.author} started quiz on {map_name} for {amount_of_questions} questions")
-            for i, question in enumerate(quiz_questions):
-                # check if user cancels the quiz
-                if self.active_quizzes[chat_id] == "cancel":
-                    end_output = "Quiz stopped.\n~~The mission, the nightmares... they're finally... over~~"
-                    break
-                await self.quiz_polling(ctx=ctx, map_name=map_name, quiz_question=question,
-                                        question_number=(i + 1, len(quiz_questions)), chat_id=chat_id,
-                                        chat_type=chat_type, quiz_timer=quiz_timer)
-            self.active_quizzes[chat_id] = False  # exclude from active quizzes
-            await ctx.send(end_output)
+            logger.info("%s started quiz on %s for %s questions", ctx.message.author, map_name, amount_of_questions,
+                        extra={"chat_id": chat_id})
+            for i in range(total):
+                question = await upcoming
+                upcoming = asyncio.ensure_future(self.prepare_question(quiz_questions[i + 1], map_name, (i + 2, total),
+                                                                       catalog)) if i + 1 < total else None
+                await self.coordinate(self.quizzes.touch, chat_id)
+                if session:
+                    session.progress(i + 1)
+                tally = await self.quiz_polling(ctx=ctx, map_name=map_name, question=question, chat_id=chat_id,
+                                                chat_type=chat_type, quiz_timer=quiz_timer,
+                                                participants=participants if chat_type == "channel" else None,
+                                                catalog=catalog)
+                participants.update(tally.first_answers)
+        except asyncio.CancelledError:
+            # $stop: drop reactions and verdicts still queued for this quiz, the stop message goes out right away
+            self.sender.cancel(chat_id)
+            self.sender.cancel(discord_reactions_key(chat_id))
+            self.send(ctx, "Quiz stopped.\n~~The mission, the nightmares... they're finally... over~~", priority=URGENT)
+            return True
+        finally:
+            if upcoming:
+                upcoming.cancel()
+        self.send(ctx, "Quiz done!")
+        return False
 
     def read_cfg(self):
         """read all main self.* variables outside of __init__ to be able to re-read config after it was changed
         without restarting the bot."""
-        self.b_all_maps = self.quiz_separate_data.keys()
-        maps_buffer = {}
-        for key, val in self.quiz_separate_data.items():
-            for k, v in val.items():
-                maps_buffer[k] = f"{key}/{v}"
-        self.quiz_separate_data[self.all_maps_val] = maps_buffer
+        self.catalog = self.catalog_loader()
+        log_problems(logger, self.catalog)
 
     async def cancel_processor(self, ctx):
-        """raises cancel flag that stops current quiz for user or channel"""
+        """stops current quiz for user or channel. The quiz task is cancelled right away if it runs in this process,
+        otherwise the shared cancel flag tells the worker running it"""
         message_channel = ctx.channel
         chat_id = ctx.channel.id
         if type(message_channel) in (discord.channel.TextChannel, discord.channel.DMChannel):
-            if not self.active_quizzes.get(chat_id, False):
+            if self.sessions.cancel(chat_id):
+                logger.info("%s cancelled their quiz", ctx.message.author, extra={"chat_id": chat_id})
+                return  # the quiz says it's stopped itself
+            state = await self.coordinate(self.quizzes.state, chat_id)
+            if not state:
                 output = "Quiz isn't running here"
-            elif self.active_quizzes.get(chat_id, None) == "cancel":  # already called for stop
+            elif state == CANCEL:  # already called for stop
                 output = f"{ctx.message.author.mention} yeah, this quiz is being stopped now. It'll be over soon"
             else:
-                self.active_quizzes[chat_id] = "cancel"
+                await self.coordinate(self.quizzes.request_cancel, chat_id)
                 output = "Ok, stopping the quiz..."
-                logger.info(f"{ctx.message.author} cancelled their quiz")
+                logger.info("%s cancelled their quiz", ctx.message.author, extra={"chat_id": chat_id})
         else:
             output = "Sorry, this command only supported in text channels and DMs"
-        await ctx.send(output)
+        await self.send(ctx, output)
+
+    async def watch_cancels(self):
+        """$stop could be handled by another worker process. Check shared cancel flags for the quizzes we run"""
+        while True:
+            await asyncio.sleep(self.cancel_check_interval)
+            if self.sessions.running:
+                for chat_id in await self.coordinate(self.quizzes.cancelled, list(self.sessions.running)):
+                    self.sessions.cancel(chat_id)
+
+    async def watch_catalog(self):
+        """pick up changes of quiz.txt and picture folders. Stat calls and reload run off the event loop"""
+        watcher = CatalogWatcher(self.catalog_loader, lambda catalog: setattr(self, "catalog", catalog), logger)
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.catalog_check_interval)
+            try:
+                await loop.run_in_executor(None, watcher.check, self.catalog)
+            except Exception:
+                logger.exception("Content reload failed")
 
-    def create_list_of_quiz_questions(self, quiz_length, map_name, total_options):
+    def create_list_of_quiz_questions(self, quiz_length, map_name, total_options, catalog=None, user_id=None):
         """composes list of quiz question options. First element is always the correct answer. The're total 1 +
         self.quiz_options_amount options for each question and total of self.quiz_questions_amount questions per quiz.
         Each quiz run each question is randomized from the quiz pull (for any chosen map all for all supported maps"""
-        all_questions = []
-        chosen_options = []
-        true_quiz_length = min(quiz_length, len(self.quiz_separate_data[map_name].items()))
-        for _ in range(true_quiz_length):
-            # get random option
+        sampler = (catalog or self.catalog).sampler
+        if self.mastery and user_id is not None:
             try:
-                correct_answer = random.choice(
-                    [i for i in self.quiz_separate_data[map_name].keys() if i not in chosen_options])
-            except IndexError:
-                return all_questions
-            if correct_answer:
-                quiz_options = [i for i in self.quiz_separate_data[map_name].keys() if i != correct_answer]
-                true_total_options = min(total_options, len(quiz_options))
-                quiz_options = random.sample(quiz_options, true_total_options)
-                # correct answer is always the first element
-                quiz_options.insert(0, correct_answer)
-                chosen_options.append(correct_answer)
-                all_questions.append(quiz_options)
-            else:
-                pass
-        return all_questions
+                return self.mastery.sample(user_id, map_name, sampler.keys[map_name], quiz_length, total_options)
+            except Exception:
+                logger.exception("Adaptive quiz for %s failed, asking random questions", user_id)
+        return sampler.sample(quiz_length, map_name, total_options)
 
-    async def quiz_polling(self, ctx, map_name, quiz_question, question_number, chat_id, chat_type, quiz_timer):
-        """poll quiz for a DM chat or channel"""
+    async def prepare_question(self, quiz_question, map_name, question_number, catalog=None):
+        """shuffle options, compose the text and get the picture: CDN url of the previous upload or its bytes"""
         output = f"Question # {question_number[0]}/{question_number[1]}."
         correct_answer = quiz_question[0]  # always first option
         random.shuffle(quiz_question)
-        pic_name = self.quiz_separate_data[map_name][correct_answer]
-        try:
-            if map_name == self.all_maps_val:
-                with open(f"files/quiz/{pic_name}", 'rb') as pic:
-                    quiz_pic = discord.File(pic)
-            else:
-                with open(f"files/quiz/{map_name}/{pic_name}", 'rb') as pic:
-                    quiz_pic = discord.File(pic)
-        except FileNotFoundError:
-            logger.warning(f"Picture missing for files/quiz/{map_name}/{pic_name}")
-            output = f"huh... I couldn't find proper picture for files/quiz/{map_name}/{pic_name}"
-            with open("files/misc/not_found.png", "rb") as pic:
-                quiz_pic = discord.File(pic)
+        pic_path, found = await self.run_io(self.resolve_picture, catalog or self.catalog, map_name, correct_answer)
+        if not found:
+            logger.warning("Picture missing for %s", pic_path)
+            output = f"huh... I couldn't find proper picture for {pic_path}"
+            pic_path = await self.run_io((catalog or self.catalog).images.variant, self.not_found_pic,
+                                          self.picture_tier)
         emoji_options = self.num_to_emoji(range(1, len(quiz_question) + 1))
         output += "\n"*2
         pretty_options = dict(zip(emoji_options, quiz_question))
         pretty_options = [f" {emoji}   {opt}" for emoji, opt in pretty_options.items()]
         output += "\n".join(pretty_options)
-        msg = await ctx.send(content=output, file=quiz_pic)
-        for option in emoji_options:
-            await msg.add_reaction(option)
-        reactions = []
+        url = await self.cached_attachment_url(pic_path)
+        data = None if url else await self.run_io(self.picture_bytes.read, pic_path)
+        return PreparedQuestion(quiz_question, correct_answer, emoji_options, output, pic_path, url, data)
+
+    def resolve_picture(self, catalog, map_name, callout):
+        """(variant to send, True) or (what was expected, False) if the picture is gone. Runs on the io pool"""
+        pic_path = catalog.picture_path(map_name, callout)
+        if not pic_path or not path.exists(pic_path):
+            return pic_path, False
+        return catalog.images.variant(pic_path, self.picture_tier), True
+
+    def coordinate(self, fn, *args):
+        """run a quiz coordinator call (self.quizzes) on its own thread. Returns awaitable"""
+        return asyncio.get_event_loop().run_in_executor(self.coordinator_pool, fn, *args)
+
+    def run_io(self, fn, *args):
+        """run blocking file access on the io pool. Returns awaitable"""
+        return asyncio.get_event_loop().run_in_executor(self.io_pool, fn, *args)
+
+    async def quiz_polling(self, ctx, map_name, question, chat_id, chat_type, quiz_timer, participants=None,
+                           catalog=None):
+        """poll prepared quiz question for a DM chat or channel. Returns QuestionTally with everyone's answers"""
+        quiz_question, correct_answer, emoji_options = question.options, question.correct_answer, question.emoji_options
+        msg = await self.send_question(ctx, question)
+        tally = QuestionTally(chat_id, emoji_options, participants)
+        self.live_questions[msg.id] = tally
+        try:
+            await asyncio.gather(*[self.sender.submit(discord_reactions_key(chat_id), msg.add_reaction, option,
+                                                      priority=URGENT) for option in emoji_options])
+            await self.wait_for_reaction(tally, quiz_timer)
+        finally:
+            self.live_questions.pop(msg.id, None)
+        correct_option = quiz_question.index(correct_answer)
+        timeout_user = ctx.message.author.id if chat_type == "DM" else None
+        guild = getattr(ctx, "guild", None)
+        scopes = [("channel", chat_id), GLOBAL] + ([("guild", guild.id)] if guild else [])
+        self.record_answers(tally, map_name, correct_answer, correct_option, scopes, catalog, timeout_user)
         # in channels only evaluate overall statistics. No need for mentions
         if chat_type == "channel":
-            await asyncio.sleep(quiz_timer)
-            msg_after = await ctx.fetch_message(msg.id)
-            for reaction in msg_after.reactions:
-                reactions.append(reaction.count - 1)
-            total_reactions = sum(reactions)
-            correct_reactions = reactions[quiz_question.index(correct_answer)]
-            if correct_reactions == 0:
-                output = f"No one guessed it right!\nIt was # {quiz_question.index(correct_answer) + 1}: " \
-                         f"{correct_answer}"
-            elif correct_reactions == 1:
-                output = f"Just one person got it right!\nIt was " \
-                         f"# {quiz_question.index(correct_answer) + 1}: {correct_answer}"
-            elif correct_reactions > 1:
-                output = f"{correct_reactions} out of {total_reactions} got it right!\nIt was " \
-                         f"# {quiz_question.index(correct_answer) + 1}: {correct_answer}"
-            await ctx.send(output)
-            return
+            correct_users = tally.correct_users(correct_option)
+            if not correct_users:
+                output = f"No one guessed it right!\nIt was # {correct_option + 1}: {correct_answer}"
+            elif len(correct_users) == 1:
+                output = f"Just one person got it right!\nIt was # {correct_option + 1}: {correct_answer}"
+            else:
+                output = f"{len(correct_users)} out of {len(tally.first_answers)} got it right!\nIt was " \
+                         f"# {correct_option + 1}: {correct_answer}"
+            if correct_users:
+                output += f"\nFastest: <@{correct_users[0]}> " \
+                          f"({tally.first_answers[correct_users[0]][1]:.1f} s)"
+            self.send(ctx, output, priority=URGENT)  # not awaited: the next question queues right behind it
+            return tally
         # proceed with DMs and reaction evaluation
-        await self.wait_for_reaction(ctx, msg.id, chat_id, quiz_timer)
-        if self.active_quizzes.get(chat_id, None) == "cancel":  # don't show correct answer if quiz was cancelled
-            return
-        msg_after = await ctx.fetch_message(msg.id)
+        chosen_options = tally.chosen_options()
+        if len(chosen_options) > 1:
+            output = "No-no, just 1 answer allowed!"
+        elif not chosen_options:
+            output = f"Time's out!\nIt was # {correct_option + 1}: {correct_answer}"
+        elif chosen_options == {correct_option}:
+            output = "Good job!"
+        else:
+            output = f"Nope, sorry, not {quiz_question[chosen_options.pop()]}. It's actually {correct_answer}"
+        self.send(ctx, output, priority=URGENT)
+        return tally
 
-        for reaction in msg_after.reactions:
-            reactions.append(reaction.count - 1)
-        if reactions.count(1) > 1:
-            await ctx.send("No-no, just 1 answer allowed!")
-            return
-        elif reactions.count(1) == 0:
-            await ctx.send(f"Time's out!\nIt was # {quiz_question.index(correct_answer) + 1}: {correct_answer}")
+    def record_answers(self, tally, map_name, correct_answer, correct_option, scopes, catalog=None, timeout_user=None):
+        """count first answer of everyone who answered: leaderboards and, with adaptive quizzes on, mastery stats.
+        In DMs no answer counts as a wrong one for mastery"""
+        for user_id, (option, latency) in tally.first_answers.items():
+            self.leaderboard.record(user_id, scopes, option == correct_option, latency)
+        if not self.mastery:
             return
-        chosen_answer = reactions.index(1)
-        if quiz_question[chosen_answer] == correct_answer:
-            await ctx.send("Good job!")
-        else:
-            await ctx.send(f"Nope, sorry, not {quiz_question[chosen_answer]}. It's actually {correct_answer}")
+        keys = (catalog or self.catalog).sampler.keys.get(map_name)
+        answers = [(user_id, option == correct_option) for user_id, (option, _) in tally.first_answers.items()]
+        if timeout_user and not tally.first_answers:
+            answers.append((timeout_user, False))
+        self.run_io(self.record_mastery, map_name, keys, correct_answer, answers)  # the quiz doesn't wait for it
 
-    async def wait_for_reaction(self, ctx, message_id, user_id, wait_time):
-        """a primitive way to speed up quiz so user won't have to wait 10 seconds after each question"""
-        for _ in range(1, wait_time + 1):
-            await asyncio.sleep(1)
-            msg_later = await ctx.fetch_message(message_id)
-            if any(reaction.count == 2 for reaction in msg_later.reactions) or \
-                    self.active_quizzes.get(user_id, None) == "cancel":
-                break
+    def record_mastery(self, map_name, keys, callout, answers):
+        """mastery.record for every (user_id, correct) of answers. Runs on the io pool, a failure is only logged"""
+        for user_id, correct in answers:
+            try:
+                self.mastery.record(user_id, map_name, keys, callout, correct)
+            except Exception:
+                logger.exception("Failed to record mastery of %s on %s", user_id, map_name)
+
+    @staticmethod
+    async def wait_for_reaction(tally, wait_time):
+        """wait until user reacts to the question (or quiz is cancelled) so user won't have to wait 10 seconds after
+        each question"""
+        try:
+            await asyncio.wait_for(tally.answered.wait(), timeout=wait_time)
+        except asyncio.TimeoutError:
+            pass
 
     async def view_map(self, ctx, map_name):
-        logger.info(f"{ctx.channel.id} requested {map_name} schematics")
-        map_path = f"{self.maps_dir}{map_name}"
-        if path.exists(map_path):
-            # send all related pics
-            for root, dirs, files in walk(map_path):
-                for file in files:
-                    if file.endswith('png'):
-                        pic_name = f"{map_path}/{file}"
-                        with open(pic_name, 'rb') as pic:
-                            map_schema = discord.File(pic)
-                        await ctx.send(file=map_schema)
-            await ctx.send("Here you go")
+        logger.info("%s requested %s schematics", ctx.channel.id, map_name, extra={"chat_id": ctx.channel.id})
+        schematics = self.catalog.schematics.get(map_name)
+        if schematics:
+            # send all related pics in one go
+            await self.send_cached_pictures(ctx, schematics, content="Here you go")
         else:
-            logger.warning(f"Failed to locate files for {map_name} map!")
-            await ctx.send(f"Sorry, {ctx.message.author.mention}, I couldn't find files for {map_name}.\nThis will"
-                           f"be reported, so someone would fix it one day. I hope")
+            logger.warning("Failed to locate files for %s map!", map_name)
+            await self.send(ctx, f"Sorry, {ctx.message.author.mention}, I couldn't find files for {map_name}."
+                                 f"\nThis will be reported, so someone would fix it one day. I hope")
+
+    def send(self, ctx, content=None, priority=NORMAL, **kwargs):
+        """ctx.send through the send scheduler. Returns a future: await it for the message or leave it be. Plain
+        texts queued back to back for the same channel go as one message"""
+        if content is not None:
+            kwargs["content"] = content
+        return self.sender.submit(ctx.channel.id, ctx.send, priority=priority, text_arg="content", **kwargs)
+
+    async def send_cached_pictures(self, ctx, pic_paths, content=None):
+        """send several pictures in their order with as few messages as possible. Pictures uploaded before go as links
+        in the message text (Discord shows them as images), the rest are attached, up to max_attachments per message.
+        Links and attachments never share a message, so every run of them goes as its own one and the order holds"""
+        pic_paths = await self.run_io(lambda: [self.catalog.images.variant(p, self.picture_tier) for p in pic_paths])
+        urls = [await self.cached_attachment_url(p) for p in pic_paths]
+        runs = []  # (cached, urls or pic paths) of consecutive pictures
+        for pic_path, url in zip(pic_paths, urls):
+            cached = bool(url)
+            if runs and runs[-1][0] == cached and (cached or len(runs[-1][1]) < self.max_attachments):
+                runs[-1][1].append(url or pic_path)
+            else:
+                runs.append((cached, [url or pic_path]))
+        for cached, items in runs:
+            if cached:
+                await self.send(ctx, content="\n".join(([content] if content else []) + items), priority=BULK)
+            else:
+                files = [(pic_path, await self.run_io(self.picture_bytes.read, pic_path)) for pic_path in items]
+                msg = await self.send_files(ctx, files, content=content, priority=BULK, kind="schematics")
+                for pic_path, attachment in zip(items, msg.attachments):
+                    await self.run_io(self.attachment_urls.put, pic_path, attachment.url)
+            content = None
+        if content:  # no pictures at all
+            await self.send(ctx, content=content, priority=BULK)
+
+    async def send_question(self, ctx, question):
+        """send prepared question as an embed with CDN url of the previous upload if we have one, upload it
+        otherwise"""
+        if question.url:
+            embed = discord.Embed()
+            embed.set_image(url=question.url)
+            try:
+                return await self.send(ctx, content=question.text, priority=URGENT, embed=embed)
+            except discord.HTTPException:
+                logger.warning("Failed to send cached url for %s. Uploading it again", question.pic_path)
+                await self.run_io(self.attachment_urls.drop, question.pic_path)
+        data = question.data or await self.run_io(self.picture_bytes.read, question.pic_path)
+        msg = await self.send_files(ctx, [(question.pic_path, data)], content=question.text, priority=URGENT,
+                                   kind="question")
+        if msg.attachments:
+            await self.run_io(self.attachment_urls.put, question.pic_path, msg.attachments[0].url)
+        return msg
+
+    def send_files(self, ctx, files, content=None, priority=NORMAL, kind="pictures"):
+        """self.send with pictures from memory, files is [(path, bytes)]. discord.py closes files once they're
+        uploaded, so every attempt (there's another one after 429) gets fresh discord.File objects"""
+        self.upload_bytes.observe(sum(len(data) for _, data in files), kind)
+
+        async def upload():
+            return await ctx.send(content=content, files=[discord.File(io.BytesIO(data), filename=path.basename(p))
+                                                          for p, data in files])
+        return self.sender.submit(ctx.channel.id, upload, priority=priority)
+
+    async def cached_attachment_url(self, pic_path):
+        """CDN url of the previous upload. Urls we haven't used for a while are checked first so a deleted
+        attachment doesn't end up as a broken embed"""
+        url = await self.run_io(self.attachment_urls.get, pic_path)
+        if not url or self.attachment_urls.checked_ago(pic_path) < self.attachment_recheck_time:
+            return url
+        if self.http_session is None:
+            self.http_session = aiohttp.ClientSession()
+        try:
+            async with self.http_session.head(url) as resp:
+                alive = resp.status == 200
+        except aiohttp.ClientError:
+            alive = False
+        if alive:
+            await self.run_io(self.attachment_urls.touch, pic_path)
+            return url
+        logger.info("Cached url for %s went stale", pic_path)
+        await self.run_io(self.attachment_urls.drop, pic_path)
+        return None
 
     def num_to_emoji(self, iterator):
         """converts numbers into emoji representation"""
@@ -334,7 +686,7 @@ class R6Callouts:
                     emoji_number += self.emoji_dict.get(int(digit))
                 emoji_numbers.append(emoji_number)
             else:
-                logger.warning(f"{entry} doesn't look like a number with that pesky {type(entry)} type")
+                logger.warning("%s doesn't look like a number with that pesky %s type", entry, type(entry))
         return emoji_numbers
 
     @staticmethod
@@ -375,8 +727,51 @@ class R6Callouts:
         self.bot.run(self.TOKEN)
 
 
-logger.info("Start the bot!")
-bot = R6Callouts()
-bot.run_bot()
+def run_worker(shard_ids, shard_count, log_queue):
+    """worker process entry point. Its log records go to the parent process, which writes them to the log file"""
+    forward_logging(logger, log_queue)
+    R6Callouts(shard_ids=shard_ids, shard_count=shard_count).run_bot()
+
+
+def write_worker_logs(log_queue):
+    """parent side of forward_logging, runs on a thread"""
+    while True:
+        logger.handle(log_queue.get())
+
+
+def run_sharded(workers, shard_count):
+    """spread shard_count shards across worker processes and restart workers that died. Workers are spawned, not
+    forked: a forked child would inherit the log queue, but not the listener thread writing it out"""
+    context = multiprocessing.get_context("spawn")
+    log_queue = context.Queue()
+    threading.Thread(target=write_worker_logs, args=(log_queue,), name="worker_logs", daemon=True).start()
+    shards = {w: list(range(w, shard_count, workers)) for w in range(workers)}
+    processes = {}
+    while True:
+        for w, shard_ids in shards.items():
+            if w not in processes or not processes[w].is_alive():
+                if w in processes:
+                    logger.warning("Worker %s (shards %s) exited with %s, restarting", w, shard_ids,
+                                   processes[w].exitcode)
+                processes[w] = context.Process(target=run_worker, args=(shard_ids, shard_count, log_queue),
+                                               name=f"r6_callouts_worker_{w}")
+                processes[w].start()
+        time.sleep(5)
 
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Discord bot to learn Rainbow Six Siege maps callouts")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes to spread shards across. 1 runs everything in this process")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="total shards, Discord wants ~1 per 1000 guilds. At least one per worker")
+    args = parser.parse_args()
+    logger.info("Start the bot!")
+    total_shards = max(args.shards, args.workers)
+    if args.workers > 1:
+        run_sharded(args.workers, total_shards)
+    elif total_shards > 1:
+        R6Callouts(shard_ids=list(range(total_shards)), shard_count=total_shards).run_bot()
+    else:
+        bot = R6Callouts()
+        bot.run_bot()
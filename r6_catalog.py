@@ -0,0 +1,201 @@
+import json
+import threading
+import time
+from os import listdir, path
+from r6_media import build_schematic_index, ImageManifest, VARIANTS_MANIFEST
+from r6_quiz import QuizSampler
+from r6_snapshot import SNAPSHOT_FILE, read_snapshot, sources_unchanged, stat_entry, write_snapshot
+
+
+"""Quiz content both bots serve: quiz.txt callouts, quiz pictures, map schematics, map buttons from the telegram
+config and the image variants manifest. Loaded and cross-checked in one place, reloaded when files change on disk.
+tools/build_snapshot.py precompiles all of it into a binary snapshot for fast start"""
+
+
+class ContentCatalog:
+    """Snapshot of quiz content. Never modified after it's built: bots swap the whole object on reload, so questions
+    being played keep using the snapshot they started with"""
+    def __init__(self, quiz_data, all_maps_val, quiz_dir, schematics, map_buttons=(), fingerprint=None,
+                 broken=False, sampler=None, images=None):
+        self.quiz_data = quiz_data  # {MAP: {callout: picture}} plus all maps pool {callout: "MAP/picture"}
+        self.all_maps_val = all_maps_val
+        self.quiz_dir = quiz_dir
+        self.maps = tuple(m for m in quiz_data if m != all_maps_val)  # maps with quizzes
+        self.schematics = schematics  # {MAP: [schematic paths]}
+        self.map_buttons = tuple(map_buttons)  # maps offered by telegram keyboard
+        self.sampler = sampler or QuizSampler(quiz_data)
+        self.images = images or ImageManifest(files={})  # transcoded picture variants
+        self.fingerprint = fingerprint
+        self.broken = broken  # quiz file couldn't be read. Such catalog never replaces a working one
+        self.problems = []
+
+    def picture_path(self, map_name, callout):
+        """path to the quiz picture or None if there's no such callout"""
+        pic_name = self.quiz_data.get(map_name, {}).get(callout)
+        if pic_name is None:
+            return None
+        if map_name == self.all_maps_val:
+            return f"{self.quiz_dir}/{pic_name}"
+        return f"{self.quiz_dir}/{map_name}/{pic_name}"
+
+    def snapshot(self):
+        """plain data for the binary snapshot. Image manifest is stored separately, it's shared by all catalogs"""
+        return {"quiz_data": self.quiz_data, "all_maps_val": self.all_maps_val, "quiz_dir": self.quiz_dir,
+                "schematics": self.schematics, "map_buttons": self.map_buttons, "fingerprint": self.fingerprint,
+                "problems": self.problems, "sampler_keys": self.sampler.keys}
+
+    @classmethod
+    def from_snapshot(cls, data, image_files):
+        catalog = cls(data["quiz_data"], data["all_maps_val"], data["quiz_dir"], data["schematics"],
+                      data["map_buttons"], data["fingerprint"], sampler=QuizSampler(keys=data["sampler_keys"]),
+                      images=ImageManifest(files=image_files))
+        catalog.problems = data["problems"]
+        return catalog
+
+
+def source_fingerprint(files, dirs):
+    """cheap summary of everything the catalog is built from: stat of every file, of the content folders and of
+    every map folder in them. Adding, removing or renaming a picture changes mtime of its folder"""
+    fingerprint = [stat_entry(file) for file in files]
+    for root in dirs:
+        fingerprint.append(stat_entry(root, with_size=False))
+        try:
+            fingerprint.extend(stat_entry(f"{root}/{sub_dir}", with_size=False) for sub_dir in sorted(listdir(root)))
+        except FileNotFoundError:
+            pass
+    return tuple(fingerprint)
+
+
+def load_catalog(quiz_file, quiz_dir, maps_dir, all_maps_val, config_file=None, manifest_file=VARIANTS_MANIFEST):
+    """build ContentCatalog and check that quiz.txt, telegram config and picture folders agree with each other.
+    Problems are collected into catalog.problems, not raised: a missing picture shouldn't take the whole bot down"""
+    quiz_dir, maps_dir = quiz_dir.rstrip("/"), maps_dir.rstrip("/")
+    fingerprint = source_fingerprint([f for f in (quiz_file, config_file, manifest_file) if f], [quiz_dir, maps_dir])
+    problems = []
+    broken = False
+    try:
+        with open(quiz_file, "r") as of:
+            quiz_data = json.load(of)
+    except (FileNotFoundError, json.decoder.JSONDecodeError) as e:
+        problems.append(f"can't read {quiz_file}: {e}")
+        quiz_data = {}
+        broken = True
+    map_buttons = []
+    if config_file:
+        try:
+            with open(config_file, "r") as of:
+                map_buttons = json.load(of)['BUTTONS']['ALL_MAPS']
+        except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError) as e:
+            problems.append(f"can't read map buttons from {config_file}: {e}")
+    try:
+        schematics = build_schematic_index(maps_dir)
+    except FileNotFoundError:
+        problems.append(f"no schematics folder {maps_dir}")
+        schematics = {}
+    # all maps pool. Callouts with the same name on different maps collide there, the last map wins
+    maps_buffer = {}
+    for key, val in quiz_data.items():
+        hidden = [k for k in val if k in maps_buffer]
+        if hidden:
+            problems.append(f"{key}: {len(hidden)} callout(s) hide same-named ones of other maps in '{all_maps_val}' "
+                            f"pool: {', '.join(hidden[:5])}")
+        for k, v in val.items():
+            maps_buffer[k] = f"{key}/{v}"
+    for map_name, callouts in quiz_data.items():
+        if not path.isdir(f"{quiz_dir}/{map_name}"):
+            problems.append(f"quiz map {map_name} has no {quiz_dir}/{map_name} folder")
+            continue
+        missing = [pic for pic in callouts.values() if not path.isfile(f"{quiz_dir}/{map_name}/{pic}")]
+        if missing:
+            problems.append(f"{map_name}: {len(missing)} quiz picture(s) missing: {', '.join(missing[:5])}")
+    for map_name in map_buttons:
+        if map_name not in quiz_data:
+            problems.append(f"map button {map_name} has no quiz in {quiz_file}")
+        if not schematics.get(map_name):
+            problems.append(f"map button {map_name} has no schematics in {maps_dir}")
+    quiz_data[all_maps_val] = maps_buffer
+    catalog = ContentCatalog(quiz_data, all_maps_val, quiz_dir, schematics, map_buttons, fingerprint, broken,
+                             images=ImageManifest(manifest_file))
+    catalog.problems = problems
+    return catalog
+
+
+class CatalogWatcher:
+    """Rebuilds catalog when its source files change. check() is one cheap stat pass, call it from a thread with
+    start() or from an event loop executor"""
+    def __init__(self, load, on_swap, logger, interval=10):
+        self.load = load  # CatalogLoader
+        self.on_swap = on_swap  # called with the new catalog
+        self.logger = logger
+        self.interval = interval
+        self.fingerprint = None
+        self.thread = None
+
+    def check(self, current):
+        """reload catalog if sources changed since current was built. Returns new catalog or None"""
+        fingerprint = source_fingerprint(self.load.files, self.load.dirs)
+        if fingerprint in (current.fingerprint, self.fingerprint):
+            return None
+        self.fingerprint = fingerprint  # don't retry a broken reload until files change again
+        catalog = self.load()
+        log_problems(self.logger, catalog)
+        if catalog.broken:
+            self.logger.error("Content reload failed, keeping the previous version")
+            return None
+        self.logger.info("Content reloaded: %s quiz maps, %s schematics", len(catalog.maps), len(catalog.schematics))
+        self.on_swap(catalog)
+        return catalog
+
+    def start(self, get_current):
+        def loop():
+            while True:
+                time.sleep(self.interval)
+                try:
+                    self.check(get_current())
+                except Exception:
+                    self.logger.exception("Content reload failed")
+        self.thread = threading.Thread(target=loop, name="catalog_watcher", daemon=True)
+        self.thread.start()
+
+
+class CatalogLoader:
+    """load_catalog with arguments bound, plus the list of sources for CatalogWatcher. Takes the catalog from the
+    binary snapshot when there's an up to date one built for the same arguments"""
+    def __init__(self, quiz_file, quiz_dir, maps_dir, all_maps_val, config_file=None,
+                 manifest_file=VARIANTS_MANIFEST, snapshot_file=SNAPSHOT_FILE):
+        self.args = (quiz_file, quiz_dir.rstrip("/"), maps_dir.rstrip("/"), all_maps_val, config_file, manifest_file)
+        self.files = [f for f in (quiz_file, config_file, manifest_file) if f]
+        self.dirs = [quiz_dir.rstrip("/"), maps_dir.rstrip("/")]
+        self.snapshot_file = snapshot_file
+
+    def __call__(self):
+        return self.from_snapshot() or load_catalog(*self.args)
+
+    def from_snapshot(self):
+        """catalog from the snapshot or None if it's missing, built for other sources or out of date"""
+        if not self.snapshot_file:
+            return None
+        data = read_snapshot(self.snapshot_file)
+        catalog_data = data and data["catalogs"].get(self.args)
+        if not catalog_data or not sources_unchanged(catalog_data["fingerprint"]):
+            return None
+        return ContentCatalog.from_snapshot(catalog_data, data["images"][self.args[-1]])
+
+
+def build_snapshot(loaders, snapshot_file=SNAPSHOT_FILE):
+    """compile catalogs of all loaders into one snapshot file. Returns snapshot size and the catalogs"""
+    catalogs = {loader.args: load_catalog(*loader.args) for loader in loaders}
+    for catalog in catalogs.values():
+        if catalog.broken:
+            raise ValueError(f"not writing snapshot of broken content: {catalog.problems[0]}")
+    # variant lookups only need mtime, size and paths. Content hashes are for tools/build_variants.py
+    images = {args[-1]: {src: {k: entry[k] for k in ("mtime", "size", "variants")}
+                         for src, entry in c.images.files.items()} for args, c in catalogs.items()}
+    size = write_snapshot(snapshot_file, {"catalogs": {args: c.snapshot() for args, c in catalogs.items()},
+                                          "images": images})
+    return size, list(catalogs.values())
+
+
+def log_problems(logger, catalog):
+    for problem in catalog.problems:
+        logger.warning("content: %s", problem)
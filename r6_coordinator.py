@@ -0,0 +1,209 @@
+import asyncio
+import os
+import socket
+import sys
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+"""'One quiz per chat' lock and cancel flags for the Discord bot. Local version for a single process, SQLite version
+when shards are spread across several worker processes. QuizSessions runs the quizzes of this process as tasks"""
+
+RUNNING = "running"
+CANCEL = "cancel"
+DONE = "done"
+STOPPED = "stopped"
+FAILED = "failed"
+
+
+class LocalQuizCoordinator:
+    """in-process dict, same thing active_quizzes used to be"""
+    def __init__(self):
+        self.quizzes = {}  # chat_id: RUNNING or CANCEL
+
+    def acquire(self, chat_id):
+        """take the chat for a new quiz. False if there's a quiz running there already"""
+        if chat_id in self.quizzes:
+            return False
+        self.quizzes[chat_id] = RUNNING
+        return True
+
+    def release(self, chat_id):
+        self.quizzes.pop(chat_id, None)
+
+    def state(self, chat_id):
+        """RUNNING, CANCEL or None if there's no quiz in the chat"""
+        return self.quizzes.get(chat_id)
+
+    def touch(self, chat_id):
+        pass
+
+    def request_cancel(self, chat_id):
+        if self.quizzes.get(chat_id) == RUNNING:
+            self.quizzes[chat_id] = CANCEL
+
+    def cancelled(self, chat_ids):
+        """chats from chat_ids that have cancel requested"""
+        return {chat_id for chat_id in chat_ids if self.quizzes.get(chat_id) == CANCEL}
+
+
+class SqliteQuizCoordinator:
+    """Shared between processes through a SQLite file in WAL mode. Every quiz row has an owner process and a heartbeat,
+    so a chat locked by a crashed worker is freed after stale_after seconds"""
+    def __init__(self, db_file, stale_after=600):
+        self.db_file = db_file
+        self.stale_after = stale_after
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.local = threading.local()
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS quizzes (chat_id INTEGER PRIMARY KEY, owner TEXT NOT NULL, "
+                         "state TEXT NOT NULL, heartbeat REAL NOT NULL)")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10, isolation_level=None)  # autocommit
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+    def acquire(self, chat_id):
+        now = time.time()
+        cursor = self.connection().execute(
+            "INSERT INTO quizzes (chat_id, owner, state, heartbeat) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(chat_id) DO UPDATE SET owner = excluded.owner, state = excluded.state, "
+            "heartbeat = excluded.heartbeat WHERE heartbeat < ?",
+            (chat_id, self.owner, RUNNING, now, now - self.stale_after))
+        return cursor.rowcount == 1
+
+    def release(self, chat_id):
+        self.connection().execute("DELETE FROM quizzes WHERE chat_id = ? AND owner = ?", (chat_id, self.owner))
+
+    def state(self, chat_id):
+        row = self.connection().execute("SELECT state FROM quizzes WHERE chat_id = ? AND heartbeat >= ?",
+                                        (chat_id, time.time() - self.stale_after)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, chat_id):
+        """heartbeat. Owner calls it on every question"""
+        self.connection().execute("UPDATE quizzes SET heartbeat = ? WHERE chat_id = ? AND owner = ?",
+                                  (time.time(), chat_id, self.owner))
+
+    def request_cancel(self, chat_id):
+        self.connection().execute("UPDATE quizzes SET state = ? WHERE chat_id = ? AND state = ?",
+                                  (CANCEL, chat_id, RUNNING))
+
+    def cancelled(self, chat_ids):
+        chat_ids = list(chat_ids)
+        if not chat_ids:
+            return set()
+        rows = self.connection().execute(
+            f"SELECT chat_id FROM quizzes WHERE state = ? AND chat_id IN ({','.join('?' * len(chat_ids))})",
+            (CANCEL, *chat_ids))
+        return {row[0] for row in rows}
+
+
+class LiveQuiz:
+    """one quiz run by this process. Kept around for a while after it ends so $sessions can show it"""
+    __slots__ = ("chat_id", "map_name", "user", "task", "questions", "asked", "started", "updated", "ended", "state")
+
+    def __init__(self, chat_id, map_name=None, user=None):
+        self.chat_id = chat_id
+        self.map_name = map_name
+        self.user = user
+        self.task = None
+        self.questions = []  # quiz questions, set by the quiz once they're drawn
+        self.asked = 0
+        self.started = time.monotonic()
+        self.updated = self.started
+        self.ended = None
+        self.state = RUNNING
+
+    def progress(self, asked):
+        self.asked = asked
+        self.updated = time.monotonic()
+
+    def memory(self):
+        """rough size in bytes: the session and its questions. Frames of the task aren't counted"""
+        size = sys.getsizeof(self) + sys.getsizeof(self.questions)
+        for question in self.questions:
+            size += sys.getsizeof(question) + sum(sys.getsizeof(option) for option in question)
+        return size
+
+
+class QuizSessions:
+    """Quizzes of this process, one asyncio task per chat. Cancelling a quiz cancels its task, so $stop doesn't wait
+    for the question timer, and whatever the quiz waits on (sleep, send, answers) is released right away. Ended
+    sessions are dropped after finished_ttl seconds or when there are more than max_finished of them, least recently
+    ended first. Running ones without progress for idle_timeout seconds are cancelled"""
+    def __init__(self, on_end=None, logger=None, finished_ttl=600, max_finished=256, idle_timeout=1800):
+        self.on_end = on_end  # called with chat_id when a quiz is over, however it ended
+        self.logger = logger
+        self.finished_ttl = finished_ttl
+        self.max_finished = max_finished
+        self.idle_timeout = idle_timeout
+        self.running = {}  # chat_id: LiveQuiz
+        self.finished = OrderedDict()  # chat_id: LiveQuiz, least recently ended first
+        self.counts = {DONE: 0, STOPPED: 0, FAILED: 0}
+
+    def start(self, chat_id, play, map_name=None, user=None):
+        """run play(session) coroutine function as the quiz of the chat. It returns True if the quiz was stopped midway.
+        The caller holds the chat lock already"""
+        self.sweep()
+        session = LiveQuiz(chat_id, map_name, user)
+        self.finished.pop(chat_id, None)
+        self.running[chat_id] = session
+        session.task = asyncio.ensure_future(play(session))
+        session.task.add_done_callback(lambda task: self.end(session, task))
+        return session
+
+    def end(self, session, task):
+        if task.cancelled():
+            session.state = STOPPED
+        elif task.exception():
+            session.state = FAILED
+            if self.logger:
+                self.logger.error("Quiz in %s failed", session.chat_id, exc_info=task.exception(),
+                                  extra={"chat_id": session.chat_id})
+        else:
+            session.state = STOPPED if task.result() else DONE
+        self.counts[session.state] += 1
+        session.ended = time.monotonic()
+        session.task = None  # let go of the coroutine and everything it referenced
+        if self.running.get(session.chat_id) is session:
+            del self.running[session.chat_id]
+            self.finished[session.chat_id] = session
+        if self.on_end:
+            self.on_end(session.chat_id)
+        self.sweep()
+
+    def cancel(self, chat_id):
+        """cancel the quiz of the chat right away. False if this process doesn't run one there"""
+        session = self.running.get(chat_id)
+        if session is None or session.task is None or session.task.done():
+            return False
+        session.state = CANCEL
+        session.task.cancel()
+        return True
+
+    def get(self, chat_id):
+        return self.running.get(chat_id)
+
+    def sweep(self):
+        now = time.monotonic()
+        while self.finished:
+            chat_id, session = next(iter(self.finished.items()))
+            if now - session.ended < self.finished_ttl and len(self.finished) <= self.max_finished:
+                break
+            del self.finished[chat_id]
+        for chat_id, session in list(self.running.items()):
+            if now - session.updated > self.idle_timeout and self.cancel(chat_id) and self.logger:
+                self.logger.warning("Quiz in %s made no progress for %s s, cancelled", chat_id, self.idle_timeout,
+                                    extra={"chat_id": chat_id})
+
+    def sessions(self):
+        """running sessions first, then ended ones, most recent first"""
+        self.sweep()
+        return list(self.running.values()) + list(reversed(self.finished.values()))
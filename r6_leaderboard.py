@@ -0,0 +1,170 @@
+import atexit
+import queue
+import sqlite3
+import threading
+import time
+
+
+"""Quiz leaderboards: per channel, per guild (or telegram chat) and global. Totals are updated in place as answers come
+in and every ranking has its own index, so top-k is an index walk of k rows, not a scan of the answer history"""
+
+GLOBAL = ("global", 0)
+
+# metric: (column, order, ranks only players with at least min_answers answers)
+METRICS = {
+    "score": ("correct", "DESC", False),
+    "accuracy": ("accuracy", "DESC", True),
+    "streak": ("best_streak", "DESC", False),
+    "speed": ("avg_latency", "ASC", True),
+}
+
+
+class Leaderboard:
+    """SQLite (WAL mode) backed leaderboards. Answers are queued and written in batches by a background thread, so the
+    quiz loop never waits for the disk. Rankings catch up within flush_interval"""
+    def __init__(self, db_file, flush_interval=2, max_batch=1000, min_answers=10, max_attempts=3, logger=None):
+        self.db_file = db_file
+        self.flush_interval = flush_interval  # seconds. Max delay before queued answers hit the disk
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts  # per batch
+        self.logger = logger
+        self.min_answers = min_answers
+        self.writes = queue.Queue()
+        self.local = threading.local()  # readers: one connection per thread
+        conn = self.connect()
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS scores (scope TEXT NOT NULL, scope_id INTEGER NOT NULL, "
+                         "user_id INTEGER NOT NULL, answers INTEGER NOT NULL, correct INTEGER NOT NULL, "
+                         "streak INTEGER NOT NULL, best_streak INTEGER NOT NULL, latency_sum REAL NOT NULL, "
+                         "accuracy REAL NOT NULL, avg_latency REAL NOT NULL, updated REAL NOT NULL, "
+                         "PRIMARY KEY (scope, scope_id, user_id)) WITHOUT ROWID")
+            for metric, (column, order, qualified) in METRICS.items():
+                # partial index: one lucky answer doesn't make the top, and top-k doesn't skip over such players
+                condition = f" WHERE answers >= {self.min_answers}" if qualified else ""
+                conn.execute(f"CREATE INDEX IF NOT EXISTS {self.index_name(metric)} ON scores "
+                             f"(scope, scope_id, {column} {order}){condition}")
+            conn.execute("CREATE TABLE IF NOT EXISTS players (user_id INTEGER PRIMARY KEY, name TEXT)")
+        conn.close()
+        self.writer = threading.Thread(target=self.write_loop, name="leaderboard", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def index_name(self, metric):
+        return f"scores_{metric}_{self.min_answers}" if METRICS[metric][2] else f"scores_{metric}"
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def record(self, user_id, scopes, correct, latency, name=None):
+        """queue one answer for every (scope, scope_id) in scopes. Latency is seconds since the question was sent"""
+        self.writes.put((int(user_id), tuple(scopes), bool(correct), float(latency), name, time.time()))
+
+    def write_loop(self):
+        conn = self.connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # collect whatever comes in during flush_interval into one transaction
+            while len(batch) < self.max_batch and batch[-1] is not None:
+                try:
+                    batch.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            self.write(conn, [w for w in batch if w is not None])
+            if stop:
+                conn.close()
+                return
+
+    def write(self, conn, batch):
+        """apply the batch. A locked database (another process writing the same file) usually passes, so it's retried
+        a few times. A batch that still fails is dropped: the writer thread has to survive it"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.apply(conn, batch)
+                return
+            except Exception:
+                if self.logger:
+                    self.logger.exception("Failed to write %s answers to the leaderboard, attempt %s of %s", len(batch),
+                                          attempt, self.max_attempts)
+            if attempt < self.max_attempts:
+                time.sleep(self.flush_interval)
+        if self.logger:
+            self.logger.error("Dropped %s leaderboard answers", len(batch))
+
+    @staticmethod
+    def apply(conn, batch):
+        """fold the batch into one upsert per player and scope. Streaks need the order of answers, so besides totals
+        every row carries the run of correct answers the batch starts with, the one it ends with and the best one"""
+        totals = {}  # (scope, scope_id, user_id): row
+        names = {}
+        for user_id, scopes, correct, latency, name, ts in batch:
+            if name:
+                names[user_id] = name
+            for scope, scope_id in scopes:
+                row = totals.get((scope, scope_id, user_id))
+                if row is None:
+                    row = totals[(scope, scope_id, user_id)] = {
+                        "scope": scope, "scope_id": scope_id, "user_id": user_id, "answers": 0, "correct": 0,
+                        "latency": 0.0, "leading": 0, "broken": False, "trailing": 0, "best": 0}
+                row["answers"] += 1
+                row["latency"] += latency
+                row["updated"] = ts
+                if correct:
+                    row["correct"] += 1
+                    row["trailing"] += 1
+                    row["best"] = max(row["best"], row["trailing"])
+                    if not row["broken"]:
+                        row["leading"] += 1
+                else:
+                    row["broken"] = True
+                    row["trailing"] = 0
+        with conn:
+            conn.executemany("INSERT INTO scores (scope, scope_id, user_id, answers, correct, streak, best_streak, "
+                             "latency_sum, accuracy, avg_latency, updated) VALUES (:scope, :scope_id, :user_id, "
+                             ":answers, :correct, :trailing, :best, :latency, CAST(:correct AS REAL) / :answers, "
+                             ":latency / :answers, :updated) "
+                             "ON CONFLICT(scope, scope_id, user_id) DO UPDATE SET answers = answers + :answers, "
+                             "correct = correct + :correct, "
+                             "streak = CASE WHEN :broken THEN :trailing ELSE streak + :trailing END, "
+                             "best_streak = MAX(best_streak, streak + :leading, :best), "
+                             "latency_sum = latency_sum + :latency, "
+                             "accuracy = CAST(correct + :correct AS REAL) / (answers + :answers), "
+                             "avg_latency = (latency_sum + :latency) / (answers + :answers), "
+                             "updated = :updated", list(totals.values()))
+            conn.executemany("INSERT INTO players (user_id, name) VALUES (?, ?) "
+                             "ON CONFLICT(user_id) DO UPDATE SET name = excluded.name", names.items())
+
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+        return conn
+
+    def top(self, scope, scope_id, metric="score", k=10):
+        """[(user_id, name, answers, correct, accuracy, best_streak, avg_latency), ...] best first"""
+        column, order, qualified = METRICS[metric]
+        # the condition has to match the partial index literally, hence no parameter here
+        condition = f" AND s.answers >= {self.min_answers}" if qualified else ""
+        return self.reader().execute(
+            f"SELECT s.user_id, p.name, s.answers, s.correct, s.accuracy, s.best_streak, s.avg_latency "
+            f"FROM scores s INDEXED BY {self.index_name(metric)} LEFT JOIN players p ON p.user_id = s.user_id "
+            f"WHERE s.scope = ? AND s.scope_id = ?{condition} ORDER BY s.{column} {order} LIMIT ?",
+            (scope, scope_id, k)).fetchall()
+
+    def close(self):
+        """flush queued answers and stop the writer"""
+        if self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join()
+
+
+def format_top(rows, mention=None):
+    """leaderboard lines. mention(user_id, name) renders the player, plain name by default"""
+    mention = mention or (lambda user_id, name: name or str(user_id))
+    return "\n".join(f"{place}. {mention(user_id, name)}: {correct}/{answers} ({accuracy:.0%}), best streak {streak}, "
+                     f"{avg_latency:.1f} s avg"
+                     for place, (user_id, name, answers, correct, accuracy, streak, avg_latency) in enumerate(rows, 1))
@@ -0,0 +1,160 @@
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+
+"""Logging setup shared by both bots. Callers only put records on a queue, formatting and file writes (rotation
+included) happen on a listener thread, so a log call never blocks the event loop on disk I/O. Use %-style arguments
+(logger.info("quiz on %s", map_name)): the message is built on the listener thread and not at all for disabled levels.
+Records with extra={"chat_id": ...} are rate limited per chat. Worker processes forward their records to the parent
+process, which writes them along with its own"""
+
+TEXT_FORMAT = "%(asctime)s -  %(levelname)s - %(message)s"
+DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """one json object per line: easy to grep, easy to feed into anything"""
+    def format(self, record):
+        entry = {"ts": round(record.created, 3), "level": record.levelname, "logger": record.name,
+                 "msg": record.getMessage()}
+        chat_id = getattr(record, "chat_id", None)
+        if chat_id is not None:
+            entry["chat_id"] = chat_id
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ChatSampler(logging.Filter):
+    """token bucket per chat: burst records at once, then rate records per second. Warnings and errors always pass.
+    The first record after a drop tells how many were dropped"""
+    def __init__(self, rate=1, burst=20, sweep_interval=300):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.sweep_interval = sweep_interval  # seconds. Idle chats are forgotten after that
+        self.buckets = {}  # chat_id: [tokens, last refill, records dropped]
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        chat_id = getattr(record, "chat_id", None)
+        if chat_id is None or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sweep > self.sweep_interval:
+                self.sweep(now)
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.dropped += 1
+                return False
+            bucket[0] -= 1
+            if bucket[2]:
+                record.sampled_out = bucket[2]
+                bucket[2] = 0
+        return True
+
+    def sweep(self, now):
+        """drop buckets that are full again: they'd behave exactly like new ones"""
+        self.last_sweep = now
+        self.buckets = {chat_id: b for chat_id, b in self.buckets.items()
+                        if b[2] or b[0] + (now - b[1]) * self.rate < self.burst}
+
+
+class DropNoteFilter(logging.Filter):
+    """appends the drop counter left by ChatSampler. Runs on the listener thread"""
+    def filter(self, record):
+        dropped = getattr(record, "sampled_out", 0)
+        if dropped:
+            record.msg = f"{record.msg} [{dropped} earlier records of this chat dropped]"
+        return True
+
+
+class LazyQueueHandler(QueueHandler):
+    """stock QueueHandler formats the message in the calling thread. This one leaves msg and args as they are, so log
+    arguments must not be mutated after the call (strings and numbers everywhere in this repo). Tracebacks are
+    rendered right away since they reference live frames. A full queue drops the record instead of blocking"""
+    def __init__(self, log_queue, max_size=10000):
+        super().__init__(log_queue)
+        self.max_size = max_size
+        self.dropped = 0
+        self.formatter = logging.Formatter()
+
+    def prepare(self, record):
+        if record.exc_info:
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue is a lot cheaper than queue.Queue, but has no maxsize of its own
+        if self.queue.qsize() >= self.max_size:
+            self.dropped += 1
+            return
+        self.queue.put_nowait(record)
+
+
+def setup_logging(name, log_file, max_log_file_size=10, max_log_files=5, level=logging.DEBUG, json_lines=False,
+                  chat_rate=1, chat_burst=20, queue_size=10000):
+    """logger writing to a rotating file through a background listener. max_log_file_size in MB. json_lines switches
+    the file format to one json object per record. chat_rate=None turns per-chat sampling off"""
+    # neither format uses caller, thread or process info, skip collecting it for every record
+    # (see "Optimization" in the logging docs)
+    logging._srcfile = None
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
+    logger = logging.getLogger(name)
+    if any(type(handler) is QueueHandler for handler in logger.handlers):
+        return logger  # worker process forwarding records, see forward_logging
+    logger.setLevel(level)
+    file_handler = RotatingFileHandler(log_file, mode='a', maxBytes=max_log_file_size * 1024 * 1024,
+                                       backupCount=max_log_files, encoding='utf-8', delay=False)
+    file_handler.setFormatter(JsonLinesFormatter() if json_lines else logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    file_handler.addFilter(DropNoteFilter())
+    queue_handler = LazyQueueHandler(queue.SimpleQueue(), queue_size)
+    if chat_rate:
+        queue_handler.addFilter(ChatSampler(chat_rate, chat_burst))
+    logger.addHandler(queue_handler)
+    queue_handler.listener = QueueListener(queue_handler.queue, file_handler, respect_handler_level=True)
+    queue_handler.listener.start()
+    atexit.register(stop_logging, logger)
+    return logger
+
+
+def stop_logging(logger):
+    """write out whatever is still queued and stop listener threads of the logger"""
+    for handler in logger.handlers:
+        if isinstance(handler, LazyQueueHandler) and handler.listener._thread:
+            handler.listener.stop()
+
+
+def forward_logging(logger, log_queue):
+    """worker process: records go to log_queue (anything with put_nowait, sends them to the parent process) instead
+    of the log file, the parent passes them to logger.handle. Messages are formatted here, arguments of a record don't
+    have to survive pickling then. Per-chat sampling stays in the worker"""
+    sampler = next((f for h in logger.handlers for f in h.filters if isinstance(f, ChatSampler)), None)
+    stop_logging(logger)
+    for handler in list(logger.handlers):
+        if isinstance(handler, LazyQueueHandler):
+            for file_handler in handler.listener.handlers:
+                file_handler.close()
+        logger.removeHandler(handler)
+    handler = QueueHandler(log_queue)
+    if sampler:
+        handler.addFilter(ChatSampler(sampler.rate, sampler.burst, sampler.sweep_interval))
+    logger.addHandler(handler)
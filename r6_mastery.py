@@ -0,0 +1,315 @@
+import array
+import atexit
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from r6_quiz import QuizSampler
+
+
+"""Per-user answer statistics for adaptive "focus on what I get wrong" quizzes. Counters live in flat arrays with one
+slot per callout and go to the disk as one blob per user and map pool. Correct answers are drawn from a Fenwick tree
+of weights: k questions cost O(k log n), every answer updates one weight in O(log n), nothing is rebuilt per quiz.
+Several processes can share one database (Telegram workers, Discord shards): slots are numbered by the database and
+every process adds its own answers to the stored counters instead of overwriting them"""
+
+
+def answer_weight(correct, wrong, seen, now, stale_after):
+    """how likely the callout is asked. Laplace-smoothed share of wrong answers: unseen callouts start at 1/2, ten
+    correct answers in a row bring it down to 1/12. Callouts not asked for stale_after seconds get up to twice that"""
+    error_rate = (wrong + 1) / (correct + wrong + 2)
+    staleness = min(now - seen, stale_after) / stale_after if seen else 1
+    return error_rate * (1 + staleness)
+
+
+class FenwickTree:
+    """binary indexed tree over non-negative weights. Weight update and search by cumulative weight in O(log n)"""
+    def __init__(self, weights):
+        self.weights = array.array("d", weights)
+        n = len(self.weights)
+        self.tree = array.array("d", [0.0]) + self.weights  # 1-based, built in O(n)
+        for i in range(1, n + 1):
+            parent = i + (i & -i)
+            if parent <= n:
+                self.tree[parent] += self.tree[i]
+        self.top = 1 << n.bit_length() >> 1  # highest power of two <= n
+
+    def __len__(self):
+        return len(self.weights)
+
+    def set(self, i, weight):
+        delta = weight - self.weights[i]
+        self.weights[i] = weight
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def total(self):
+        i, total = len(self.weights), 0.0
+        while i:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def find(self, value):
+        """index of the item where cumulative weight passes value"""
+        pos, step = 0, self.top
+        while step:
+            if pos + step < len(self.tree) and self.tree[pos + step] <= value:
+                pos += step
+                value -= self.tree[pos]
+            step >>= 1
+        return min(pos, len(self.weights) - 1)
+
+    def sample(self, k, rng=random):
+        """k distinct indexes. Every pick is proportional to weight among the items left. Picked weights are zeroed
+        for the duration of the draw and put back afterwards"""
+        picked = []
+        for _ in range(min(k, len(self.weights))):
+            total = self.total()
+            if total <= 1e-12:
+                break
+            i = self.find(rng.random() * total)
+            if self.weights[i] <= 0:  # float rounding at the very end of the range
+                i = max(range(len(self.weights)), key=self.weights.__getitem__)
+            picked.append((i, self.weights[i]))
+            self.set(i, 0.0)
+        for i, weight in picked:
+            self.set(i, weight)
+        return [i for i, _ in picked]
+
+
+class MasteryProfile:
+    """answer counters of one user in one map pool. Arrays are indexed by callout slot, the tree by position in quiz
+    keys the profile was last used with"""
+    __slots__ = ("correct", "wrong", "seen", "keys", "tree", "base")
+
+    def __init__(self, data=b"", base=None):
+        counters = array.array("I")
+        counters.frombytes(data)
+        n = len(counters) // 3
+        self.correct = counters[:n]
+        self.wrong = counters[n:2 * n]
+        self.seen = counters[2 * n:]  # unix time of the last answer, 0 if never asked
+        self.keys = None
+        self.tree = None
+        self.base = data if base is None else base  # counters as they were last read from or written to the disk
+
+    def encode(self):
+        return (self.correct + self.wrong + self.seen).tobytes()
+
+    def grow(self, n):
+        """make room for callouts added to the pool since the profile was stored"""
+        for counters in (self.correct, self.wrong, self.seen):
+            if len(counters) < n:
+                counters.extend([0] * (n - len(counters)))
+
+    @staticmethod
+    def merge(stored, ours, base):
+        """counters blob with answers of every process: stored has what the others wrote, ours minus base is what
+        this one counted since it last synced with the disk"""
+        stored, ours, base = MasteryProfile(stored), MasteryProfile(ours), MasteryProfile(base)
+        n = max(len(stored.correct), len(ours.correct), len(base.correct))
+        for profile in (stored, ours, base):
+            profile.grow(n)
+        for s in range(n):
+            stored.correct[s] += ours.correct[s] - base.correct[s]
+            stored.wrong[s] += ours.wrong[s] - base.wrong[s]
+            stored.seen[s] = max(stored.seen[s], ours.seen[s])
+        return stored.encode()
+
+    def replace(self, data):
+        """take counters of data, the tree is rebuilt on the next use"""
+        other = MasteryProfile(data)
+        self.correct, self.wrong, self.seen = other.correct, other.wrong, other.seen
+        self.keys = None
+
+
+class MasteryStore:
+    """SQLite (WAL mode) backed mastery profiles. Recently used profiles stay in memory, changed ones are written in
+    batches by a background thread. Callout slots are append-only per map pool, so stored counters never shift when
+    content changes: callouts removed from quiz.txt just stop being asked"""
+    def __init__(self, db_file, flush_interval=2, cache_size=4096, stale_after=7 * 24 * 3600, logger=None):
+        self.db_file = db_file
+        self.flush_interval = flush_interval  # seconds. Max delay before answers hit the disk
+        self.cache_size = cache_size  # profiles kept in memory
+        self.stale_after = stale_after
+        self.logger = logger
+        self.lock = threading.RLock()
+        self.conn = self.connect()
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS callouts (map_name TEXT NOT NULL, name TEXT NOT NULL, "
+                              "slot INTEGER NOT NULL, PRIMARY KEY (map_name, name)) WITHOUT ROWID")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS mastery (user_id INTEGER NOT NULL, map_name TEXT NOT NULL, "
+                              "counters BLOB NOT NULL, updated REAL NOT NULL, PRIMARY KEY (user_id, map_name)) "
+                              "WITHOUT ROWID")
+        self.slots = {}  # map_name: {callout: slot}
+        self.positions = {}  # map_name: (keys, slot of every key, {callout: position in keys})
+        self.profiles = OrderedDict()  # (user_id, map_name): MasteryProfile, least recently used first
+        self.dirty = set()
+        # (user_id, map_name): (counters blob, base blob) of changed profiles pushed out of memory, then being written
+        self.evicted = {}
+        self.flushing = {}
+        self.stop = threading.Event()
+        self.writer = threading.Thread(target=self.write_loop, name="mastery", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def key_positions(self, map_name, keys):
+        """slots of current quiz keys of the map pool. New callouts get new slots"""
+        cached = self.positions.get(map_name)
+        if cached and cached[0] is keys:
+            return cached
+        slots = self.slots.get(map_name)
+        if slots is None:
+            slots = dict(self.conn.execute("SELECT name, slot FROM callouts WHERE map_name = ?", (map_name,)))
+            self.slots[map_name] = slots
+        new = [name for name in keys if name not in slots]
+        if new:
+            # another process may be adding the same callouts right now: the write lock is taken before the numbers
+            # are picked, and whatever made it into the table is read back
+            with self.conn:
+                self.conn.execute("BEGIN IMMEDIATE")
+                self.conn.executemany("INSERT OR IGNORE INTO callouts (map_name, name, slot) "
+                                      "SELECT ?, ?, COALESCE(MAX(slot), -1) + 1 FROM callouts WHERE map_name = ?",
+                                      [(map_name, name, map_name) for name in new])
+            slots.update(self.conn.execute("SELECT name, slot FROM callouts WHERE map_name = ?", (map_name,)))
+        cached = keys, [slots[name] for name in keys], {name: i for i, name in enumerate(keys)}
+        self.positions[map_name] = cached
+        return cached
+
+    def profile(self, user_id, map_name, keys):
+        """profile with its tree built for keys. Call with the lock held"""
+        key = (user_id, map_name)
+        profile = self.profiles.get(key)
+        if profile is None:
+            pending = self.evicted.pop(key, None) or self.flushing.get(key)
+            if pending is not None:  # came back before the writer was done with it
+                profile = MasteryProfile(*pending)
+                self.dirty.add(key)
+            else:
+                row = self.conn.execute("SELECT counters FROM mastery WHERE user_id = ? AND map_name = ?",
+                                        key).fetchone()
+                profile = MasteryProfile(row[0] if row else b"")
+            self.profiles[key] = profile
+            while len(self.profiles) > self.cache_size:
+                old_key, old = self.profiles.popitem(last=False)
+                if old_key in self.dirty:
+                    self.dirty.discard(old_key)
+                    self.evicted[old_key] = (old.encode(), old.base)
+        else:
+            self.profiles.move_to_end(key)
+        if profile.keys is not keys:  # first use or content reloaded: O(n) once, not per quiz
+            _, slots, _ = self.key_positions(map_name, keys)
+            profile.grow(max(slots, default=-1) + 1)
+            now = time.time()
+            profile.tree = FenwickTree([answer_weight(profile.correct[s], profile.wrong[s], profile.seen[s], now,
+                                                      self.stale_after) for s in slots])
+            profile.keys = keys
+        return profile
+
+    def sample(self, user_id, map_name, keys, quiz_length, total_options, rng=random):
+        """quiz questions in QuizSampler.sample format, correct answers weighted towards user's mistakes"""
+        with self.lock:
+            answers = self.profile(user_id, map_name, keys).tree.sample(quiz_length, rng)
+        return QuizSampler.questions(keys, answers, total_options, rng)
+
+    def record(self, user_id, map_name, keys, callout, correct):
+        """count the answer and reweight the callout right away"""
+        if not keys:
+            return
+        with self.lock:
+            profile = self.profile(user_id, map_name, keys)
+            _, slots, positions = self.key_positions(map_name, keys)
+            i = positions.get(callout)
+            if i is None:  # content changed while the question was on screen
+                return
+            s = slots[i]
+            if correct:
+                profile.correct[s] += 1
+            else:
+                profile.wrong[s] += 1
+            now = time.time()
+            profile.seen[s] = int(now)
+            profile.tree.set(i, answer_weight(profile.correct[s], profile.wrong[s], profile.seen[s], now,
+                                              self.stale_after))
+            self.dirty.add((user_id, map_name))
+
+    def stats(self, user_id, map_name, keys):
+        """{callout: (correct, wrong)} of the current quiz keys"""
+        with self.lock:
+            profile = self.profile(user_id, map_name, keys)
+            _, slots, _ = self.key_positions(map_name, keys)
+            return {name: (profile.correct[s], profile.wrong[s]) for name, s in zip(keys, slots)}
+
+    def write_loop(self):
+        conn = self.connect()
+        while not self.stop.wait(self.flush_interval):
+            self.write(conn)
+        self.write(conn)
+        conn.close()
+
+    def write(self, conn):
+        """flush, the writer thread has to survive a failed one. Nothing is lost: the next flush writes it"""
+        try:
+            self.flush(conn)
+        except Exception:
+            if self.logger:
+                self.logger.exception("Failed to write mastery stats, retrying in %s s", self.flush_interval)
+
+    def flush(self, conn):
+        with self.lock:
+            self.flushing = {key: (self.profiles[key].encode(), self.profiles[key].base) for key in self.dirty}
+            self.flushing.update(self.evicted)
+            self.dirty.clear()
+            self.evicted.clear()
+            pending = self.flushing
+        if not pending:
+            return
+        merged = {}
+        try:
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")  # nobody else writes between our read and our write
+                for key, (data, base) in pending.items():
+                    row = conn.execute("SELECT counters FROM mastery WHERE user_id = ? AND map_name = ?",
+                                       key).fetchone()
+                    merged[key] = MasteryProfile.merge(row[0] if row else b"", data, base)
+                now = time.time()
+                conn.executemany("INSERT OR REPLACE INTO mastery (user_id, map_name, counters, updated) "
+                                 "VALUES (?, ?, ?, ?)", [key + (counters, now) for key, counters in merged.items()])
+        except Exception:
+            with self.lock:  # nothing was written, bases are unchanged: try again with the next flush
+                for key, entry in pending.items():
+                    if key in self.profiles:
+                        self.dirty.add(key)
+                    else:
+                        self.evicted.setdefault(key, entry)
+                self.flushing = {}
+            raise
+        with self.lock:
+            # profiles in memory take in answers other processes stored, and keep the ones counted here since
+            for key, stored in merged.items():
+                profile = self.profiles.get(key)
+                if profile is not None:
+                    data = profile.encode()
+                    rebased = MasteryProfile.merge(stored, data, pending[key][0])
+                    if rebased != data:
+                        profile.replace(rebased)
+                    profile.base = stored
+                elif key in self.evicted:
+                    self.evicted[key] = (MasteryProfile.merge(stored, self.evicted[key][0], pending[key][0]), stored)
+            self.flushing = {}
+
+    def close(self):
+        """write pending answers and stop the writer"""
+        if self.writer.is_alive():
+            self.stop.set()
+            self.writer.join()
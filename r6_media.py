@@ -0,0 +1,205 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from os import stat, replace, path, listdir, getpid
+
+
+"""Shared helpers for sending quiz pictures and map schematics without re-uploading them every time"""
+
+# downscaled copies of quiz pictures and schematics built by tools/build_variants.py
+VARIANTS_DIR = "files/variants"
+VARIANTS_MANIFEST = f"{VARIANTS_DIR}/manifest.txt"
+# tier name: (max width/height in px, format, quality)
+VARIANTS_TIERS = {"jpeg": (1280, "JPEG", 85),
+                  "webp": (1280, "WEBP", 80),
+                  "thumb": (320, "JPEG", 75)}
+
+
+def file_digest(file_path, chunk_size=1024 * 1024):
+    """sha1 of the file content. Used as a part of the cache key so modified pictures are uploaded again"""
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MediaCache:
+    """Persistent map of local file -> id the messenger returned after the upload (telegram file_id, discord CDN url).
+    Every entry keeps the content hash of the uploaded file along with its mtime and size. Stat is checked on every
+    lookup (cheap), the file is re-hashed only when stat changed, and entry is dropped if the content did change"""
+    def __init__(self, cache_file, save_delay=5):
+        self.cache_file = cache_file
+        self.save_delay = save_delay  # seconds. Batches multiple uploads into one write
+        self.lock = threading.Lock()
+        self.timer = None
+        self.entries = self.load()
+        self.dropped = {}  # file path: when it was dropped, so save() doesn't bring the entry back from the disk
+
+    def load(self):
+        try:
+            with open(self.cache_file, "r") as of:
+                return json.load(of)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return {}
+
+    def get(self, file_path):
+        """returns remote id for the file or None if it was never uploaded or changed since.
+        Raises FileNotFoundError if the file itself is missing, same as open() would"""
+        st = stat(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+        if not entry:
+            return None
+        if entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            return entry["remote_id"]
+        # file was touched. Only content matters here, so compare hashes before throwing the id away
+        if file_digest(file_path) == entry["hash"]:
+            with self.lock:
+                entry["mtime"], entry["size"] = st.st_mtime_ns, st.st_size
+            self.start_save_timer()
+            return entry["remote_id"]
+        self.drop(file_path)
+        return None
+
+    def put(self, file_path, remote_id):
+        """remember remote id for the file that was just uploaded"""
+        st = stat(file_path)
+        entry = {"hash": file_digest(file_path), "mtime": st.st_mtime_ns, "size": st.st_size, "remote_id": remote_id,
+                 "checked": time.time()}
+        with self.lock:
+            self.entries[file_path] = entry
+        self.start_save_timer()
+
+    def checked_ago(self, file_path):
+        """seconds since remote id was uploaded or last confirmed alive with touch()"""
+        with self.lock:
+            entry = self.entries.get(file_path, {})
+        return time.time() - entry.get("checked", 0)
+
+    def touch(self, file_path):
+        """mark remote id as confirmed alive"""
+        with self.lock:
+            if file_path in self.entries:
+                self.entries[file_path]["checked"] = time.time()
+        self.start_save_timer()
+
+    def drop(self, file_path):
+        """forget the file. Used when messenger refuses the cached id"""
+        with self.lock:
+            self.entries.pop(file_path, None)
+            self.dropped[file_path] = time.time()
+        self.start_save_timer()
+
+    def start_save_timer(self):
+        with self.lock:
+            if self.timer and self.timer.is_alive():
+                return
+            if self.save_delay <= 0:
+                self.timer = None
+            else:
+                self.timer = threading.Timer(self.save_delay, self.save)
+                self.timer.daemon = True
+                self.timer.start()
+                return
+        self.save()
+
+    def save(self):
+        """dump cache to disk. Worker processes share the file, so entries other processes saved in the meantime are
+        merged in (and used here from now on) rather than overwritten. The one checked last wins when both have the
+        file. Write to a temp file first so a crash won't leave a broken cache behind"""
+        on_disk = self.load()
+        with self.lock:
+            for file_path, entry in on_disk.items():
+                ours = self.entries.get(file_path)
+                newer_than = ours.get("checked", 0) if ours else self.dropped.get(file_path, -1)
+                if entry.get("checked", 0) > newer_than:
+                    self.entries[file_path] = entry
+            self.dropped.clear()
+            data = json.dumps(self.entries)
+        tmp_file = f"{self.cache_file}.{getpid()}.tmp"
+        with open(tmp_file, "w") as wf:
+            wf.write(data)
+        replace(tmp_file, self.cache_file)
+
+
+class ByteCache:
+    """Bounded LRU of file contents, keyed by path and checked against mtime and size on every read. Meant to be
+    called from worker threads: the point is to keep disk reads off the event loop and serve hot pictures from memory"""
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()  # path: (mtime, size, bytes), least recently used first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def read(self, file_path):
+        st = stat(file_path)
+        with self.lock:
+            entry = self.entries.get(file_path)
+            if entry and entry[:2] == (st.st_mtime_ns, st.st_size):
+                self.entries.move_to_end(file_path)
+                self.hits += 1
+                return entry[2]
+        with open(file_path, 'rb') as f:
+            data = f.read()
+        with self.lock:
+            self.misses += 1
+            old = self.entries.pop(file_path, None)
+            if old:
+                self.size -= len(old[2])
+            if len(data) <= self.max_bytes:  # a file bigger than the whole cache is just passed through
+                self.entries[file_path] = (st.st_mtime_ns, st.st_size, data)
+                self.size += len(data)
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+
+def build_schematic_index(maps_dir):
+    """{MAP: [schematic paths sorted by name]} for every map folder in maps_dir. Built once on start, so floors always
+    go in the same order and nobody walks the directory on every request"""
+    maps_dir = maps_dir.rstrip("/")
+    index = {}
+    for map_name in sorted(listdir(maps_dir)):
+        if path.isdir(f"{maps_dir}/{map_name}"):
+            index[map_name] = [f"{maps_dir}/{map_name}/{file}" for file in sorted(listdir(f"{maps_dir}/{map_name}"))
+                               if file.endswith('png')]
+    return index
+
+
+def variant_path(src, tier):
+    """where tools/build_variants.py puts the tier variant of files/<dir>/<...> picture"""
+    ext = VARIANTS_TIERS[tier][1].lower().replace("jpeg", "jpg")
+    return f"{VARIANTS_DIR}/{tier}/{path.splitext(src.split('/', 1)[1])[0]}.{ext}"
+
+
+class ImageManifest:
+    """Resolves original picture path into its transcoded variant for the platform. Falls back to the original if
+    there's no manifest, the picture isn't in it or it was modified after the variants were built"""
+    def __init__(self, manifest_file=VARIANTS_MANIFEST, files=None):
+        if files is not None:  # already loaded, e.g. from the content snapshot
+            self.files = files
+            return
+        try:
+            with open(manifest_file, "r") as of:
+                self.files = json.load(of)["files"]
+        except (FileNotFoundError, json.decoder.JSONDecodeError, KeyError):
+            self.files = {}
+
+    def variant(self, src, tier):
+        entry = self.files.get(src)
+        if not entry or tier not in entry["variants"]:
+            return src
+        try:
+            st = stat(src)
+            if st.st_mtime_ns != entry["mtime"] or st.st_size != entry["size"] or \
+                    not path.exists(entry["variants"][tier]):
+                return src
+        except FileNotFoundError:
+            return src
+        return entry["variants"][tier]
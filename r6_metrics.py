@@ -0,0 +1,245 @@
+import asyncio
+import functools
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+"""Runtime metrics for both bots in Prometheus text format: handler latency histograms, upload sizes, send queue
+counters, live sessions, event loop lag. Served by a tiny HTTP server thread on a local port. NullMetrics has the same
+interface and does nothing: timed() hands the function back untouched, so a disabled bot pays nothing per call"""
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+BYTES_BUCKETS = tuple(4 ** i * 1024 for i in range(1, 8))  # 4 KB to 16 MB
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def label_text(names, values, extra=""):
+    """{name="value",...} part of a sample line"""
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values = {}  # label values: count
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            lines.extend(f"{self.name}{label_text(self.labels, k)} {v}" for k, v in self.values.items())
+        return lines
+
+
+class Histogram:
+    """cumulative buckets are computed at render time, observe() bumps a single bucket"""
+    def __init__(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values: [count per bucket..., count over the last bucket, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[i] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            series = [(k, list(v)) for k, v in self.series.items()]
+        for label_values, counts in series:
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                total += count
+                le = f'le="{bound}"'
+                lines.append(f"{self.name}_bucket{label_text(self.labels, label_values, le)} {total}")
+            lines.append(f"{self.name}_sum{label_text(self.labels, label_values)} {counts[-1]}")
+            lines.append(f"{self.name}_count{label_text(self.labels, label_values)} {total}")
+        return lines
+
+
+class Sampled:
+    """value read at scrape time: fn() returns a number, {label values: number} or None to skip"""
+    def __init__(self, name, doc, fn, kind="gauge", labels=()):
+        self.name = name
+        self.doc = doc
+        self.fn = fn
+        self.kind = kind
+        self.labels = labels
+
+    def render(self):
+        value = self.fn()
+        if value is None:
+            return []
+        values = value if isinstance(value, dict) else {(): value}
+        return [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"] + \
+            [f"{self.name}{label_text(self.labels, k)} {v}" for k, v in values.items()]
+
+
+class Metrics:
+    def __init__(self, prefix="r6"):
+        self.prefix = prefix
+        self.metrics = {}
+        self.started = time.time()
+        self.server = None
+        self.handler_latency = self.histogram("handler_seconds", "Handler run time", ("handler",))
+        self.handler_errors = self.counter("handler_errors_total", "Handler exceptions", ("handler",))
+        self.sampled("uptime_seconds", "Seconds since start", lambda: round(time.time() - self.started, 1))
+
+    def add(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, doc, labels=()):
+        return self.add(Counter(f"{self.prefix}_{name}", doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=LATENCY_BUCKETS):
+        return self.add(Histogram(f"{self.prefix}_{name}", doc, labels, buckets))
+
+    def sampled(self, name, doc, fn, kind="gauge", labels=()):
+        return self.add(Sampled(f"{self.prefix}_{name}", doc, fn, kind, labels))
+
+    def timed(self, name):
+        """decorator: run time of every call into the handler_seconds histogram. Works for coroutine functions"""
+        def decorator(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def timed_coroutine(*args, **kwargs):
+                    start = time.perf_counter()
+                    try:
+                        return await fn(*args, **kwargs)
+                    except Exception:
+                        self.handler_errors.inc(name)
+                        raise
+                    finally:
+                        self.handler_latency.observe(time.perf_counter() - start, name)
+                return timed_coroutine
+
+            @functools.wraps(fn)
+            def timed_function(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                except Exception:
+                    self.handler_errors.inc(name)
+                    raise
+                finally:
+                    self.handler_latency.observe(time.perf_counter() - start, name)
+            return timed_function
+        return decorator
+
+    def send_stats(self, stats):
+        """counters of a send scheduler (r6_scheduler.SendStats) plus its queue delays as a histogram"""
+        for name, doc, attr in (("sends_total", "Messages and calls sent", "sent"),
+                                ("sends_merged_total", "Texts merged into the previous message", "merged"),
+                                ("sends_throttled_total", "429 replies, each one is retried", "throttled"),
+                                ("sends_failed_total", "Sends that failed for good", "failed")):
+            self.sampled(name, doc, functools.partial(getattr, stats, attr), kind="counter")
+        stats.observe = self.histogram("send_queue_delay_seconds", "Time from submit to send").observe
+
+    async def watch_loop_lag(self, interval=0.5):
+        """how late the event loop wakes up a sleeping coroutine: time callbacks were stuck behind blocking code"""
+        lag = self.histogram("loop_lag_seconds", "Event loop wake up delay", buckets=LAG_BUCKETS)
+        loop = asyncio.get_event_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(interval)
+            lag.observe(max(0.0, loop.time() - start - interval))
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def serve(self, listen="127.0.0.1", port=9108):
+        """GET /metrics on a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass  # scrapes every few seconds would flood the bot log
+
+        self.server = ThreadingHTTPServer((listen, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        return self.server
+
+
+class NullMetric:
+    def inc(self, *args, **kwargs):
+        pass
+
+    def observe(self, *args):
+        pass
+
+
+class NullMetrics:
+    """metrics off"""
+    null = NullMetric()
+
+    def counter(self, *args, **kwargs):
+        return self.null
+
+    def histogram(self, *args, **kwargs):
+        return self.null
+
+    def sampled(self, *args, **kwargs):
+        return self.null
+
+    def timed(self, name):
+        return lambda fn: fn
+
+    def send_stats(self, stats):
+        pass
+
+    async def watch_loop_lag(self, interval=0.5):
+        pass
+
+    def render(self):
+        return ""
+
+    def serve(self, listen="127.0.0.1", port=9108):
+        return None
+
+
+def metrics_from_cfg(cfg, port_offset=0):
+    """Metrics serving on {"ENABLED": true, "LISTEN": ..., "PORT": ...}, NullMetrics if not enabled"""
+    if not cfg.get("ENABLED"):
+        return NullMetrics()
+    metrics = Metrics()
+    metrics.serve(cfg.get("LISTEN", "127.0.0.1"), cfg.get("PORT", 9108) + port_offset)
+    return metrics
@@ -0,0 +1,48 @@
+import random
+
+
+"""Quiz question sampling shared by both bots"""
+
+
+def sparse_sample(n, k, rng=random):
+    """k distinct random indexes from range(n) in O(k) time and memory: partial Fisher-Yates shuffle where the
+    permutation is stored sparsely, only for the positions that were actually swapped"""
+    swapped = {}
+    picked = []
+    for i in range(min(k, n)):
+        j = rng.randrange(i, n)
+        picked.append(swapped.get(j, j))
+        swapped[j] = swapped.get(i, i)
+    return picked
+
+
+class QuizSampler:
+    """Per-map index of callout names built once from quiz data. Composes a whole quiz in O(k) for k questions no
+    matter how big the map pool is"""
+    def __init__(self, quiz_data=None, keys=None):
+        # keys: prebuilt index, e.g. from the content snapshot
+        self.keys = keys if keys is not None else {map_name: list(callouts) for map_name, callouts in quiz_data.items()}
+
+    def sample(self, quiz_length, map_name, total_options, rng=random):
+        """list of quiz questions. Every question is a list of options, the first one is always the correct answer.
+        Correct answers don't repeat within a quiz"""
+        keys = self.keys[map_name]
+        return self.questions(keys, sparse_sample(len(keys), quiz_length, rng), total_options, rng)
+
+    @staticmethod
+    def questions(keys, answers, total_options, rng=random):
+        """quiz questions for correct answers picked elsewhere (indexes into keys), distractors are drawn here"""
+        n = len(keys)
+        true_total_options = min(total_options, n - 1)
+        all_questions = []
+        for answer in answers:
+            # pick distractors from n - 1 callouts, shifting indexes past the correct one to skip it
+            options = [keys[answer]]
+            for i in sparse_sample(n - 1, true_total_options, rng):
+                options.append(keys[i + 1 if i >= answer else i])
+            all_questions.append(options)
+        return all_questions
+
+    def sample_many(self, amount, quiz_length, map_name, total_options, rng=random):
+        """compose a batch of independent quizzes for the same map"""
+        return [self.sample(quiz_length, map_name, total_options, rng) for _ in range(amount)]
@@ -0,0 +1,419 @@
+import asyncio
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+"""Outbound message scheduler shared by both bots. Every send goes through one queue that keeps the platform rate
+limits (global and per chat token buckets), sends quiz questions and verdicts ahead of bulky stuff like schematics,
+keeps messages of one chat in order and merges plain texts queued back to back for the same chat into one message"""
+
+# priorities. Lower goes first
+URGENT = 0  # quiz questions and verdicts: somebody is waiting for them right now
+NORMAL = 1
+BULK = 2  # schematics albums
+
+# (rate per second, burst) from the platforms' docs. Telegram: ~30 messages/s overall, ~1/s in a private chat,
+# 20/minute in a group. Discord: 50 requests/s overall, 5 messages per 5 s per channel, reactions have their own
+# limit of one per 0.25 s per channel
+TELEGRAM_LIMITS = {"global": (30, 30), "private": (1, 5), "group": (20 / 60, 5)}
+DISCORD_LIMITS = {"global": (50, 50), "channel": (1, 5), "reactions": (4, 1)}
+TELEGRAM_TEXT_LIMIT = 4096
+DISCORD_TEXT_LIMIT = 2000
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate  # tokens per second
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0  # set by 429 replies
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self, now, cost=1):
+        """seconds until cost tokens are available. Costs above burst wait for a full bucket and go into debt"""
+        self.refill(now)
+        wait = max(0, self.blocked_until - now)
+        if self.tokens < min(cost, self.burst):
+            wait = max(wait, (min(cost, self.burst) - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now, cost=1):
+        self.refill(now)
+        self.tokens -= cost
+
+    def block(self, now, seconds):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    def idle(self, now):
+        self.refill(now)
+        return self.tokens >= self.burst and self.blocked_until <= now
+
+
+class SendJob:
+    """one queued call. Plain text jobs (text_arg set) can absorb the text jobs queued right after them"""
+    __slots__ = ("chat_id", "fn", "args", "kwargs", "priority", "cost", "text_arg", "seq", "queued", "futures",
+                 "attempts")
+
+    def __init__(self, chat_id, fn, args, kwargs, priority, cost, text_arg, future):
+        self.chat_id = chat_id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.cost = cost
+        self.text_arg = text_arg  # name of the text kwarg for mergeable messages
+        self.seq = None
+        self.queued = time.monotonic()
+        self.futures = [future]  # merged jobs share the result of the message they went into
+        self.attempts = 0
+
+    def is_plain_text(self):
+        return self.text_arg is not None and set(self.kwargs) == {self.text_arg}
+
+
+class SendStats:
+    """queue delay and outcome counters"""
+    def __init__(self, window=1000):
+        self.sent = 0
+        self.merged = 0
+        self.throttled = 0  # 429 replies
+        self.failed = 0
+        self.delays = deque(maxlen=window)  # seconds from submit to send of the latest jobs
+        self.max_delay = 0
+        self.observe = None  # optional callback with every delay, see r6_metrics
+
+    def record(self, delay):
+        self.sent += 1
+        self.delays.append(delay)
+        self.max_delay = max(self.max_delay, delay)
+        if self.observe:
+            self.observe(delay)
+
+    def percentile(self, q):
+        if not self.delays:
+            return 0
+        ordered = sorted(self.delays)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def summary(self):
+        return f"sent {self.sent}, merged {self.merged}, 429s {self.throttled}, failed {self.failed}, queue delay " \
+               f"p50 {self.percentile(0.5) * 1000:.0f} ms, p99 {self.percentile(0.99) * 1000:.0f} ms, " \
+               f"max {self.max_delay * 1000:.0f} ms"
+
+
+class SendQueue:
+    """Scheduling core without any threads or event loop. Chats wait in a heap ordered by priority of their first
+    job, then by submit order; chats out of tokens wait in a second heap ordered by the time they get tokens back.
+    Only one job per chat is in flight at a time, that's what keeps messages of a chat in order"""
+    def __init__(self, global_limit, chat_limits, max_text_length, merge_kwargs=()):
+        self.global_bucket = TokenBucket(*global_limit)
+        self.chat_limits = chat_limits  # function chat_id -> (rate, burst)
+        self.max_text_length = max_text_length
+        self.merge_kwargs = set(merge_kwargs)  # extra kwargs a text may carry and still be merged into the previous one
+        self.chats = {}  # chat_id: deque of waiting jobs
+        self.buckets = {}  # chat_id: TokenBucket. Full buckets of idle chats are dropped
+        self.busy = set()  # chats with a job in flight
+        self.ready = []  # heap of (priority, seq, chat_id)
+        self.delayed = []  # heap of (time chat gets tokens, seq, chat_id)
+        self.seq = itertools.count()
+        self.stats = SendStats()
+        self.sweep_interval = 60  # seconds between dropping buckets of chats that went quiet
+        self.last_sweep = time.monotonic()
+
+    def __len__(self):
+        return sum(len(jobs) for jobs in self.chats.values())
+
+    def bucket(self, chat_id):
+        bucket = self.buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.buckets[chat_id] = TokenBucket(*self.chat_limits(chat_id))
+        return bucket
+
+    def push(self, job, now):
+        job.seq = next(self.seq)
+        jobs = self.chats.setdefault(job.chat_id, deque())
+        jobs.append(job)
+        if len(jobs) == 1 and job.chat_id not in self.busy:
+            self.schedule(job.chat_id, now)
+
+    def schedule(self, chat_id, now):
+        head = self.chats[chat_id][0]
+        wait = self.bucket(chat_id).delay(now, head.cost)
+        if wait > 0:
+            heapq.heappush(self.delayed, (now + wait, head.seq, chat_id))
+        else:
+            heapq.heappush(self.ready, (head.priority, head.seq, chat_id))
+
+    def is_current(self, chat_id, seq):
+        # heap entries aren't removed when a chat gets busy or its first job changes, they're skipped here
+        jobs = self.chats.get(chat_id)
+        return chat_id not in self.busy and bool(jobs) and jobs[0].seq == seq
+
+    def pop(self, now):
+        """(job, 0) for the job to send now, or (None, seconds to wait). Seconds are None if there's nothing queued"""
+        if now - self.last_sweep >= self.sweep_interval:
+            self.sweep(now)
+        while self.delayed and self.delayed[0][0] <= now:
+            _, seq, chat_id = heapq.heappop(self.delayed)
+            if self.is_current(chat_id, seq):
+                self.schedule(chat_id, now)
+        while self.ready and not self.is_current(self.ready[0][2], self.ready[0][1]):
+            heapq.heappop(self.ready)
+        if not self.ready:
+            return None, (self.delayed[0][0] - now if self.delayed else None)
+        chat_id = self.ready[0][2]
+        jobs = self.chats[chat_id]
+        wait = self.global_bucket.delay(now, jobs[0].cost)
+        if wait > 0:
+            return None, wait
+        heapq.heappop(self.ready)
+        job = jobs.popleft()
+        self.merge(job, jobs)
+        self.global_bucket.take(now, job.cost)
+        self.bucket(chat_id).take(now, job.cost)
+        self.busy.add(chat_id)
+        self.stats.record(now - job.queued)
+        return job, 0
+
+    def merge(self, job, jobs):
+        """fold plain texts queued right after job into it. The last text may carry a keyboard"""
+        while jobs and job.is_plain_text():
+            following = jobs[0]
+            if following.text_arg != job.text_arg or following.fn != job.fn or following.args != job.args or \
+                    not set(following.kwargs) - {following.text_arg} <= self.merge_kwargs:
+                return
+            text = f"{job.kwargs[job.text_arg]}\n\n{following.kwargs[following.text_arg]}"
+            if len(text) > self.max_text_length:
+                return
+            jobs.popleft()
+            job.kwargs = dict(following.kwargs, **{job.text_arg: text})
+            job.priority = min(job.priority, following.priority)
+            job.futures.extend(following.futures)
+            self.stats.merged += 1
+
+    def done(self, job, now):
+        chat_id = job.chat_id
+        self.busy.discard(chat_id)
+        if self.chats.get(chat_id):
+            self.schedule(chat_id, now)
+            return
+        self.chats.pop(chat_id, None)
+
+    def discard(self, chat_id):
+        """drop jobs of the chat that are still waiting and return them. A job in flight goes on"""
+        return list(self.chats.pop(chat_id, ()))
+
+    def sweep(self, now):
+        """a refilled bucket is the same as no bucket, don't keep one for every chat we've ever talked to"""
+        self.last_sweep = now
+        for chat_id in [c for c, bucket in self.buckets.items() if c not in self.chats and bucket.idle(now)]:
+            del self.buckets[chat_id]
+
+    def retry(self, job, delay, now):
+        """put job back in front of its chat after 429. The chat gets no tokens for delay seconds"""
+        job.attempts += 1
+        self.stats.throttled += 1
+        self.bucket(job.chat_id).block(now, delay)
+        self.busy.discard(job.chat_id)
+        self.chats.setdefault(job.chat_id, deque()).appendleft(job)
+        self.schedule(job.chat_id, now)
+
+
+def telegram_chat_limits(chat_id):
+    # private chats have positive ids, groups and channels negative ones
+    return TELEGRAM_LIMITS["private"] if chat_id > 0 else TELEGRAM_LIMITS["group"]
+
+
+def telegram_send_queue(share=1):
+    """share: part of the global limit this process may use. Each of N worker processes gets 1/N, chats are split
+    between workers, so chat limits stay as they are"""
+    rate, burst = TELEGRAM_LIMITS["global"]
+    return SendQueue((rate * share, max(1, burst * share)), telegram_chat_limits, TELEGRAM_TEXT_LIMIT,
+                     merge_kwargs=("reply_markup",))
+
+
+def discord_reactions_key(channel_id):
+    """queue key for reactions in the channel. They're paced separately from messages"""
+    return channel_id, "reactions"
+
+
+def discord_chat_limits(key):
+    return DISCORD_LIMITS["reactions"] if isinstance(key, tuple) else DISCORD_LIMITS["channel"]
+
+
+def discord_send_queue():
+    return SendQueue(DISCORD_LIMITS["global"], discord_chat_limits, DISCORD_TEXT_LIMIT)
+
+
+def telegram_retry_after(exc):
+    """seconds Telegram asked to wait, None if exc isn't a 429 (telebot ApiTelegramException)"""
+    if getattr(exc, "error_code", None) == 429:
+        return exc.result_json.get("parameters", {}).get("retry_after", 1)
+    return None
+
+
+def discord_retry_after(exc):
+    """same for discord.HTTPException. discord.py retries 429s itself, this is for the ones it gave up on"""
+    if getattr(exc, "status", None) == 429:
+        return float(exc.response.headers.get("Retry-After", 1))
+    return None
+
+
+class SendScheduler:
+    """SendQueue served by a pool of sender threads, for blocking clients (telebot). submit() returns a
+    concurrent.futures.Future right away, so handlers don't wait for the network unless they need the result"""
+    def __init__(self, send_queue, logger, workers=8, retry_after=None, max_attempts=3, report_interval=300):
+        self.queue = send_queue
+        self.logger = logger
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.report_interval = report_interval  # seconds between stats lines in the log
+        self.last_report = time.monotonic()
+        self.cond = threading.Condition()
+        self.threads = [threading.Thread(target=self.work, name=f"sender_{i}", daemon=True) for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, chat_id, fn, *args, priority=NORMAL, cost=1, text_arg=None, **kwargs):
+        future = Future()
+        job = SendJob(chat_id, fn, args, kwargs, priority, cost, text_arg, future)
+        with self.cond:
+            self.queue.push(job, time.monotonic())
+            self.cond.notify()
+        return future
+
+    def call(self, chat_id, fn, *args, **kwargs):
+        """submit and wait for the result"""
+        return self.submit(chat_id, fn, *args, **kwargs).result()
+
+    def work(self):
+        while True:
+            with self.cond:
+                job, wait = self.queue.pop(time.monotonic())
+                while job is None:
+                    self.cond.wait(wait)
+                    job, wait = self.queue.pop(time.monotonic())
+                self.report()
+            self.execute(job)
+
+    def execute(self, job):
+        try:
+            result = job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            delay = self.retry_after(e) if self.retry_after else None
+            with self.cond:
+                if delay is not None and job.attempts < self.max_attempts:
+                    self.logger.warning("429 for chat %s, retrying in %s s", job.chat_id, delay,
+                                        extra={"chat_id": job.chat_id})
+                    self.queue.retry(job, delay, time.monotonic())
+                    self.cond.notify()
+                    return
+                self.queue.stats.failed += 1
+                self.queue.done(job, time.monotonic())
+                self.cond.notify()
+            self.logger.exception("Failed to send to chat %s", job.chat_id, extra={"chat_id": job.chat_id})
+            for future in job.futures:
+                future.set_exception(e)
+            return
+        with self.cond:
+            self.queue.done(job, time.monotonic())
+            self.cond.notify()
+        for future in job.futures:
+            future.set_result(result)
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.logger.info("send queue: %s waiting, %s", len(self.queue), self.queue.stats.summary())
+
+
+class AsyncSendScheduler:
+    """SendQueue served by sender tasks on the event loop, for coroutine clients (discord.py). Sender tasks start
+    with the first submit"""
+    def __init__(self, send_queue, logger, workers=8, retry_after=None, max_attempts=3, report_interval=300):
+        self.queue = send_queue
+        self.logger = logger
+        self.workers = workers
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.report_interval = report_interval
+        self.last_report = time.monotonic()
+        self.wakeup = None
+        self.tasks = []
+
+    def submit(self, chat_id, fn, *args, priority=NORMAL, cost=1, text_arg=None, **kwargs):
+        """queue coroutine function call. Returns asyncio future: await it for the result or leave it be"""
+        if not self.tasks:
+            self.wakeup = asyncio.Event()
+            self.tasks = [asyncio.ensure_future(self.work()) for _ in range(self.workers)]
+        future = asyncio.get_event_loop().create_future()
+        # failures are logged by the scheduler, nobody has to retrieve them from futures nobody awaits
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self.queue.push(SendJob(chat_id, fn, args, kwargs, priority, cost, text_arg, future), time.monotonic())
+        self.wakeup.set()
+        return future
+
+    async def call(self, chat_id, fn, *args, **kwargs):
+        return await self.submit(chat_id, fn, *args, **kwargs)
+
+    def cancel(self, chat_id):
+        """drop queued jobs of the chat, their futures are cancelled"""
+        jobs = self.queue.discard(chat_id)
+        for job in jobs:
+            for future in job.futures:
+                future.cancel()
+        return len(jobs)
+
+    async def work(self):
+        while True:
+            job, wait = self.queue.pop(time.monotonic())
+            if job is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.report()
+            await self.execute(job)
+
+    async def execute(self, job):
+        try:
+            result = await job.fn(*job.args, **job.kwargs)
+        except Exception as e:
+            delay = self.retry_after(e) if self.retry_after else None
+            if delay is not None and job.attempts < self.max_attempts:
+                self.logger.warning("429 for chat %s, retrying in %s s", job.chat_id, delay,
+                                    extra={"chat_id": job.chat_id})
+                self.queue.retry(job, delay, time.monotonic())
+                self.wakeup.set()
+                return
+            self.queue.stats.failed += 1
+            self.queue.done(job, time.monotonic())
+            self.wakeup.set()
+            self.logger.exception("Failed to send to chat %s", job.chat_id, extra={"chat_id": job.chat_id})
+            for future in job.futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        self.queue.done(job, time.monotonic())
+        self.wakeup.set()
+        for future in job.futures:
+            if not future.done():
+                future.set_result(result)
+
+    def report(self):
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            self.logger.info("send queue: %s waiting, %s", len(self.queue), self.queue.stats.summary())
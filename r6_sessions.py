@@ -0,0 +1,359 @@
+import json
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+"""Quiz sessions stored outside of bot process, so a quiz survives bot restart and any worker can continue it.
+In-process conversation state (memory backend, telebot next step handlers) is bounded: chats that walked away are
+dropped after a while, and the oldest idle ones go first when there are too many"""
+
+
+class QuizSession:
+    """Progress of one quiz in one chat. Serialised into a compact json array, not a dict, to keep keys out of
+    every stored session"""
+    version = 1
+
+    def __init__(self, chat_id, map_name, questions, correct_answer=None, score=0, asked=0, started=None,
+                 updated=None, correct_option=None):
+        self.chat_id = chat_id
+        self.map_name = map_name
+        self.questions = questions  # questions left. First option of every question is the correct answer
+        self.correct_answer = correct_answer  # answer for the question user sees right now. None if not asked yet
+        self.score = score  # correct answers so far
+        self.asked = asked  # questions asked so far
+        self.started = started or time.time()
+        self.updated = updated or self.started
+        # inline keyboard quiz only: index of the correct answer among the buttons. None for reply keyboard quizzes
+        self.correct_option = correct_option
+
+    def encode(self):
+        return json.dumps([self.version, self.chat_id, self.map_name, self.questions, self.correct_answer,
+                           self.score, self.asked, round(self.started, 1), round(self.updated, 1),
+                           self.correct_option],
+                          separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+    @classmethod
+    def decode(cls, data):
+        version, *fields = json.loads(data)
+        if version != cls.version:
+            raise ValueError(f"unsupported quiz session version {version}")
+        return cls(*fields)
+
+
+class ExpiringDict:
+    """dict with TTL counted from the last write and a size cap. Keys are kept in write order, so the oldest idle ones
+    are at the front: expired keys are swept from there, and that's where the cap evicts. Evicted keys are remembered
+    (bounded the same way) for remember_for seconds, so a chat coming back can be told its conversation expired.
+    Thread safe"""
+    def __init__(self, ttl, max_size, remember_for=24 * 3600):
+        self.ttl = ttl  # seconds
+        self.max_size = max_size
+        self.remember_for = remember_for
+        self.items = OrderedDict()  # key: (expires at, value), least recently written first
+        self.evicted = OrderedDict()  # key: when it was evicted
+        self.lock = threading.RLock()
+        self.evicted_ttl = 0
+        self.evicted_lru = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.items.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= now:
+                self.evict(key, now)
+                self.evicted_ttl += 1
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        now = time.monotonic()
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (now + self.ttl, value)
+            self.evicted.pop(key, None)
+            self.sweep(now)
+
+    def pop(self, key, default=None):
+        with self.lock:
+            value = self.get(key, default)
+            self.items.pop(key, None)
+            return value
+
+    def evict(self, key, now):
+        del self.items[key]
+        self.evicted[key] = now
+
+    def sweep(self, now):
+        """O(evicted keys): everything past the first live key is younger"""
+        while self.items:
+            key, (expires, _) = next(iter(self.items.items()))
+            if expires <= now:
+                self.evicted_ttl += 1
+            elif len(self.items) > self.max_size:
+                self.evicted_lru += 1
+            else:
+                break
+            self.evict(key, now)
+        while self.evicted and (len(self.evicted) > self.max_size or
+                                next(iter(self.evicted.values())) < now - self.remember_for):
+            self.evicted.popitem(last=False)
+
+    def expired(self, key):
+        """True once if key was evicted since it was last written"""
+        with self.lock:
+            return self.evicted.pop(key, None) is not None
+
+    def stats(self):
+        with self.lock:
+            return {"live": len(self.items), "evicted_ttl": self.evicted_ttl, "evicted_lru": self.evicted_lru}
+
+
+class ExpiringHandlerBackend:
+    """telebot next_step_backend (register_handler, clear_handlers, get_handlers) on top of ExpiringDict. The stock
+    MemoryHandlerBackend keeps handlers, and everything bound to them, of every chat that never sent the next message.
+    get_handlers runs for every incoming message, so expired entries are dropped as a side effect of normal traffic"""
+    def __init__(self, ttl=3600, max_chats=10000):
+        self.handlers = ExpiringDict(ttl, max_chats)
+
+    def register_handler(self, handler_group_id, handler):
+        with self.handlers.lock:
+            handlers = self.handlers.pop(handler_group_id) or []
+            handlers.append(handler)
+            self.handlers.set(handler_group_id, handlers)
+
+    def clear_handlers(self, handler_group_id):
+        self.handlers.pop(handler_group_id)
+
+    def get_handlers(self, handler_group_id):
+        return self.handlers.pop(handler_group_id) or []
+
+    def expired(self, chat_id):
+        return self.handlers.expired(chat_id)
+
+    def stats(self):
+        return self.handlers.stats()
+
+
+class MemorySessionBackend:
+    """in-process ExpiringDict. Sessions die with the process, abandoned ones after ttl seconds"""
+    def __init__(self, ttl=24 * 3600, max_sessions=100000):
+        self.data = ExpiringDict(ttl, max_sessions)
+
+    def get(self, chat_id):
+        return self.data.get(chat_id)
+
+    def set(self, chat_id, value):
+        self.data.set(chat_id, value)
+
+    def delete(self, chat_id):
+        self.data.pop(chat_id)
+
+    def count(self):
+        return len(self.data)
+
+    def expired(self, chat_id):
+        return self.data.expired(chat_id)
+
+
+class SqliteSessionBackend:
+    """SQLite file in WAL mode. Good enough for several processes on the same host. Works like MemorySessionBackend:
+    sessions idle for ttl seconds expire, the oldest idle ones go first over max_sessions, and expired chats are
+    remembered for remember_for seconds. Writes sweep the table at most once per sweep_interval seconds, so the cap can
+    be passed by the sessions started in between"""
+    def __init__(self, db_file, ttl=24 * 3600, max_sessions=100000, remember_for=24 * 3600, sweep_interval=10):
+        self.db_file = db_file
+        self.ttl = ttl  # seconds
+        self.max_sessions = max_sessions
+        self.remember_for = remember_for
+        self.sweep_interval = sweep_interval
+        self.last_sweep = 0
+        self.local = threading.local()  # sqlite connections can't be shared between threads
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS sessions (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL, "
+                         "updated REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)")
+            conn.execute("CREATE TABLE IF NOT EXISTS expired_sessions (chat_id INTEGER PRIMARY KEY, "
+                         "expired REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS expired_sessions_expired ON expired_sessions (expired)")
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_file, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    def get(self, chat_id):
+        conn = self.connection()
+        row = conn.execute("SELECT data, updated FROM sessions WHERE chat_id = ?", (chat_id,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if row[1] < now - self.ttl:  # not swept yet
+            with conn:
+                self.expire(conn, "chat_id = ? AND updated < ?", (chat_id, now - self.ttl), now)
+            return None
+        return row[0]
+
+    def set(self, chat_id, value):
+        now = time.time()
+        with self.connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO sessions (chat_id, data, updated) VALUES (?, ?, ?)",
+                         (chat_id, value, now))
+            conn.execute("DELETE FROM expired_sessions WHERE chat_id = ?", (chat_id,))
+            if now - self.last_sweep > self.sweep_interval:
+                self.sweep(conn, now)
+
+    def delete(self, chat_id):
+        with self.connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE chat_id = ?", (chat_id,))
+
+    def count(self):
+        return self.connection().execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+
+    def expire(self, conn, condition, params, now):
+        """move sessions matching condition to expired_sessions. Call inside a transaction"""
+        conn.execute(f"INSERT OR REPLACE INTO expired_sessions (chat_id, expired) SELECT chat_id, ? FROM sessions "
+                     f"WHERE {condition}", (now, *params))
+        conn.execute(f"DELETE FROM sessions WHERE {condition}", params)
+
+    def sweep(self, conn, now):
+        """expire idle sessions and the oldest ones over the cap, forget chats expired long ago"""
+        self.last_sweep = now
+        self.expire(conn, "updated < ?", (now - self.ttl,), now)
+        over = conn.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+        if over > 0:
+            self.expire(conn, "chat_id IN (SELECT chat_id FROM sessions ORDER BY updated LIMIT ?)", (over,), now)
+        conn.execute("DELETE FROM expired_sessions WHERE expired < ?", (now - self.remember_for,))
+        over = conn.execute("SELECT COUNT(*) FROM expired_sessions").fetchone()[0] - self.max_sessions
+        if over > 0:
+            conn.execute("DELETE FROM expired_sessions WHERE chat_id IN "
+                         "(SELECT chat_id FROM expired_sessions ORDER BY expired LIMIT ?)", (over,))
+
+    def expired(self, chat_id):
+        """True once if the chat's session expired since it was last written"""
+        conn = self.connection()
+        if conn.execute("SELECT 1 FROM expired_sessions WHERE chat_id = ?", (chat_id,)).fetchone() is None:
+            return False  # the common case stays a read
+        with conn:
+            return conn.execute("DELETE FROM expired_sessions WHERE chat_id = ?", (chat_id,)).rowcount == 1
+
+
+class RedisSessionBackend:
+    """Any server speaking Redis protocol (redis, keydb, a local stand-in). Talks RESP over a plain socket, so there's
+    no extra dependency. Sessions expire after ttl seconds of inactivity"""
+    def __init__(self, host="127.0.0.1", port=6379, prefix="r6:quiz:", ttl=24 * 3600):
+        self.address = (host, port)
+        self.prefix = prefix
+        self.ttl = ttl
+        self.local = threading.local()  # one connection per handler thread
+
+    def connection(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = socket.create_connection(self.address, timeout=5)
+            self.local.conn = conn
+            self.local.reader = conn.makefile("rb")
+        return conn
+
+    def command(self, *args):
+        payload = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            payload.append(f"${len(arg)}\r\n".encode() + arg + b"\r\n")
+        try:
+            self.connection().sendall(b"".join(payload))
+            return self.read_reply()
+        except OSError:
+            self.disconnect()  # reconnect on the next command
+            raise
+
+    def disconnect(self):
+        for stream in (getattr(self.local, "reader", None), getattr(self.local, "conn", None)):
+            if stream is not None:
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self.local.conn = None
+        self.local.reader = None
+
+    def read_reply(self):
+        line = self.local.reader.readline()
+        if not line:
+            raise ConnectionError("server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind in (b"+", b":"):
+            return rest
+        if kind == b"-":
+            raise RuntimeError(rest.decode())
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self.local.reader.read(length + 2)[:-2]
+        raise RuntimeError(f"unexpected reply {line!r}")
+
+    def get(self, chat_id):
+        return self.command("GET", f"{self.prefix}{chat_id}")
+
+    def set(self, chat_id, value):
+        self.command("SET", f"{self.prefix}{chat_id}", value, "EX", self.ttl)
+
+    def delete(self, chat_id):
+        self.command("DEL", f"{self.prefix}{chat_id}")
+
+
+class SessionStore:
+    """QuizSession <-> backend. Broken or outdated records are treated as no session at all"""
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, chat_id):
+        data = self.backend.get(chat_id)
+        if data is None:
+            return None
+        try:
+            return QuizSession.decode(data)
+        except (ValueError, TypeError):
+            self.backend.delete(chat_id)
+            return None
+
+    def save(self, session):
+        session.updated = time.time()
+        self.backend.set(session.chat_id, session.encode())
+
+    def delete(self, chat_id):
+        self.backend.delete(chat_id)
+
+    def expired(self, chat_id):
+        """True once if the chat's session was dropped for inactivity. Redis can't tell"""
+        expired = getattr(self.backend, "expired", None)
+        return bool(expired and expired(chat_id))
+
+    def count(self):
+        """stored sessions, None if the backend can't tell (redis keys share the db with everything else)"""
+        count = getattr(self.backend, "count", None)
+        return count() if count else None
+
+
+def session_store_from_cfg(cfg):
+    """build SessionStore from {"BACKEND": "memory" | "sqlite" | "redis", ...} config section"""
+    backend = cfg.get("BACKEND", "memory")
+    ttl = cfg.get("TTL", 24 * 3600)
+    if backend == "sqlite":
+        return SessionStore(SqliteSessionBackend(cfg.get("PATH", "files/tg_sessions.db"), ttl,
+                                                 cfg.get("MAX_SESSIONS", 100000)))
+    if backend == "redis":
+        return SessionStore(RedisSessionBackend(cfg.get("HOST", "127.0.0.1"), cfg.get("PORT", 6379), ttl=ttl))
+    return SessionStore(MemorySessionBackend(ttl, cfg.get("MAX_SESSIONS", 100000)))
@@ -0,0 +1,57 @@
+import marshal
+import mmap
+import struct
+from os import replace, stat
+
+
+"""Binary snapshot of prebuilt content (see tools/build_snapshot.py). A fixed header followed by one marshal payload,
+read through mmap: loading is a single C-level unmarshal, no json parsing and no directory walks"""
+
+SNAPSHOT_FILE = "files/content.snapshot"
+SNAPSHOT_MAGIC = b"R6SNAP"
+SNAPSHOT_VERSION = 1  # bump whenever payload layout changes
+HEADER = struct.Struct("<6sHHQ")  # magic, snapshot version, marshal version, payload size
+
+
+def stat_entry(file, with_size=True):
+    """(path, mtime, size) of a file or (path, mtime, None) of a folder. (path, None, None) if it's gone"""
+    try:
+        st = stat(file)
+    except FileNotFoundError:
+        return file, None, None
+    return file, st.st_mtime_ns, st.st_size if with_size else None
+
+
+def sources_unchanged(fingerprint):
+    """re-stat exactly the paths recorded at build time. Adding or removing a picture changes mtime of its folder,
+    so this catches everything a full rescan would, at the cost of a few dozen stat calls"""
+    for file, mtime, size in fingerprint:
+        if stat_entry(file, with_size=size is not None or mtime is None)[1:] != (mtime, size):
+            return False
+    return True
+
+
+def write_snapshot(snapshot_file, payload):
+    data = marshal.dumps(payload)
+    tmp_file = f"{snapshot_file}.tmp"
+    with open(tmp_file, "wb") as of:
+        of.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, marshal.version, len(data)))
+        of.write(data)
+    replace(tmp_file, snapshot_file)  # bots never see a half written snapshot
+    return HEADER.size + len(data)
+
+
+def read_snapshot(snapshot_file):
+    """payload dict or None if there's no snapshot or it was written by another snapshot/marshal version"""
+    try:
+        with open(snapshot_file, "rb") as of, mmap.mmap(of.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER.size:
+                return None
+            magic, version, marshal_version, size = HEADER.unpack_from(mm)
+            if (magic, version, marshal_version) != (SNAPSHOT_MAGIC, SNAPSHOT_VERSION, marshal.version) or \
+                    len(mm) != HEADER.size + size:
+                return None
+            with memoryview(mm) as view, view[HEADER.size:] as data:
+                return marshal.loads(data)
+    except (FileNotFoundError, ValueError, EOFError, TypeError):
+        return None
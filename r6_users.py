@@ -0,0 +1,125 @@
+import atexit
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+
+"""Registry of bot users: who they are, when we saw them first and last, how many quizzes they've played"""
+
+
+class UserRegistry:
+    """SQLite (WAL mode) backed user registry. Membership check is answered from in-memory set of ids, all writes are
+    queued and applied in batches by a background thread, so handlers never wait for the disk"""
+    def __init__(self, db_file, legacy_file=None, flush_interval=2, max_batch=500, max_attempts=3, logger=None):
+        self.db_file = db_file
+        self.flush_interval = flush_interval  # seconds. Max delay before queued writes hit the disk
+        self.max_batch = max_batch
+        self.max_attempts = max_attempts  # per batch
+        self.logger = logger
+        self.writes = queue.Queue()
+        conn = self.connect()
+        conn.execute("CREATE TABLE IF NOT EXISTS users (chat_id INTEGER PRIMARY KEY, username TEXT, "
+                     "first_seen REAL NOT NULL, last_seen REAL NOT NULL, quiz_count INTEGER NOT NULL DEFAULT 0)")
+        self.ids = {row[0] for row in conn.execute("SELECT chat_id FROM users")}
+        if legacy_file and not self.ids:
+            self.import_legacy(conn, legacy_file)
+        conn.close()
+        self.writer = threading.Thread(target=self.write_loop, name="user_registry", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_file)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")  # WAL keeps db consistent on crash, only last batch may be lost
+        return conn
+
+    def import_legacy(self, conn, legacy_file):
+        """move users from old {chat_id: username} json file. Time of the first visit is unknown there"""
+        try:
+            with open(legacy_file, "r") as of:
+                legacy_users = json.load(of)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+        now = time.time()
+        with conn:
+            conn.executemany("INSERT OR IGNORE INTO users (chat_id, username, first_seen, last_seen) "
+                             "VALUES (?, ?, ?, ?)", [(int(k), v, now, now) for k, v in legacy_users.items()])
+        self.ids.update(int(k) for k in legacy_users)
+
+    def __contains__(self, chat_id):
+        return int(chat_id) in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def seen(self, chat_id, username=None):
+        """register user activity. Returns True if that's a new user"""
+        chat_id = int(chat_id)
+        is_new = chat_id not in self.ids
+        self.ids.add(chat_id)
+        self.writes.put(("seen", chat_id, username, time.time()))
+        return is_new
+
+    def quiz_started(self, chat_id):
+        self.writes.put(("quiz", int(chat_id), None, time.time()))
+
+    def write_loop(self):
+        conn = self.connect()
+        while True:
+            batch = [self.writes.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # collect whatever comes in during flush_interval into one transaction
+            while len(batch) < self.max_batch and batch[-1] is not None:
+                try:
+                    batch.append(self.writes.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is None
+            self.write(conn, [w for w in batch if w is not None])
+            if stop:
+                conn.close()
+                return
+
+    def write(self, conn, batch):
+        """apply the batch. A locked database (another process writing the same file) usually passes, so it's retried
+        a few times. A batch that still fails is dropped: the writer thread has to survive it"""
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.apply(conn, batch)
+                return
+            except Exception:
+                if self.logger:
+                    self.logger.exception("Failed to write %s user updates, attempt %s of %s", len(batch), attempt,
+                                          self.max_attempts)
+            if attempt < self.max_attempts:
+                time.sleep(self.flush_interval)
+        if self.logger:
+            self.logger.error("Dropped %s user updates", len(batch))
+
+    @staticmethod
+    def apply(conn, batch):
+        seen = {}  # chat_id: (username, timestamp). Only the latest visit matters
+        quizzes = {}  # chat_id: (quizzes started, timestamp)
+        for kind, chat_id, username, ts in batch:
+            if kind == "seen":
+                seen[chat_id] = (username or seen.get(chat_id, (None,))[0], ts)
+            else:
+                quizzes[chat_id] = (quizzes.get(chat_id, (0,))[0] + 1, ts)
+        with conn:
+            conn.executemany("INSERT INTO users (chat_id, username, first_seen, last_seen) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT(chat_id) DO UPDATE SET last_seen = excluded.last_seen, "
+                             "username = COALESCE(excluded.username, username)",
+                             [(chat_id, username, ts, ts) for chat_id, (username, ts) in seen.items()])
+            conn.executemany("INSERT INTO users (chat_id, first_seen, last_seen, quiz_count) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT(chat_id) DO UPDATE SET last_seen = excluded.last_seen, "
+                             "quiz_count = quiz_count + excluded.quiz_count",
+                             [(chat_id, ts, ts, count) for chat_id, (count, ts) in quizzes.items()])
+
+    def close(self):
+        """flush queued writes and stop the writer"""
+        if self.writer.is_alive():
+            self.writes.put(None)
+            self.writer.join()
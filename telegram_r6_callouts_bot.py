@@ -1,10 +1,24 @@
 import telebot
 import random
+import time
 import json
-import logging
-from logging.handlers import RotatingFileHandler
+import os
+from os import path
+from r6_logging import setup_logging
 from telebot import types
-from os import walk, path
+from r6_media import MediaCache
+from r6_catalog import CatalogLoader, CatalogWatcher, log_problems
+from r6_users import UserRegistry
+from r6_mastery import MasteryStore
+from r6_leaderboard import Leaderboard, GLOBAL, format_top
+from r6_metrics import metrics_from_cfg, BYTES_BUCKETS
+from r6_sessions import QuizSession, ExpiringHandlerBackend, session_store_from_cfg
+from tg_runners import AsyncPollingRunner, WebhookRunner, PartitionedRunner, PollingTeleBot
+from r6_scheduler import SendScheduler, telegram_send_queue, telegram_retry_after, URGENT, NORMAL, BULK
+try:
+    import PIL.Image  # noqa: F401 telebot checks every upload with PIL.Image but only imports PIL itself
+except ImportError:
+    pass
 
 
 """Telegram bot to learn Rainbow Six Siege maps callouts"""
@@ -17,40 +31,58 @@ __version__ = "0.2"
 log_file = "files/log/r6_callouts_bot.log"
 max_log_file_size = 10  # max log file size in MB
 max_log_files = 5
-logger = logging.getLogger('r6_callouts')
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s -  %(levelname)s - %(message)s', datefmt='%d.%m.%Y %H:%M:%S')
-handler = logging.handlers.RotatingFileHandler(log_file, mode='a', maxBytes=max_log_file_size*1024*1024,
-                                               backupCount=max_log_files, encoding='utf-8', delay=False)
-handler.setFormatter(formatter)
-logger.addHandler(handler)
+log_json_lines = False  # one json object per line instead of plain text
+log_chat_rate = 1  # records per second a single chat can log at INFO and below, after a burst of log_chat_burst
+log_chat_burst = 20
+config_file = "files/tg_config.txt"
+logger = setup_logging('r6_callouts', log_file, max_log_file_size, max_log_files, json_lines=log_json_lines,
+                       chat_rate=log_chat_rate, chat_burst=log_chat_burst)
 
 
 class R6CalloutsBot:
-    def __init__(self):
-        self.config_file = "files/tg_config.txt"
+    def __init__(self, worker=None):
+        self.worker = worker  # index of the worker process in "workers" run mode, None for the process that polls
+        self.config_file = config_file
         self.users_file = "files/tg_users.txt"
+        self.users_db = "files/tg_users.db"
+        self.mastery_db = "files/tg_mastery.db"
+        self.leaderboard_db = "files/tg_leaderboard.db"
         self.quiz_file = "files/quiz.txt"
-        with open(self.config_file, "r") as of:  # no handling here. Let  it crash if there's a problem with cfg
-            self.cfg = json.load(of)
-        try:
-            with open(self.users_file, "r") as of:
-                self.users = json.load(of)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.users = {}
-        try:
-            with open(self.quiz_file, "r") as of:
-                self.quiz_separate_data = json.load(of)
-        except (FileNotFoundError, json.decoder.JSONDecodeError):
-            self.users = {}
+        self.quiz_dir = "files/quiz"
+        self.maps_dir = "files/maps"
+        self.file_ids_file = "files/tg_file_ids.txt"
+        self.cfg = load_cfg(self.config_file)
+        # old users file is imported into the registry once
+        self.users = UserRegistry(self.users_db, legacy_file=self.users_file, logger=logger)
+        # telegram file_id for every picture we've uploaded. Lets us send pictures without uploading them again
+        self.file_ids = MediaCache(self.file_ids_file)
+        # which downscaled copy of pictures to send (see tools/build_variants.py). Telegram shrinks photos to 1280px
+        self.picture_tier = "jpeg"
+        self.max_album_size = 10  # telegram limit for sendMediaGroup
         self.commands = None
         self.main_sticker_pull = None
         self.b_back_to_main_menu = None
         self.token = None
+        self.run_mode = None
+        self.max_concurrent_updates = None
+        self.workers = None
+        self.webhook_cfg = None
+        self.sessions_cfg = None
+        self.send_workers = None
+        self.step_ttl = None
+        self.max_step_chats = None
+        self.metrics_cfg = None
+        self.inline_quiz = None
+        self.adaptive_quiz = None
         self.quiz_questions = None
-        self.b_all_maps = None
         self.b_main_menu = None
         self.all_maps_val = 'all maps!'
+        # quiz content and map buttons. Replaced as a whole when files change
+        self.catalog_loader = CatalogLoader(self.quiz_file, self.quiz_dir, self.maps_dir, self.all_maps_val,
+                                            config_file=self.config_file)
+        self.catalog = None
+        self.catalog_watcher = CatalogWatcher(self.catalog_loader, lambda catalog: setattr(self, "catalog", catalog),
+                                              logger)
         self.quiz_options_amount = 5  # total amount of 'salt' options in a quiz question
         self.quiz_questions_amount = 5  # total amount of questions per quiz
         # default sticker to reply to other stickers. TODO: create a list of related stickers and send random.choice
@@ -58,17 +90,52 @@ class R6CalloutsBot:
 
         self.read_cfg()
 
+        # handler timings, upload sizes, send queue and session counters on a local /metrics endpoint. Off by default
+        # every worker process serves its own, on the next ports
+        self.metrics = metrics_from_cfg(self.metrics_cfg, port_offset=0 if worker is None else worker + 1)
+        self.upload_bytes = self.metrics.histogram("upload_bytes", "Bytes uploaded per picture", ("kind",),
+                                                   buckets=BYTES_BUCKETS)
+        for name in ("view_map_callouts", "quiz", "check_answer", "check_inline_answer", "contact_dev", "send_top",
+                     "upload_photo", "upload_album", "edit_photo"):
+            setattr(self, name, self.metrics.timed(name)(getattr(self, name)))
+
         self.cancel_cmd = '/cancel'
+        self.answer_prefix = 'a:'  # callback data of inline quiz buttons: a:<question number>:<option index>
         self.confirm_cmd = '/done'
         self.help_cmd = '/help'
 
         self.author = '@lavrooshka'
         self.author_chat_id = 264272264
 
-        # initiate bot
-        self.bot = telebot.TeleBot(self.token)
+        # per-user answer stats. Adaptive quizzes ask more of the callouts user gets wrong
+        self.mastery = MasteryStore(self.mastery_db, logger=logger) if self.adaptive_quiz else None
+
+        # global and group chat standings, updated with every answer
+        self.leaderboard = Leaderboard(self.leaderboard_db, logger=logger)
+
+        # running quizzes. Kept outside of the process so they survive restarts and can be shared by workers
+        self.sessions = session_store_from_cfg(self.sessions_cfg)
+
+        # menus and /contact wait for the next message with next step handlers. Chats that walk away are forgotten
+        self.next_steps = ExpiringHandlerBackend(ttl=self.step_ttl, max_chats=self.max_step_chats)
+
+        # initiate bot. Other run modes dispatch updates themselves, so telebot must run handlers right away
+        self.bot = PollingTeleBot(self.token, threaded=self.run_mode == "polling", next_step_backend=self.next_steps)
+        # every outgoing message goes through the send scheduler: rate limits, priorities, merging of plain texts
+        self.sender = SendScheduler(telegram_send_queue(share=1 if worker is None else 1 / self.workers), logger,
+                                    workers=self.send_workers, retry_after=telegram_retry_after)
+        self.metrics.send_stats(self.sender.queue.stats)
+        self.metrics.sampled("send_queue_length", "Sends waiting in the queue", lambda: len(self.sender.queue))
+        self.metrics.sampled("quiz_sessions", "Stored quiz sessions", self.sessions.count)
+        self.metrics.sampled("next_steps", "Chats waiting on a menu or /contact step",
+                             lambda: self.next_steps.stats()["live"])
+        self.metrics.sampled("next_steps_evicted_total", "Next steps dropped for inactivity or over the cap",
+                             lambda: {("ttl",): self.next_steps.stats()["evicted_ttl"],
+                                      ("cap",): self.next_steps.stats()["evicted_lru"]},
+                             kind="counter", labels=("reason",))
 
         @self.bot.message_handler(commands=list(self.commands.keys()))
+        @self.metrics.timed("welcome")
         def welcome(message):
             """command handler. Add new commands here if necessary"""
             if message.text == '/help':
@@ -79,14 +146,27 @@ class R6CalloutsBot:
                 self.cancel_handler(message)
             elif message.text == '/debug':
                 output = "nope :)"
-                self.bot.send_message(message.chat.id, output)
+                self.send_message(message.chat.id, output)
                 # self.debug()
 
         @self.bot.message_handler(content_types=['text'])
+        @self.metrics.timed("replies")
         def replies(message):
             """message handler. Basically, processes 99% of bot activities: requests, special commands, etc."""
             msg_txt = message.text.lower()
-            if msg_txt in self.commands:
+            self.users.seen(message.chat.id, message.chat.username)
+            session = self.sessions.get(message.chat.id)
+            # menu or quiz this message was meant for was dropped for inactivity
+            expired = not session and (self.next_steps.expired(message.chat.id) or
+                                       self.sessions.expired(message.chat.id))
+            if session and session.correct_option is not None:  # inline quiz is waiting for a button press
+                if message.text == self.cancel_cmd:
+                    self.cancel_handler(message)
+                else:
+                    self.reply_to(message, f"Tap one of the options under the picture, or {self.cancel_cmd}")
+            elif session and session.correct_answer:  # quiz is waiting for the answer
+                self.check_answer(message=message, navigation='check', session=session)
+            elif msg_txt in self.commands:
                 if msg_txt == 'view map callouts':
                     self.view_map_callouts(message=message, navigation="map pick")
                 elif msg_txt == 'quiz':
@@ -95,35 +175,44 @@ class R6CalloutsBot:
                     self.send_disclaimer(message=message)
                 elif msg_txt == '/debug':
                     output = "nope :)"
-                    self.bot.send_message(message.chat.id, output)
+                    self.send_message(message.chat.id, output)
                     self.debug(message=message)
                 elif msg_txt == '/start':
-                    if message.chat.id not in self.users:
-                        self.users[message.chat.id] = message.chat.username
-                        # dump into file
-                        with open("files/tg_users.txt", "w") as wf:
-                            json.dump(self.users, wf)
                     output = "Welcome!"
                     self.main_menu(message=message, text=output)
+                elif msg_txt == '/top':
+                    self.send_top(message)
             elif message.text.lower() == 'hi':
-                self.bot.send_message(message.chat.id, 'hello')
+                self.send_message(message.chat.id, 'hello')
             elif msg_txt == '/contact':
                 # self.main_menu(message=message, text="work in progress for now")  # TODO reroute messages to @author
                 self.contact_dev(message=message)
             elif message.text == '/whoami':
                 output = f"name: {message.chat.username}\nchat ID: {message.chat.id}"
-                self.bot.reply_to(message, output)
+                self.reply_to(message, output)
+            elif expired:
+                logger.info("Conversation expired, next steps: %s", self.next_steps.stats(),
+                            extra={"chat_id": message.chat.id})
+                self.main_menu(message=message, text="Sorry, that took a while and I lost track of where we were. "
+                                                     "Let's start over")
             # handle messages that cannot be treated as commands with some preset text
             else:
                 output = "Let's stick to buttons at the botton for now"
                 self.main_menu(message=message, text=output)
 
+        @self.bot.callback_query_handler(func=lambda call: (call.data or '').startswith(self.answer_prefix))
+        @self.metrics.timed("inline_answer")
+        def inline_answer(call):
+            """answer button of inline keyboard quiz"""
+            self.users.seen(call.message.chat.id, call.from_user.username)
+            self.check_inline_answer(call)
+
         # sticker handler. Replies with random sticker from prepared list
         @self.bot.message_handler(content_types=['sticker'])
         def get_sticker_id(message):
             """logs sent sticker ID"""
-            logger.info(f"used sticker: {message.sticker.file_id}")
-            self.bot.send_sticker(message.chat.id, self.default_sticker)
+            logger.info("used sticker: %s", message.sticker.file_id, extra={"chat_id": message.chat.id})
+            self.sender.submit(message.chat.id, self.bot.send_sticker, message.chat.id, self.default_sticker)
             # self.send_sticker(message)
 
     def debug(self, message):
@@ -136,14 +225,26 @@ class R6CalloutsBot:
         self.commands = self.cfg['MAIN']['COMMANDS']
         self.b_back_to_main_menu = self.cfg['BUTTONS']['BACK_TO_MAIN_MENU']
         self.b_main_menu = self.cfg['BUTTONS']['MAIN_MENU']
-        self.b_all_maps = self.cfg['BUTTONS']['ALL_MAPS']
-        maps_buffer = {}
-        for key, val in self.quiz_separate_data.items():
-            for k, v in val.items():
-                maps_buffer[k] = f"{key}/{v}"
-        self.quiz_separate_data[self.all_maps_val] = maps_buffer
+        self.catalog = self.catalog_loader()
+        log_problems(logger, self.catalog)
         # telegram bot token. Is used to connect to tg API
         self.token = self.cfg['MAIN']['TOKEN']
+        # "polling": telebot's infinity_polling. "async": asyncio long polling, chats are processed in parallel.
+        # "webhook": same as async, but updates are pushed by Telegram to the built-in HTTP server. Needs WEBHOOK SECRET
+        # "workers": same as async, chats are split between WORKERS processes (0: one per core)
+        self.run_mode = self.cfg['MAIN'].get('RUN_MODE', 'polling')
+        self.max_concurrent_updates = self.cfg['MAIN'].get('MAX_CONCURRENT_UPDATES', 32)
+        self.workers = self.cfg['MAIN'].get('WORKERS') or os.cpu_count()
+        self.webhook_cfg = self.cfg.get('WEBHOOK', {})
+        self.send_workers = self.cfg['MAIN'].get('SEND_WORKERS', 8)
+        # next step handlers (menus, /contact) live this long without an answer. The oldest idle go first over the cap
+        self.step_ttl = self.cfg['MAIN'].get('STEP_TTL', 3600)
+        self.max_step_chats = self.cfg['MAIN'].get('MAX_STEP_CHATS', 10000)
+        # quiz as one message edited in place: photo, question and inline buttons. Reply keyboard quiz otherwise
+        self.inline_quiz = self.cfg['MAIN'].get('INLINE_QUIZ', False)
+        self.adaptive_quiz = self.cfg['MAIN'].get('ADAPTIVE_QUIZ', False)
+        self.sessions_cfg = self.cfg.get('SESSIONS', {})
+        self.metrics_cfg = self.cfg.get('METRICS', {})
 
     def create_markup(self, buttons, width=2, back_to_main_menu=False, cancel_cmd=False, confirm_cmd=False):
         """create markup for provided buttons and width
@@ -174,15 +275,15 @@ class R6CalloutsBot:
     def main_menu(self, message, text="Yes?"):
         """get back to the main menu"""
         markup = self.create_markup(buttons=self.b_main_menu, cancel_cmd=False)
-        self.bot.send_message(message.chat.id, text, reply_markup=markup)
+        self.send_message(message.chat.id, text, reply_markup=markup)
 
     def view_map_callouts(self, message, navigation):
         """provide map schematics with callout names for all available maps"""
         typ = message.content_type
         if typ != 'text':
             output = "let's stick to buttons, ok?"
-            msg = self.bot.reply_to(message=message, text=output)
-            self.bot.register_next_step_handler(msg, self.view_map_callouts, navigation=navigation)
+            self.reply_to(message=message, text=output)
+            self.bot.register_next_step_handler(message, self.view_map_callouts, navigation=navigation)
             return
         name = message.text.upper()
         if name == self.cancel_cmd.upper():
@@ -190,23 +291,18 @@ class R6CalloutsBot:
             return
         if navigation == "map pick":
             output = "Which map?"
-            markup = self.create_markup(buttons=self.b_all_maps, cancel_cmd=True)
-            msg = self.bot.reply_to(message=message, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.view_map_callouts, navigation="send map")
+            markup = self.create_markup(buttons=self.catalog.map_buttons, cancel_cmd=True)
+            self.reply_to(message=message, text=output, reply_markup=markup)
+            self.bot.register_next_step_handler(message, self.view_map_callouts, navigation="send map")
         elif navigation == "send map":
-            pic_path = f"files/maps/{name}"
-            if path.exists(pic_path):
-                # send all related pics
-                for root, dirs, files in walk(pic_path):
-                    for file in files:
-                        if file.endswith('png'):
-                            pic_name = f"{pic_path}/{file}"
-                            with open(pic_name, 'rb') as pic:
-                                self.bot.send_photo(message.chat.id, pic)
+            schematics = self.catalog.schematics.get(name)
+            if schematics:
+                # send all related pics as one album
+                self.send_cached_album(message.chat.id, schematics)
                 self.main_menu(message=message, text="Here you go")
             else:
                 self.main_menu(message=message, text=f"Sorry, no schematics for {name} yet")
-                logger.warning(f"No schematics found for {name}")
+                logger.warning("No schematics found for %s", name, extra={"chat_id": message.chat.id})
 
     def quiz(self, message, navigation, total_questions=None):
         """Send {self.quiz_questions_amount} quiz messages with {self.quiz_options_amount + 1} answer options"""
@@ -214,126 +310,311 @@ class R6CalloutsBot:
         typ = message.content_type
         if typ != 'text':
             output = "let's stick to buttons, ok?"
-            msg = self.bot.reply_to(message=message, text=output)
-            self.bot.register_next_step_handler(msg, self.quiz, navigation=navigation)
+            self.reply_to(message=message, text=output)
+            self.bot.register_next_step_handler(message, self.quiz, navigation=navigation)
             return
         if name == self.cancel_cmd:
             self.cancel_handler(message)
             return
         if navigation == 'map pick':
             output = "Choose a map or play with every map pull"
-            quiz_buttons = list(self.b_all_maps)
+            quiz_buttons = list(self.catalog.map_buttons)
             quiz_buttons.insert(0, self.all_maps_val)
             markup = self.create_markup(buttons=quiz_buttons, cancel_cmd=True)
-            msg = self.bot.reply_to(message=message, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.quiz, navigation='start polling')
+            self.reply_to(message=message, text=output, reply_markup=markup)
+            self.bot.register_next_step_handler(message, self.quiz, navigation='start polling')
         elif navigation == 'start polling':  # map picked
-            try:
-                _ = self.quiz_separate_data[name]
-            except KeyError:
+            if name not in self.catalog.quiz_data:
                 output = f"huh, I cannot find {name} map. Weird, right?\nAnyway, let's try again."
-                logger.warning(f"No map schematics for {name}")
-                quiz_buttons = list(self.b_all_maps)
+                logger.warning("No map schematics for %s", name, extra={"chat_id": message.chat.id})
+                quiz_buttons = list(self.catalog.map_buttons)
                 quiz_buttons.insert(0, self.all_maps_val)
                 markup = self.create_markup(buttons=quiz_buttons, cancel_cmd=True)
-                msg = self.bot.reply_to(message=message, text=output, reply_markup=markup)
-                self.bot.register_next_step_handler(msg, self.quiz, navigation='start polling')
+                self.reply_to(message=message, text=output, reply_markup=markup)
+                self.bot.register_next_step_handler(message, self.quiz, navigation='start polling')
                 return
             if not total_questions:
                 total_questions = self.quiz_questions_amount
             quiz_questions = self.create_list_of_quiz_questions(quiz_length=total_questions, map_name=name,
-                                                                total_options=self.quiz_options_amount)
-            self.quiz_polling(message=message, map_name=name, quiz_questions=quiz_questions)
+                                                                total_options=self.quiz_options_amount,
+                                                                user_id=message.chat.id)
+            self.users.quiz_started(message.chat.id)
+            session = QuizSession(chat_id=message.chat.id, map_name=name, questions=quiz_questions)
+            if self.inline_quiz:
+                self.ask_inline(message.chat.id, session)
+            else:
+                self.quiz_polling(message=message, session=session)
         else:
             self.main_menu(message=message, text="ugh... I'm a bit lost. Let's start again")
-            logger.warning(f"Lost on quiz with name={name}\nnavigation={navigation}")
+            logger.warning("Lost on quiz with name=%s\nnavigation=%s", name, navigation,
+                           extra={"chat_id": message.chat.id})
 
-    def quiz_polling(self, message, map_name, quiz_questions):
+    def quiz_polling(self, message, session):
         """Poll all the quiz questions"""
         name = message.text
         typ = message.content_type
         if typ != 'text':
             output = "let's stick to buttons, ok?"
-            msg = self.bot.reply_to(message=message, text=output)
-            self.bot.register_next_step_handler(msg, self.view_map_callouts)
+            self.reply_to(message=message, text=output)
+            self.bot.register_next_step_handler(message, self.view_map_callouts)
             return
         if name == self.cancel_cmd:
             self.cancel_handler(message)
             return
-        if quiz_questions:
-            self.check_answer(message=message, navigation='ask', quiz_questions=quiz_questions, map_name=map_name)
+        if session.questions:
+            self.check_answer(message=message, navigation='ask', session=session)
         else:
-            output = "Once more?"
+            self.sessions.delete(session.chat_id)
+            output = f"{session.score}/{session.asked} correct. Once more?"
             self.main_menu(message=message, text=output)
 
-    def check_answer(self, message, navigation, quiz_questions, map_name, correct_answer=None):
-        """check the answer for running quiz"""
+    def check_answer(self, message, navigation, session):
+        """check the answer for running quiz. Quiz progress lives in the session store, not in the handler, so
+        the answer can be processed by any worker, even after restart"""
         name = message.text
-        typ = message.content_type
-        if typ != 'text':
-            output = "let's stick to buttons, ok?"
-            msg = self.bot.reply_to(message=message, text=output)
-            self.bot.register_next_step_handler(msg, self.check_answer, navigation=navigation,
-                                                quiz_questions=quiz_questions, map_name=map_name,
-                                                correct_answer=correct_answer)
-            return
         if name == self.cancel_cmd:
             self.cancel_handler(message)
             return
+        map_name = session.map_name
         if navigation == 'ask':
             output = "so, what's the callout?"
-            q = quiz_questions[0]
+            q = session.questions[0]
             correct_answer = q[0]  # always first option
             random.shuffle(q)
             markup = self.create_markup(buttons=q, cancel_cmd=True)
-            pic_name = self.quiz_separate_data[map_name][correct_answer]
+            session.correct_answer = correct_answer
+            session.questions = session.questions[1:]
+            session.asked += 1
+            self.sessions.save(session)
+            # content could be reloaded since the quiz started, so the picture may be gone
+            pic_path = self.catalog.picture_path(map_name, correct_answer)
             try:
-                if map_name == self.all_maps_val:
-                    with open(f"files/quiz/{pic_name}", 'rb') as pic:
-                        self.bot.send_photo(message.chat.id, pic)
-                else:
-                    with open(f"files/quiz/{map_name}/{pic_name}", 'rb') as pic:
-                        self.bot.send_photo(message.chat.id, pic)
+                if not pic_path:
+                    raise FileNotFoundError(correct_answer)
+                # question goes as the picture caption: one message instead of two
+                self.send_cached_photo(message.chat.id, pic_path, priority=URGENT, caption=output, reply_markup=markup)
             except FileNotFoundError:
-                output = f"huh... I couldn't find proper picture for files/quiz/{map_name}/{pic_name}"
-                logger.warning(f"No quiz picture for files/quiz/{map_name}/{pic_name}")
-            msg = self.bot.send_message(message.chat.id, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.check_answer, navigation='check', quiz_questions=quiz_questions,
-                                                map_name=map_name, correct_answer=correct_answer)
+                output = f"huh... I couldn't find proper picture for {map_name}/{correct_answer}"
+                logger.warning("No quiz picture for %s/%s: %s", map_name, correct_answer, pic_path)
+                self.send_message(message.chat.id, text=output, priority=URGENT, reply_markup=markup)
         elif navigation == 'check':
-            if name == correct_answer:  # correct
+            if name == session.correct_answer:  # correct
                 output = "Good job!"
+                parse_mode = None  # plain text can be merged with the quiz summary
+                session.score += 1
             else:  # incorrect answer
-                output = f"Nope! It's called *{correct_answer}*"
-            self.bot.send_message(message.chat.id, text=output, parse_mode="Markdown")
+                output = f"Nope! It's called *{session.correct_answer}*"
+                parse_mode = "Markdown"
+            self.record_answer(session, message.chat, message.from_user, correct=parse_mode is None)
+            session.correct_answer = None
+            self.sessions.save(session)
+            if parse_mode:
+                self.send_message(message.chat.id, text=output, priority=URGENT, parse_mode=parse_mode)
+            else:
+                self.send_message(message.chat.id, text=output, priority=URGENT)
             # continue polling
-            self.quiz_polling(message=message, map_name=map_name, quiz_questions=quiz_questions[1:])
+            self.quiz_polling(message=message, session=session)
 
-    def create_list_of_quiz_questions(self, quiz_length, map_name,  total_options):
-        """composes list of quiz question options. First element is always the correct answer. The're total 1 +
-        self.quiz_options_amount options for each question and total of self.quiz_questions_amount questions per quiz.
-        Each quiz run each question is randomized from the quiz pull (for any chosen map all for all supported maps"""
-        all_questions = []
-        chosen_options = []  # quiz options already picked up by random
-        true_quiz_length = min(quiz_length, len(self.quiz_separate_data[map_name].items()))
-        for _ in range(true_quiz_length):
-            # get random option
+    def next_inline_question(self, session):
+        """move session on to its next question. Returns picture path (None if it's gone), caption and buttons"""
+        q = session.questions[0]
+        correct_answer = q[0]  # always first option
+        random.shuffle(q)
+        session.correct_answer = correct_answer
+        session.correct_option = q.index(correct_answer)
+        session.questions = session.questions[1:]
+        session.asked += 1
+        total = session.asked + len(session.questions)
+        # question number in callback data tells presses on the current question from late or repeated ones
+        data = f"{self.answer_prefix}{session.asked}:"
+        markup = types.InlineKeyboardMarkup(row_width=2)
+        markup.add(*[types.InlineKeyboardButton(option, callback_data=f"{data}{i}") for i, option in enumerate(q)])
+        markup.add(types.InlineKeyboardButton(self.cancel_cmd, callback_data=f"{data}x"))
+        pic_path = self.catalog.picture_path(session.map_name, correct_answer)
+        if not pic_path:
+            logger.warning("No quiz picture for %s/%s", session.map_name, correct_answer)
+        return pic_path, f"{session.asked}/{total}: so, what's the callout?", markup
+
+    def ask_inline(self, chat_id, session, message=None, verdict=None):
+        """ask the next question of inline quiz. With message (the previous question) given, its picture, caption
+        and buttons are replaced in place: one API call per question instead of verdict, picture and keyboard"""
+        pic_path, caption, markup = self.next_inline_question(session)
+        self.sessions.save(session)
+        if verdict:
+            caption = f"{verdict}\n\n{caption}"
+        if pic_path:
+            pic_path = self.catalog.images.variant(pic_path, self.picture_tier)
+        if not pic_path or not path.isfile(pic_path):
+            output = f"huh... I couldn't find proper picture for this one\n\n{caption}"
+            self.send_message(chat_id, text=output, priority=URGENT, parse_mode="Markdown", reply_markup=markup)
+        elif message and message.content_type == 'photo':
+            self.sender.submit(chat_id, self.edit_photo, chat_id, message.message_id, pic_path, caption, markup,
+                               priority=URGENT)
+        else:  # first question, or the previous one had no picture: text messages can't be edited into photos
+            self.send_cached_photo(chat_id, pic_path, priority=URGENT, caption=caption, parse_mode="Markdown",
+                                   reply_markup=markup)
+
+    def check_inline_answer(self, call):
+        """inline quiz button press. The answer is checked against the option index saved in the session"""
+        chat_id = call.message.chat.id
+        question, _, option = call.data[len(self.answer_prefix):].partition(':')
+        session = self.sessions.get(chat_id)
+        if not session or session.correct_option is None or question != str(session.asked):
+            self.answer_callback(chat_id, call, text="This question is over")
+            return
+        self.answer_callback(chat_id, call)
+        if option == 'x':
+            self.sender.submit(chat_id, self.bot.edit_message_reply_markup, chat_id, call.message.message_id,
+                               priority=URGENT)
+            self.cancel_handler(call.message)
+            return
+        correct = option == str(session.correct_option)
+        if correct:
+            verdict = "Good job!"
+            session.score += 1
+        else:
+            verdict = f"Nope! It's called *{session.correct_answer}*"
+        self.record_answer(session, call.message.chat, call.from_user, correct)
+        if session.questions:
+            self.ask_inline(chat_id, session, message=call.message, verdict=verdict)
+            return
+        self.sessions.delete(chat_id)
+        # no reply_markup drops the buttons of the last question
+        output = f"{verdict}\n\n{session.score}/{session.asked} correct"
+        if call.message.content_type == 'photo':
+            self.sender.submit(chat_id, self.bot.edit_message_caption, output, chat_id, call.message.message_id,
+                               priority=URGENT, parse_mode="Markdown")
+        else:
+            self.sender.submit(chat_id, self.bot.edit_message_text, output, chat_id, call.message.message_id,
+                               priority=URGENT, parse_mode="Markdown")
+        self.main_menu(message=call.message, text="Once more?")
+
+    def answer_callback(self, chat_id, call, text=None):
+        """stop the spinner on the pressed button. Doesn't count against message limits, hence no cost"""
+        self.sender.submit(chat_id, self.bot.answer_callback_query, call.id, priority=URGENT, cost=0, text=text)
+
+    def edit_photo(self, chat_id, message_id, pic_path, caption, markup):
+        """replace picture, caption and buttons of a sent message. Reuses telegram file_id like upload_photo does.
+        Runs on a sender thread"""
+        file_id = self.file_ids.get(pic_path)
+        if file_id:
+            try:
+                return self.bot.edit_message_media(types.InputMediaPhoto(file_id, caption=caption,
+                                                                         parse_mode="Markdown"),
+                                                   chat_id, message_id, reply_markup=markup)
+            except telebot.apihelper.ApiException:
+                logger.warning("Telegram refused cached file_id for %s. Uploading it again", pic_path)
+                self.file_ids.drop(pic_path)
+        with open(pic_path, 'rb') as pic:
+            data = pic.read()
+        self.upload_bytes.observe(len(data), "edit")
+        media = types.InputMediaPhoto(data, caption=caption, parse_mode="Markdown")
+        msg = self.bot.edit_message_media(media, chat_id, message_id, reply_markup=markup)
+        self.file_ids.put(pic_path, msg.photo[-1].file_id)
+        return msg
+
+    def record_answer(self, session, chat, user, correct):
+        """leaderboards and mastery stats. Session was saved when the question was asked, so its update time tells
+        how long the user was thinking"""
+        scopes = [GLOBAL] if chat.type == 'private' else [GLOBAL, ("chat", chat.id)]
+        self.leaderboard.record(user.id, scopes, correct, time.time() - session.updated,
+                                name=user.username or user.first_name)
+        if self.mastery:
+            self.mastery.record(session.chat_id, session.map_name, self.catalog.sampler.keys.get(session.map_name),
+                                session.correct_answer, correct)
+
+    def send_message(self, chat_id, text, priority=NORMAL, **kwargs):
+        """bot.send_message through the send scheduler. Returns a future right away. Plain texts queued back to back
+        for the same chat go as one message"""
+        return self.sender.submit(chat_id, self.bot.send_message, chat_id, priority=priority, text_arg="text",
+                                  text=text, **kwargs)
+
+    def reply_to(self, message, text, **kwargs):
+        return self.send_message(message.chat.id, text, reply_to_message_id=message.message_id, **kwargs)
+
+    def send_cached_photo(self, chat_id, pic_path, priority=NORMAL, **kwargs):
+        """queue picture for sending. Raises FileNotFoundError right away if there's no such picture"""
+        pic_path = self.catalog.images.variant(pic_path, self.picture_tier)
+        if not path.isfile(pic_path):
+            raise FileNotFoundError(pic_path)
+        return self.sender.submit(chat_id, self.upload_photo, chat_id, pic_path, priority=priority, **kwargs)
+
+    def upload_photo(self, chat_id, pic_path, **kwargs):
+        """send picture by its telegram file_id if it was uploaded before, upload and remember file_id otherwise.
+        Runs on a sender thread"""
+        file_id = self.file_ids.get(pic_path)
+        if file_id:
             try:
-                correct_answer = random.choice(
-                    [i for i in self.quiz_separate_data[map_name].keys() if i not in chosen_options])
-            except IndexError:
-                return all_questions
-            if correct_answer:
-                quiz_options = [i for i in self.quiz_separate_data[map_name].keys() if i != correct_answer]
-                true_total_options = min(total_options, len(quiz_options))
-                quiz_options = random.sample(quiz_options, true_total_options)
-                # correct answer is always the first element
-                quiz_options.insert(0, correct_answer)
-                chosen_options.append(correct_answer)
-                all_questions.append(quiz_options)
+                return self.bot.send_photo(chat_id, file_id, **kwargs)
+            except telebot.apihelper.ApiException:
+                logger.warning("Telegram refused cached file_id for %s. Uploading it again", pic_path)
+                self.file_ids.drop(pic_path)
+        self.upload_bytes.observe(path.getsize(pic_path), "photo")
+        with open(pic_path, 'rb') as pic:
+            msg = self.bot.send_photo(chat_id, pic, **kwargs)
+        self.file_ids.put(pic_path, msg.photo[-1].file_id)  # the biggest size goes last
+        return msg
+
+    def send_cached_album(self, chat_id, pic_paths):
+        """queue pictures for sending as albums. Schematics are big and nobody's waiting on a timer for them, so they
+        give way to quiz messages of other chats"""
+        pic_paths = [self.catalog.images.variant(p, self.picture_tier) for p in pic_paths]
+        calls = -(-len(pic_paths) // self.max_album_size)
+        return self.sender.submit(chat_id, self.upload_album, chat_id, pic_paths, priority=BULK, cost=calls)
+
+    def upload_album(self, chat_id, pic_paths):
+        """send pictures with as few sendMediaGroup calls as possible, reusing file_ids of previous uploads. Runs on
+        a sender thread"""
+        for i in range(0, len(pic_paths), self.max_album_size):
+            chunk = pic_paths[i:i + self.max_album_size]
+            if len(chunk) == 1:  # albums need at least 2 pictures
+                self.upload_photo(chat_id, chunk[0])
+                continue
+            file_ids = [self.file_ids.get(p) for p in chunk]
+            try:
+                msgs = self.send_album(chat_id, chunk, file_ids)
+            except telebot.apihelper.ApiException:
+                if not any(file_ids):
+                    raise
+                logger.warning("Telegram refused cached file_ids for %s. Uploading them again", chunk)
+                for p in chunk:
+                    self.file_ids.drop(p)
+                file_ids = [None] * len(chunk)
+                msgs = self.send_album(chat_id, chunk, file_ids)
+            for p, file_id, msg in zip(chunk, file_ids, msgs):
+                if not file_id:
+                    self.file_ids.put(p, msg.photo[-1].file_id)
+
+    def send_album(self, chat_id, pic_paths, file_ids):
+        media = []
+        for pic_path, file_id in zip(pic_paths, file_ids):
+            if file_id:
+                media.append(types.InputMediaPhoto(file_id))
             else:
-                pass
-        return all_questions
+                with open(pic_path, 'rb') as pic:
+                    data = pic.read()
+                self.upload_bytes.observe(len(data), "album")
+                media.append(types.InputMediaPhoto(data))
+        return self.bot.send_media_group(chat_id, media)
+
+    def create_list_of_quiz_questions(self, quiz_length, map_name,  total_options, user_id=None):
+        """composes list of quiz question options. First element is always the correct answer. The're total 1 +
+        self.quiz_options_amount options for each question and total of self.quiz_questions_amount questions per quiz.
+        Each quiz run each question is randomized from the quiz pull (for any chosen map all for all supported maps.
+        Adaptive quizzes pick correct answers weighted by user's past mistakes"""
+        if self.mastery and user_id is not None:
+            return self.mastery.sample(user_id, map_name, self.catalog.sampler.keys[map_name], quiz_length,
+                                       total_options)
+        return self.catalog.sampler.sample(quiz_length, map_name, total_options)
+
+    def send_top(self, message):
+        """/top: best players of the group chat, or of the whole bot in private chats"""
+        if message.chat.type == 'private':
+            rows = self.leaderboard.top(*GLOBAL)
+        else:
+            rows = self.leaderboard.top("chat", message.chat.id)
+        output = f"Top players:\n{format_top(rows)}" if rows else "No one's on the leaderboard yet. Time for a quiz?"
+        self.main_menu(message=message, text=output)
 
     def send_help_response(self, message):
         """ /help command processor. Basically just lists all available commands for user.
@@ -359,7 +640,7 @@ class R6CalloutsBot:
             sticker_id = st_id
         else:
             sticker_id = random.choice(self.main_sticker_pull)
-        self.bot.send_sticker(message.chat.id, sticker_id)
+        self.sender.submit(message.chat.id, self.bot.send_sticker, message.chat.id, sticker_id)
 
     def contact_dev(self, message, incoming_message=None):  # TODO add picture handling
         """forward messages to @author"""
@@ -368,14 +649,14 @@ class R6CalloutsBot:
         if typ not in ('text'):
             output = "let's stick to just text ok?"
             markup = self.create_markup(buttons=[self.confirm_cmd, self.cancel_cmd])
-            msg = self.bot.reply_to(message=message, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.contact_dev, incoming_message=incoming_message)
+            self.reply_to(message=message, text=output, reply_markup=markup)
+            self.bot.register_next_step_handler(message, self.contact_dev, incoming_message=incoming_message)
             return
         if name == self.cancel_cmd:
             self.cancel_handler(message)
             return
         if name == self.confirm_cmd:
-            self.bot.send_message(self.author_chat_id, text=incoming_message)
+            self.send_message(self.author_chat_id, text=incoming_message)
             output = "Message sent.\nThanks for the feedback!"
             self.main_menu(message=message, text=output)
             return
@@ -384,26 +665,69 @@ class R6CalloutsBot:
                      f"\nPress {self.confirm_cmd} when you're ready to send your message, or" \
                      f"{self.cancel_cmd} if you changed your mind"
             markup = self.create_markup(buttons=[self.confirm_cmd, self.cancel_cmd])
-            msg = self.bot.send_message(message.chat.id, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.contact_dev,
+            self.send_message(message.chat.id, text=output, reply_markup=markup)
+            self.bot.register_next_step_handler(message, self.contact_dev,
                                                 incoming_message=f"Message from {message.chat.username} {message.chat.id} start:\n")
         else:
             # TODO separate picture and text processing
             incoming_message += '\n' + name
             output = "Anything else?"
             markup = self.create_markup(buttons=[self.confirm_cmd, self.cancel_cmd])
-            msg = self.bot.send_message(message.chat.id, text=output, reply_markup=markup)
-            self.bot.register_next_step_handler(msg, self.contact_dev, incoming_message=incoming_message)
+            self.send_message(message.chat.id, text=output, reply_markup=markup)
+            self.bot.register_next_step_handler(message, self.contact_dev, incoming_message=incoming_message)
 
     def cancel_handler(self, message):
         """handles /cancel command"""
+        self.sessions.delete(message.chat.id)
         self.main_menu(message, "Ok")
 
     def start_bot(self):
         """start infinite polling: bot would automatically restart in case of a connection issue or platform restart"""
-        self.bot.infinity_polling()
+        logger.info("run mode: %s", self.run_mode)
+        if self.run_mode == "workers":
+            run_workers(self.cfg)  # the bot built here goes unused, see __main__
+            return
+        self.catalog_watcher.start(lambda: self.catalog)
+        if self.run_mode == "async":
+            AsyncPollingRunner(self.bot, self.token, max_concurrency=self.max_concurrent_updates,
+                               metrics=self.metrics).run_forever()
+        elif self.run_mode == "webhook":
+            WebhookRunner(self.bot, self.token, url=self.webhook_cfg.get('URL'),
+                          listen=self.webhook_cfg.get('LISTEN', '0.0.0.0'), port=self.webhook_cfg.get('PORT', 8443),
+                          secret=self.webhook_cfg.get('SECRET'),
+                          max_concurrency=self.max_concurrent_updates, metrics=self.metrics).run_forever()
+        else:
+            self.bot.infinity_polling()
+
+
+def load_cfg(path=config_file):
+    with open(path, "r") as of:  # no handling here. Let  it crash if there's a problem with cfg
+        return json.load(of)
+
+
+def run_workers(cfg):
+    """"workers" run mode. This process only polls and talks to Telegram, so it needs no bot of its own (sender,
+    writer threads, stores): every worker process builds one with worker_bot"""
+    workers = cfg['MAIN'].get('WORKERS') or os.cpu_count()
+    PartitionedRunner(worker_bot, cfg['MAIN']['TOKEN'], workers=workers,
+                      max_concurrency=cfg['MAIN'].get('MAX_CONCURRENT_UPDATES', 32),
+                      api_threads=cfg['MAIN'].get('SEND_WORKERS', 8) * workers,
+                      metrics=metrics_from_cfg(cfg.get('METRICS', {}))).run_forever()
+
+
+def worker_bot(index):
+    """TeleBot of a worker process in "workers" run mode"""
+    c_bot = R6CalloutsBot(worker=index)
+    c_bot.catalog_watcher.start(lambda: c_bot.catalog)
+    return c_bot.bot
 
 
-logger.info("start the bot!")
-c_bot = R6CalloutsBot()
-c_bot.start_bot()
+if __name__ == "__main__":
+    logger.info("start the bot!")
+    main_cfg = load_cfg()
+    if main_cfg['MAIN'].get('RUN_MODE') == "workers":
+        logger.info("run mode: workers")
+        run_workers(main_cfg)
+    else:
+        c_bot = R6CalloutsBot()
+        c_bot.start_bot()
@@ -0,0 +1,511 @@
+import asyncio
+import hmac
+import itertools
+import logging
+import multiprocessing
+import queue
+import signal
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from os import path
+import aiohttp
+from aiohttp import web
+from telebot import TeleBot, apihelper, types
+from r6_logging import forward_logging
+
+
+"""Alternative ways to feed Telegram updates into R6CalloutsBot handlers. TeleBot.infinity_polling processes
+updates one batch at a time, so a slow upload for one user delays everybody else. PartitionedRunner spreads chats over
+worker processes for more than one core"""
+
+logger = logging.getLogger('r6_callouts')
+
+
+def update_chat_id(update):
+    """chat the update belongs to. Updates of the same chat have to be processed in order"""
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        # button under a message: the chat of that message, so presses in groups line up with its messages.
+        # Inline mode results have no message, just the user
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+def api_url(token, method_name):
+    """same url telebot would use, including custom apihelper.API_URL (local Bot API server, mocks)"""
+    if apihelper.API_URL is None:
+        return f"https://api.telegram.org/bot{token}/{method_name}"
+    return apihelper.API_URL.format(token, method_name)
+
+
+class PollingTeleBot(TeleBot):
+    """TeleBot for the stock polling mode. telebot 3.7.3 pops step answers off the batch while enumerating it, so when
+    two of them come in one getUpdates batch the second one skips its next step handler and lands in the regular
+    handlers. The runners below process one update at a time and never hit that"""
+    def _notify_next_handlers(self, new_messages):
+        remaining = []
+        for message in new_messages:
+            handlers = self.next_step_backend.get_handlers(message.chat.id)
+            for handler in handlers:
+                self._exec_task(handler["callback"], message, *handler["args"], **handler["kwargs"])
+            if not handlers:
+                remaining.append(message)
+        new_messages[:] = remaining
+
+
+class ChatOrderedDispatcher:
+    """Runs handlers for different chats in parallel while updates of one chat are processed strictly in order.
+    Handlers are regular blocking telebot handlers, so they are executed on a thread pool. TeleBot has to be created
+    with threaded=False, otherwise it'd hand handlers over to its own worker pool and break the ordering"""
+    def __init__(self, bot, max_concurrency=32, on_start=None):
+        self.bot = bot
+        self.on_start = on_start  # function(update) called right before the handlers of the update run
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="tg_update")
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.chat_tails = {}  # chat_id: task processing the latest update of the chat
+
+    def dispatch(self, update):
+        chat_id = update_chat_id(update)
+        previous = self.chat_tails.get(chat_id) if chat_id is not None else None
+        task = asyncio.ensure_future(self.process(update, previous))
+        if chat_id is not None:
+            self.chat_tails[chat_id] = task
+            task.add_done_callback(lambda t: self.forget(chat_id, t))
+        return task
+
+    def forget(self, chat_id, task):
+        # don't keep an entry for every chat we've ever seen
+        if self.chat_tails.get(chat_id) is task:
+            del self.chat_tails[chat_id]
+
+    async def process(self, update, previous):
+        if previous:
+            await asyncio.wait([previous])  # errors of the previous update are its own business
+        async with self.semaphore:
+            loop = asyncio.get_event_loop()
+            if self.on_start:
+                self.on_start(update)
+            try:
+                await loop.run_in_executor(self.executor, self.bot.process_new_updates, [update])
+            except Exception:
+                logger.exception("Failed to process update %s", update.update_id)
+
+
+class AsyncPollingRunner:
+    """Long polling on asyncio event loop with a single keep-alive aiohttp session. Updates are handed over to
+    ChatOrderedDispatcher as soon as they arrive"""
+    def __init__(self, bot, token, max_concurrency=32, poll_timeout=30, retry_delay=3, metrics=None):
+        self.bot = bot
+        self.token = token
+        self.max_concurrency = max_concurrency
+        self.poll_timeout = poll_timeout
+        self.retry_delay = retry_delay
+        self.metrics = metrics  # r6_metrics: event loop lag
+        self.offset = 0
+        self.dispatcher = None
+
+    async def get_updates(self, session):
+        params = {"offset": self.offset, "timeout": self.poll_timeout}
+        async with session.get(api_url(self.token, "getUpdates"), params=params) as resp:
+            result = await resp.json()
+        if not result.get("ok"):
+            raise aiohttp.ClientError(f"getUpdates failed: {result.get('description')}")
+        return result["result"]
+
+    def start(self):
+        """runs once the event loop is up, before the first getUpdates"""
+        self.dispatcher = ChatOrderedDispatcher(self.bot, self.max_concurrency)
+
+    def dispatch(self, update_json):
+        self.dispatcher.dispatch(types.Update.de_json(update_json))
+
+    async def run(self):
+        if self.metrics:
+            asyncio.ensure_future(self.metrics.watch_loop_lag())
+        self.start()
+        connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=self.poll_timeout * 2)
+        timeout = aiohttp.ClientTimeout(total=self.poll_timeout + 10)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            while True:
+                try:
+                    updates = await self.get_updates(session)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    logger.warning("getUpdates error: %s. Retrying in %s seconds", e, self.retry_delay)
+                    await asyncio.sleep(self.retry_delay)
+                    continue
+                for update_json in updates:
+                    self.offset = max(self.offset, update_json["update_id"] + 1)
+                    self.dispatch(update_json)
+
+    def run_forever(self):
+        asyncio.get_event_loop().run_until_complete(self.run())
+
+
+class WebhookRunner:
+    """Receives updates with a small built-in HTTP server. Telegram (or the load balancer in front of the replicas)
+    gets 200 as soon as the update is validated and queued, handlers never hold the request open. Won't start without
+    a secret: anyone who reaches the port could post updates then"""
+    secret_header = "X-Telegram-Bot-Api-Secret-Token"
+
+    def __init__(self, bot, token, url=None, listen="0.0.0.0", port=8443, secret=None, max_concurrency=32,
+                 queue_size=1000, metrics=None):
+        if not secret:
+            raise ValueError("Webhook mode needs a secret token (WEBHOOK SECRET in files/tg_config)")
+        self.bot = bot
+        self.token = token
+        self.url = url  # public url to register with setWebhook. Skip registration if empty (local testing)
+        self.listen = listen
+        self.port = port
+        self.secret = secret
+        self.max_concurrency = max_concurrency
+        self.queue = None
+        self.queue_size = queue_size
+        self.metrics = metrics
+
+    async def receive(self, request):
+        if not hmac.compare_digest(request.headers.get(self.secret_header, "").encode(), self.secret.encode()):
+            logger.warning("Webhook request from %s with wrong secret token", request.remote)
+            return web.Response(status=403)
+        try:
+            update_json = await request.json()
+            if not isinstance(update_json, dict) or not isinstance(update_json.get("update_id"), int):
+                raise ValueError("no update_id")
+            update = types.Update.de_json(update_json)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            # Telegram retries anything but 2xx and 4xx, a body that can't be parsed won't get any better
+            logger.warning("Webhook request from %s isn't a valid update", request.remote)
+            return web.Response(status=400)
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Telegram retries failed deliveries, so it's safe to push back instead of growing the queue
+            logger.warning("Update queue is full, rejecting update %s", update.update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def consume(self):
+        dispatcher = ChatOrderedDispatcher(self.bot, self.max_concurrency)
+        while True:
+            update = await self.queue.get()
+            dispatcher.dispatch(update)
+
+    async def set_webhook(self):
+        params = {"url": self.url, "max_connections": self.max_concurrency, "secret_token": self.secret}
+        async with aiohttp.ClientSession() as session:
+            async with session.post(api_url(self.token, "setWebhook"), data=params) as resp:
+                result = await resp.json()
+        if not result.get("ok"):
+            raise RuntimeError(f"setWebhook failed: {result.get('description')}")
+        logger.info("Webhook set to %s", self.url)
+
+    async def run(self):
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.metrics:
+            asyncio.ensure_future(self.metrics.watch_loop_lag())
+        app = web.Application()
+        app.router.add_post("/", self.receive)
+        app.router.add_post(f"/{self.token}", self.receive)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, self.listen, self.port).start()
+        logger.info("Listening for webhook updates on %s:%s", self.listen, self.port)
+        if self.url:
+            await self.set_webhook()
+        try:
+            await self.consume()
+        finally:
+            await runner.cleanup()
+
+    def run_forever(self):
+        asyncio.get_event_loop().run_until_complete(self.run())
+
+
+def raw_chat_id(update_json):
+    """update_chat_id for an update that wasn't parsed yet"""
+    for key in ("message", "edited_message"):
+        if key in update_json:
+            return update_json[key]["chat"]["id"]
+    if "callback_query" in update_json:
+        query = update_json["callback_query"]
+        return query["message"]["chat"]["id"] if "message" in query else query["from"]["id"]
+    return None
+
+
+class RemoteCallError(Exception):
+    """Bot API call made for a worker failed in the receiving process with something other than a Telegram error"""
+
+
+def encode_error(e):
+    """exception of a call made for a worker in a form that survives pickling. telebot exceptions don't"""
+    if isinstance(e, apihelper.ApiTelegramException):
+        return "telegram", e.function_name, e.result_json
+    if isinstance(e, apihelper.ApiException):
+        return "api", e.function_name, str(e)
+    return "other", type(e).__name__, str(e)
+
+
+def decode_error(error):
+    kind, name, detail = error
+    if kind == "telegram":  # error_code and result_json are there, so are retries after 429
+        return apihelper.ApiTelegramException(name, None, detail)
+    if kind == "api":
+        e = apihelper.ApiException("", name, None)
+        e.args = (detail,)
+        return e
+    return RemoteCallError(f"{name}: {detail}")
+
+
+def portable_files(files):
+    """telebot hands open files to requests. The call is made in another process, so they travel as (name, bytes)"""
+    if not files:
+        return files
+    return {key: (path.basename(getattr(f, "name", key)), f.read()) if hasattr(f, "read") else f
+            for key, f in files.items()}
+
+
+class PipeChannel:
+    """multiprocessing Connection several threads can send on"""
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def close(self):
+        self.conn.close()
+
+
+class WorkerChannel(PipeChannel):
+    """worker process end of the pipe: updates come in, Bot API calls and log records go out, call results come back.
+    make_request replaces apihelper._make_request, put_nowait makes it a log queue for r6_logging.forward_logging"""
+    def __init__(self, conn, call_timeout=120):
+        super().__init__(conn)
+        self.call_timeout = call_timeout  # seconds. The receiving process applies telebot's own timeouts too
+        self.updates = queue.SimpleQueue()  # update json, None when it's time to stop
+        self.waiting = {}  # call id: Future
+        self.calls = itertools.count()
+
+    def make_request(self, token, method_name, method='get', params=None, files=None):
+        call_id = next(self.calls)
+        future = self.waiting[call_id] = Future()
+        try:
+            self.send(("call", call_id, token, method_name, method, params, portable_files(files)))
+            return future.result(self.call_timeout)
+        finally:
+            self.waiting.pop(call_id, None)
+
+    def put_nowait(self, record):
+        self.send(("log", record))
+
+    def receive(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                self.updates.put(None)
+                return
+            if message[0] == "update":
+                self.updates.put(message[1])
+            elif message[0] == "stop":
+                self.updates.put(None)
+            else:
+                _, call_id, ok, result = message
+                future = self.waiting.get(call_id)
+                if future and ok:
+                    future.set_result(result)
+                elif future:
+                    future.set_exception(decode_error(result))
+
+
+def partition_worker(index, make_bot, conn, max_concurrency):
+    """worker process: the bot from make_bot(index) handles updates of its share of chats, with ChatOrderedDispatcher
+    just like AsyncPollingRunner does it. Exits once the receiving process says stop or goes away"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C goes to the whole group, shutting down is up to the parent
+    channel = WorkerChannel(conn)
+    forward_logging(logger, channel)
+    apihelper._make_request = channel.make_request
+    threading.Thread(target=channel.receive, name="tg_channel", daemon=True).start()
+    bot = make_bot(index)
+
+    async def consume():
+        # the receiving process hands updates a dead worker never started over to the next one
+        dispatcher = ChatOrderedDispatcher(bot, max_concurrency,
+                                           on_start=lambda update: channel.send(("started", update.update_id)))
+        loop = asyncio.get_event_loop()
+        while True:
+            update_json = await loop.run_in_executor(None, channel.updates.get)
+            if update_json is None:
+                await asyncio.gather(*dispatcher.chat_tails.values())  # the latest of every chat waits for the rest
+                return
+            # parsing is a good part of the CPU time per update, so it happens here and not in the receiving process
+            dispatcher.dispatch(types.Update.de_json(update_json))
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    asyncio.get_event_loop().run_until_complete(consume())
+    logger.info("Worker %s is done", index)
+
+
+class WorkerProcess:
+    """receiving process end of one worker: the process, its pipe and updates held back while it's down"""
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.channel = None
+        self.started = 0
+        self.failures = 0  # quick deaths in a row
+        self.restart_at = None
+        self.backlog = deque()  # updates waiting for the worker to come back
+        self.unstarted = OrderedDict()  # update_id: update json. Sent to the worker, handlers haven't run yet
+
+
+class PartitionedRunner(AsyncPollingRunner):
+    """Long polling in this process, handlers in worker processes: one Python process is capped at one core of
+    update parsing, markup building and quiz sampling. Updates are partitioned by hash of the chat id, so a chat always
+    goes to the same worker and its updates stay in order. Workers don't talk to Telegram: their Bot API calls come
+    back over the pipe into one outbound queue served by api_threads connections here. Workers that die are started
+    again, quick deaths in a row back off up to max_restart_delay. Updates a worker was handling when it died are lost
+    with it. The ones it hadn't started on and the ones routed to it while it's down go to the new one"""
+    def __init__(self, make_bot, token, workers=2, max_concurrency=32, api_threads=32, poll_timeout=30,
+                 retry_delay=3, restart_delay=1, max_restart_delay=60, max_backlog=1000, metrics=None):
+        super().__init__(None, token, max_concurrency, poll_timeout, retry_delay, metrics)
+        self.make_bot = make_bot  # picklable function(worker index) -> TeleBot, called in the worker process
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.max_backlog = max_backlog  # updates per worker held while it's down
+        self.workers = [WorkerProcess(i) for i in range(workers)]
+        # spawn, not fork: this process already runs threads, a forked copy of their locks may be held forever
+        self.context = multiprocessing.get_context("spawn")
+        self.make_request = apihelper._make_request
+        self.outbound = ThreadPoolExecutor(max_workers=api_threads, thread_name_prefix="tg_api")
+        self.restarts = 0
+        self.loop = None
+        self.stopping = False
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        if self.metrics:
+            self.metrics.sampled("worker_restarts_total", "Worker processes started again", lambda: self.restarts,
+                                 kind="counter")
+            self.metrics.sampled("worker_backlog", "Updates waiting for a worker to come back",
+                                 lambda: {(w.index,): len(w.backlog) for w in self.workers}, labels=("worker",))
+        for worker in self.workers:
+            self.start_worker(worker)
+        asyncio.ensure_future(self.supervise())
+
+    def start_worker(self, worker):
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(target=partition_worker, name=f"tg_worker_{worker.index}",
+                                       args=(worker.index, self.make_bot, worker_conn, self.max_concurrency))
+        process.start()
+        worker_conn.close()
+        worker.process = process
+        worker.channel = PipeChannel(conn)
+        worker.started = time.monotonic()
+        worker.restart_at = None
+        threading.Thread(target=self.serve, args=(worker, worker.channel), name=f"tg_worker_{worker.index}_pipe",
+                         daemon=True).start()
+        logger.info("Worker %s started, pid %s", worker.index, process.pid)
+        while worker.backlog:
+            self.send_update(worker, worker.backlog.popleft())
+
+    def serve(self, worker, channel):
+        """reads one worker's pipe until it closes. Calls go to the outbound pool, log records to the log"""
+        while True:
+            try:
+                message = channel.conn.recv()
+            except (EOFError, OSError):
+                return
+            if message[0] == "call":
+                self.outbound.submit(self.call, channel, *message[1:])
+            elif message[0] == "started":
+                self.loop.call_soon_threadsafe(worker.unstarted.pop, message[1], None)
+            else:
+                logger.handle(message[1])
+
+    def call(self, channel, call_id, token, method_name, method, params, files):
+        try:
+            reply = ("reply", call_id, True, self.make_request(token, method_name, method, params, files))
+        except Exception as e:
+            reply = ("reply", call_id, False, encode_error(e))
+        try:
+            channel.send(reply)
+        except OSError:
+            pass  # the worker died waiting for it
+
+    def dispatch(self, update_json):
+        chat_id = raw_chat_id(update_json)
+        key = chat_id if chat_id is not None else update_json["update_id"]
+        worker = self.workers[hash(key) % len(self.workers)]
+        if worker.restart_at is not None or worker.backlog:
+            self.hold(worker, update_json)
+        else:
+            self.send_update(worker, update_json)
+
+    def send_update(self, worker, update_json):
+        try:
+            worker.channel.send(("update", update_json))
+        except OSError:  # died since the last check. The supervisor will notice
+            self.hold(worker, update_json)
+            return
+        worker.unstarted[update_json["update_id"]] = update_json
+
+    def hold(self, worker, update_json):
+        if len(worker.backlog) >= self.max_backlog:
+            logger.warning("Worker %s is down and has %s updates waiting, dropping update %s", worker.index,
+                           len(worker.backlog), update_json["update_id"])
+            return
+        worker.backlog.append(update_json)
+
+    async def supervise(self, interval=1):
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            for worker in self.workers:
+                if self.stopping:
+                    return
+                if worker.restart_at is None and not worker.process.is_alive():
+                    uptime = now - worker.started
+                    worker.failures = worker.failures + 1 if uptime < self.max_restart_delay else 0
+                    delay = min(self.restart_delay * 2 ** max(0, worker.failures - 1), self.max_restart_delay)
+                    logger.error("Worker %s exited with code %s after %.0f s. Starting it again in %s s",
+                                 worker.index, worker.process.exitcode, uptime, delay)
+                    worker.channel.close()
+                    worker.restart_at = now + delay
+                    if worker.unstarted:
+                        logger.warning("Worker %s didn't get to %s updates, they go to the new one", worker.index,
+                                       len(worker.unstarted))
+                        worker.backlog.extendleft(reversed(worker.unstarted.values()))
+                        worker.unstarted.clear()
+                elif worker.restart_at is not None and now >= worker.restart_at:
+                    self.restarts += 1
+                    self.start_worker(worker)
+
+    def stop(self, timeout=10):
+        """workers finish the updates they have, write their state and exit"""
+        self.stopping = True
+        for worker in self.workers:
+            try:
+                worker.channel.send(("stop",))
+            except (AttributeError, OSError):
+                pass  # never started or already dead
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    logger.warning("Worker %s didn't stop in %s s", worker.index, timeout)
+                    worker.process.terminate()
+
+    def run_forever(self):
+        try:
+            super().run_forever()
+        finally:
+            self.stop()
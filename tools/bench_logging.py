@@ -0,0 +1,110 @@
+import asyncio
+import logging
+import shutil
+import statistics
+import sys
+import tempfile
+import timeit
+from logging.handlers import RotatingFileHandler
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from r6_logging import setup_logging, stop_logging, TEXT_FORMAT, DATE_FORMAT  # noqa: E402
+
+
+"""Benchmark: event loop stalls caused by logging. A ticker coroutine measures how late it wakes up while chat
+coroutines log like a busy quiz, once with RotatingFileHandler attached to the logger (how both bots logged before) and
+once through the r6_logging queue. Small log files make rotation part of the picture.
+Run it from the repo root:
+    python tools/bench_logging.py
+"""
+
+max_log_file_size = 0.25  # MB
+
+
+def direct_logger(log_file):
+    logger = logging.getLogger(f"bench_direct_{log_file}")
+    logger.setLevel(logging.DEBUG)
+    handler = RotatingFileHandler(log_file, mode='a', maxBytes=int(max_log_file_size * 1024 * 1024), backupCount=5,
+                                  encoding='utf-8')
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT, DATE_FORMAT))
+    logger.addHandler(handler)
+    return logger
+
+
+async def quiz_load(logger, chats=200, records=50):
+    """returns seconds spent in log calls and ticker lags"""
+    loop = asyncio.get_event_loop()
+    lags = []
+    spent = [0.0]
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            start = loop.time()
+            await asyncio.sleep(0.001)
+            lags.append(loop.time() - start - 0.001)
+
+    async def chat(chat_id):
+        for i in range(records):
+            start = timeit.default_timer()
+            logger.info("%s answered question %s on %s in %.1f s", chat_id, i, "KAFE", 1.5,
+                        extra={"chat_id": chat_id})
+            spent[0] += timeit.default_timer() - start
+            await asyncio.sleep(0.01)  # waiting on the network
+
+    tick = asyncio.ensure_future(ticker())
+    await asyncio.gather(*(chat(chat_id) for chat_id in range(chats)))
+    done.set()
+    await tick
+    return spent[0], lags
+
+
+def report(title, spent, lags, records):
+    lags = sorted(lags)
+    p99 = lags[int(len(lags) * 0.99)] if lags else 0
+    print(f"{title:<22} {spent / records * 1e6:6.1f} us per call, loop lag median "
+          f"{statistics.median(lags) * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms, max {lags[-1] * 1000:.2f} ms")
+
+
+def main():
+    tmp_dir = tempfile.mkdtemp()
+    chats, records = 200, 50
+    try:
+        silent = logging.getLogger("bench_silent")
+        silent.addHandler(logging.NullHandler())
+        silent.propagate = False
+        loggers = [("no logging", silent),
+                   ("direct file handler", direct_logger(f"{tmp_dir}/direct.log")),
+                   ("queue, text", setup_logging("bench_text", f"{tmp_dir}/text.log", max_log_file_size,
+                                                 chat_rate=None)),
+                   ("queue, json lines", setup_logging("bench_json", f"{tmp_dir}/json.log", max_log_file_size,
+                                                       json_lines=True, chat_rate=None))]
+        for title, logger in loggers:
+            spent, lags = asyncio.run(quiz_load(logger, chats, records))
+            report(title, spent, lags, chats * records)
+            stop_logging(logger)
+
+        # level is off: f-string is built anyway, %-style args are not even formatted
+        quiet = setup_logging("bench_quiet", f"{tmp_dir}/quiet.log", level=logging.WARNING)
+        chat_id, map_name = 42, "KAFE"
+        eager = min(timeit.repeat(lambda: quiet.info(f"{chat_id} started quiz on {map_name} for {5} questions"),
+                                  number=100000, repeat=3)) / 100000
+        lazy = min(timeit.repeat(lambda: quiet.info("%s started quiz on %s for %s questions", chat_id, map_name, 5),
+                                 number=100000, repeat=3)) / 100000
+        print(f"disabled level: f-string {eager * 1e9:.0f} ns, %-style {lazy * 1e9:.0f} ns per call")
+        stop_logging(quiet)
+
+        # one chat spamming: sampling keeps it to the burst plus the rate
+        sampled = setup_logging("bench_sampled", f"{tmp_dir}/sampled.log")
+        for i in range(10000):
+            sampled.info("noisy chat record %s", i, extra={"chat_id": 1})
+        sampler = sampled.handlers[0].filters[0]
+        print(f"noisy chat: 10000 records, {10000 - sampler.dropped} written, {sampler.dropped} dropped")
+        stop_logging(sampled)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
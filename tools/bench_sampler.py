@@ -0,0 +1,77 @@
+import json
+import random
+import sys
+import timeit
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from r6_quiz import QuizSampler  # noqa: E402
+from r6_mastery import FenwickTree  # noqa: E402
+
+
+"""Microbenchmark: QuizSampler against the list-rebuilding sampler both bots used before.
+Run it from the repo root:
+    python tools/bench_sampler.py
+"""
+
+all_maps_val = "all maps!"
+
+
+def legacy_sample(quiz_data, quiz_length, map_name, total_options):
+    """create_list_of_quiz_questions as it was before QuizSampler"""
+    all_questions = []
+    chosen_options = []
+    true_quiz_length = min(quiz_length, len(quiz_data[map_name].items()))
+    for _ in range(true_quiz_length):
+        correct_answer = random.choice([i for i in quiz_data[map_name].keys() if i not in chosen_options])
+        quiz_options = [i for i in quiz_data[map_name].keys() if i != correct_answer]
+        quiz_options = random.sample(quiz_options, min(total_options, len(quiz_options)))
+        quiz_options.insert(0, correct_answer)
+        chosen_options.append(correct_answer)
+        all_questions.append(quiz_options)
+    return all_questions
+
+
+def load_quiz_data(pool_multiplier=1):
+    with open("files/quiz.txt", "r") as of:
+        quiz_data = json.load(of)
+    maps_buffer = {}
+    for copy in range(pool_multiplier):
+        for key, val in quiz_data.items():
+            for k, v in val.items():
+                maps_buffer[f"{k} {copy}" if copy else k] = f"{key}/{v}"
+    quiz_data[all_maps_val] = maps_buffer
+    return quiz_data
+
+
+def main():
+    for pool_multiplier, quiz_length in ((1, 5), (1, 500), (10, 500)):
+        quiz_data = load_quiz_data(pool_multiplier)
+        sampler = QuizSampler(quiz_data)
+        pool = len(quiz_data[all_maps_val])
+        runs = 3 if quiz_length > 100 else 1000
+        legacy = min(timeit.repeat(lambda: legacy_sample(quiz_data, quiz_length, all_maps_val, 5),
+                                   number=runs, repeat=3)) / runs
+        indexed = min(timeit.repeat(lambda: sampler.sample(quiz_length, all_maps_val, 5),
+                                    number=runs, repeat=3)) / runs
+        print(f"pool {pool:>5}, {quiz_length:>3} questions: legacy {legacy * 1000:9.3f} ms, "
+              f"indexed {indexed * 1000:7.3f} ms, x{legacy / indexed:.0f}")
+    quiz_data = load_quiz_data()
+    sampler = QuizSampler(quiz_data)
+    batch = min(timeit.repeat(lambda: sampler.sample_many(1000, 5, all_maps_val, 5), number=1, repeat=3))
+    print(f"batch of 1000 quizzes x 5 questions: {batch * 1000:.1f} ms")
+    # adaptive quizzes: correct answers drawn by weight from a Fenwick tree (see r6_mastery.py)
+    for pool_multiplier in (1, 100):
+        keys = sampler.keys[all_maps_val] * pool_multiplier
+        tree = FenwickTree([random.random() for _ in keys])
+        runs = 1000
+        weighted = min(timeit.repeat(lambda: QuizSampler.questions(keys, tree.sample(5), 5),
+                                     number=runs, repeat=3)) / runs
+        update = min(timeit.repeat(lambda: tree.set(random.randrange(len(keys)), random.random()),
+                                   number=runs, repeat=3)) / runs
+        print(f"pool {len(keys):>6}, weighted 5 questions: {weighted * 1000:.3f} ms, "
+              f"answer update {update * 1000000:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
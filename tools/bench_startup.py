@@ -0,0 +1,62 @@
+import json
+import shutil
+import sys
+import tempfile
+import timeit
+from os import makedirs, path, symlink
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from r6_catalog import CatalogLoader, build_snapshot  # noqa: E402
+
+
+"""Benchmark: content loading on bot start from the source files against the binary snapshot. Scaled runs copy every
+map pool_multiplier times (map folders are symlinked) to see how both paths grow with content.
+Run it from the repo root:
+    python tools/bench_startup.py
+"""
+
+all_maps_val = "all maps!"
+
+
+def scaled_content(tmp_dir, pool_multiplier):
+    """quiz.txt, quiz and maps folders with every map repeated pool_multiplier times. Returns CatalogLoader args"""
+    with open("files/quiz.txt", "r") as of:
+        quiz_data = json.load(of)
+    scaled = {}
+    makedirs(f"{tmp_dir}/quiz")
+    makedirs(f"{tmp_dir}/maps")
+    for copy in range(pool_multiplier):
+        for map_name, callouts in quiz_data.items():
+            name = f"{map_name}{copy}" if copy else map_name
+            scaled[name] = {f"{k} {copy}" if copy else k: v for k, v in callouts.items()}
+            if path.isdir(f"files/quiz/{map_name}"):
+                symlink(path.abspath(f"files/quiz/{map_name}"), f"{tmp_dir}/quiz/{name}")
+            if path.isdir(f"files/maps/{map_name}"):
+                symlink(path.abspath(f"files/maps/{map_name}"), f"{tmp_dir}/maps/{name}")
+    with open(f"{tmp_dir}/quiz.txt", "w") as of:
+        json.dump(scaled, of)
+    shutil.copy("files/tg_config.txt", f"{tmp_dir}/tg_config.txt")
+    return f"{tmp_dir}/quiz.txt", f"{tmp_dir}/quiz", f"{tmp_dir}/maps", all_maps_val, f"{tmp_dir}/tg_config.txt"
+
+
+def main():
+    runs = 20
+    for pool_multiplier in (1, 10, 50):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            *args, config_file = scaled_content(tmp_dir, pool_multiplier)
+            from_sources = CatalogLoader(*args, config_file=config_file, snapshot_file=None)
+            from_snapshot = CatalogLoader(*args, config_file=config_file, snapshot_file=f"{tmp_dir}/content.snapshot")
+            size, (catalog,) = build_snapshot([from_snapshot], from_snapshot.snapshot_file)
+            assert from_snapshot.from_snapshot().quiz_data == catalog.quiz_data
+            sources = min(timeit.repeat(from_sources, number=runs, repeat=3)) / runs
+            snapshot = min(timeit.repeat(from_snapshot, number=runs, repeat=3)) / runs
+            print(f"{len(catalog.maps):>4} maps, {len(catalog.quiz_data[all_maps_val]):>5} callouts: "
+                  f"sources {sources * 1000:7.2f} ms, snapshot {snapshot * 1000:6.2f} ms ({size / 1024:.0f} KB), "
+                  f"x{sources / snapshot:.1f}")
+        finally:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
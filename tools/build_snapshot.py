@@ -0,0 +1,34 @@
+import logging
+import sys
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from r6_catalog import CatalogLoader, build_snapshot, log_problems  # noqa: E402
+from r6_snapshot import SNAPSHOT_FILE  # noqa: E402
+
+
+"""Build step for quiz content: compiles quiz.txt, map buttons, schematics index, image variants manifest and sampler
+indexes into one binary snapshot both bots load on start instead of parsing and scanning everything. Bots fall back
+to the source files when the snapshot is missing or any source changed after it was built. Run it from the repo root
+after changing content (and after tools/build_variants.py):
+    python tools/build_snapshot.py
+"""
+
+# must match the way the bots create their CatalogLoader
+loaders = {"telegram": CatalogLoader("files/quiz.txt", "files/quiz", "files/maps", "all maps!",
+                                     config_file="files/tg_config.txt"),
+           "discord": CatalogLoader("files/quiz.txt", "files/quiz", "files/maps/", "all maps!")}
+
+
+def main():
+    logging.basicConfig(format="%(levelname)s: %(message)s")
+    size, catalogs = build_snapshot(loaders.values(), SNAPSHOT_FILE)
+    for name, catalog in zip(loaders, catalogs):
+        log_problems(logging.getLogger(name), catalog)
+        print(f"{name}: {len(catalog.maps)} quiz maps, {len(catalog.schematics)} schematics, "
+              f"{len(catalog.images.files)} picture variants, {len(catalog.problems)} problems")
+    print(f"{SNAPSHOT_FILE}: {size / 1024:.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
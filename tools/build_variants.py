@@ -0,0 +1,99 @@
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from os import cpu_count, makedirs, path, replace, stat, walk
+from PIL import Image
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+from r6_media import file_digest, VARIANTS_MANIFEST, VARIANTS_TIERS, variant_path  # noqa: E402
+
+
+"""Build step for quiz pictures and map schematics: produces downscaled and recompressed copies of every picture
+in files/quiz and files/maps for each tier in VARIANTS_TIERS and writes the manifest both bots read on start.
+Only new or changed pictures are processed. Run it from the repo root after adding pictures:
+    python tools/build_variants.py
+"""
+
+source_dirs = ("files/quiz", "files/maps")
+picture_ext = (".jpg", ".jpeg", ".png")
+
+
+def transcode(src, digest):
+    """create all tier variants for one picture. Runs in a worker process"""
+    variants = {}
+    with Image.open(src) as im:
+        im.load()
+        if im.mode in ("RGBA", "LA", "P"):
+            # jpeg has no alpha channel. Schematics use transparent background, flatten them onto black
+            im = im.convert("RGBA")
+            background = Image.new("RGB", im.size, (0, 0, 0))
+            background.paste(im, mask=im.split()[-1])
+            im = background
+        elif im.mode != "RGB":
+            im = im.convert("RGB")
+        for tier, (max_side, fmt, quality) in VARIANTS_TIERS.items():
+            out = im.copy()
+            out.thumbnail((max_side, max_side), Image.LANCZOS)  # keeps aspect ratio, never upscales
+            dst = variant_path(src, tier)
+            makedirs(path.dirname(dst), exist_ok=True)
+            out.save(dst, fmt, quality=quality, optimize=True)
+            variants[tier] = dst
+    st = stat(src)
+    return src, {"hash": digest, "mtime": st.st_mtime_ns, "size": st.st_size, "variants": variants}
+
+
+def needs_rebuild(src, entry):
+    """decide whether picture has to be transcoded again. Returns (rebuild, digest)"""
+    st = stat(src)
+    if entry and set(entry["variants"]) == set(VARIANTS_TIERS) and \
+            all(path.exists(v) for v in entry["variants"].values()):
+        if entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            return False, entry["hash"]
+        digest = file_digest(src)
+        return digest != entry["hash"], digest
+    return True, file_digest(src)
+
+
+def main():
+    try:
+        with open(VARIANTS_MANIFEST, "r") as of:
+            manifest = json.load(of)
+    except (FileNotFoundError, json.decoder.JSONDecodeError):
+        manifest = {}
+    if manifest.get("tiers") != {k: list(v) for k, v in VARIANTS_TIERS.items()}:
+        manifest = {}  # tier settings changed. Everything has to be rebuilt
+    old_files = manifest.get("files", {})
+    files = {}
+    jobs = []
+    for src_dir in source_dirs:
+        for root, dirs, file_names in walk(src_dir):
+            for file_name in file_names:
+                if not file_name.lower().endswith(picture_ext):
+                    continue
+                src = f"{root}/{file_name}"
+                rebuild, digest = needs_rebuild(src, old_files.get(src))
+                if rebuild:
+                    jobs.append((src, digest))
+                else:
+                    files[src] = old_files[src]
+                    files[src]["mtime"], files[src]["size"] = stat(src).st_mtime_ns, stat(src).st_size
+    print(f"{len(files)} pictures up to date, {len(jobs)} to transcode")
+    with ProcessPoolExecutor(max_workers=cpu_count()) as pool:
+        futures = [pool.submit(transcode, src, digest) for src, digest in jobs]
+        for future in as_completed(futures):
+            src, entry = future.result()
+            files[src] = entry
+    manifest = {"tiers": {k: list(v) for k, v in VARIANTS_TIERS.items()}, "files": files}
+    makedirs(path.dirname(VARIANTS_MANIFEST), exist_ok=True)
+    tmp_file = f"{VARIANTS_MANIFEST}.tmp"
+    with open(tmp_file, "w") as wf:
+        json.dump(manifest, wf)
+    replace(tmp_file, VARIANTS_MANIFEST)
+    src_size = sum(e["size"] for e in files.values())
+    for tier in VARIANTS_TIERS:
+        tier_size = sum(stat(e["variants"][tier]).st_size for e in files.values())
+        print(f"{tier}: {tier_size / 1024 / 1024:.1f} MB ({src_size / 1024 / 1024:.1f} MB originals)")
+
+
+if __name__ == "__main__":
+    main()
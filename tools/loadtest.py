@@ -0,0 +1,448 @@
+import argparse
+import asyncio
+import atexit
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from os import path
+
+import discord
+from aiohttp import web
+
+REPO = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import r6_scheduler  # noqa: E402
+
+
+"""Load test: thousands of simulated players take quizzes against the real bots with the network replaced by local
+stand-ins, so a performance regression shows up before deploy, not in production.
+Telegram: R6CalloutsBot talks HTTP to a mock Bot API server (getUpdates long polling, sendMessage, sendPhoto, ...)
+exactly as it would to api.telegram.org. Discord: R6Callouts runs on a fake transport under discord.py, HTTP calls
+are answered in process, player messages and reactions come in as gateway events.
+Reports quizzes finished, questions per second, question latency (answer sent to the next question received, p50 and
+p99) and memory growth per chat (peak RSS of the whole process, players included, so it's an upper bound).
+Bots run in a temp copy of files/ (content is symlinked), their databases and logs don't touch the real ones.
+Platform rate limits are lifted unless --real-limits is given: the point is the bot's own overhead.
+Run it from the repo root:
+    python tools/loadtest.py telegram --chats 1000
+    python tools/loadtest.py telegram --chats 1000 --run-mode polling --inline
+    python tools/loadtest.py telegram --chats 1000 --run-mode workers --workers 4
+    python tools/loadtest.py discord --chats 1000
+"""
+
+
+def sandbox():
+    """temp dir with files/ content symlinked. Becomes cwd, so whatever the bots write lands there"""
+    tmp_dir = tempfile.mkdtemp(prefix="r6_loadtest_")
+    atexit.register(shutil.rmtree, tmp_dir, True)  # registered first, runs after the bots' own exit handlers
+    os.makedirs(f"{tmp_dir}/files/log")
+    for name in os.listdir(f"{REPO}/files"):
+        if name in ("log", "tg_config.txt") or name.startswith(("tg_", "discord_")) or name.endswith(".log"):
+            continue
+        os.symlink(f"{REPO}/files/{name}", f"{tmp_dir}/files/{name}")
+    os.chdir(tmp_dir)
+    return tmp_dir
+
+
+def lift_limits():
+    for limits in (r6_scheduler.TELEGRAM_LIMITS, r6_scheduler.DISCORD_LIMITS):
+        for key in limits:
+            limits[key] = (100000, 100000)
+
+
+def peak_rss():
+    """bytes. ru_maxrss is in KB on Linux"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def workers_peak_rss():
+    """bytes, all worker processes together (VmHWM of each, Linux only)"""
+    total = 0
+    for process in multiprocessing.active_children():
+        try:
+            with open(f"/proc/{process.pid}/status") as of:
+                total += next(int(line.split()[1]) * 1024 for line in of if line.startswith("VmHWM"))
+        except (OSError, StopIteration):
+            pass
+    return total
+
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0
+
+
+class Report:
+    def __init__(self, chats):
+        self.chats = chats
+        self.latencies = []  # seconds from player's answer to the next question
+        self.finished = 0
+        self.done = asyncio.Event()
+        self.started = time.perf_counter()
+        self.rss_before = peak_rss()
+
+    def question(self, latency):
+        self.latencies.append(latency)
+
+    def finish(self):
+        self.finished += 1
+        if self.finished == self.chats:
+            self.done.set()
+
+    def print(self, title, calls):
+        wall = time.perf_counter() - self.started
+        latencies = sorted(self.latencies)
+        rss = peak_rss() - self.rss_before
+        print(title)
+        print(f"quizzes finished {self.finished}/{self.chats} in {wall:.1f} s, {len(latencies)} questions, "
+              f"{len(latencies) / wall:.0f} questions/s")
+        print(f"question latency p50 {percentile(latencies, 0.5) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms, max {percentile(latencies, 1) * 1000:.1f} ms")
+        print(f"peak RSS +{rss / 2 ** 20:.1f} MB, {rss / self.chats / 1024:.1f} KB per chat")
+        if workers_peak_rss():
+            print(f"worker processes peak RSS {workers_peak_rss() / 2 ** 20:.1f} MB in total")
+        print("outbound calls: " + ", ".join(f"{method} {count}" for method, count in sorted(calls.items())))
+
+
+class MockBotApi:
+    """Bot API on localhost. Every call is answered like Telegram would, then handed to on_call(method, params,
+    result) so players can react. Player updates wait in a queue for the bot's getUpdates"""
+    def __init__(self, rtt=0.0):
+        self.rtt = rtt  # seconds added to every call but getUpdates
+        self.updates = asyncio.Queue()
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.calls = {}
+        self.on_call = None
+
+    def push(self, update):
+        update["update_id"] = next(self.update_ids)
+        self.updates.put_nowait(update)
+
+    async def get_updates(self, timeout):
+        """long polling when asked to. telebot's own polling doesn't pass timeout on, Telegram answers at once then"""
+        updates = []
+        if self.updates.empty() and timeout > 0:
+            try:
+                updates.append(await asyncio.wait_for(self.updates.get(), timeout=min(timeout, 5)))
+            except asyncio.TimeoutError:
+                return []
+        while len(updates) < 100 and not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    def photo(self, message_id):
+        return [{"file_id": f"photo{message_id}", "file_unique_id": f"u{message_id}", "width": 1280, "height": 720}]
+
+    def result(self, method, params):
+        chat = {"id": int(params.get("chat_id") or 0), "type": "private"}
+        message = {"message_id": next(self.message_ids), "date": int(time.time()), "chat": chat,
+                   "text": params.get("text", "")}
+        if method in ("sendPhoto", "editMessageMedia"):
+            message["photo"] = self.photo(message["message_id"])
+        if method == "sendMediaGroup":
+            return [dict(message, message_id=next(self.message_ids), photo=self.photo(i))
+                    for i in range(len(json.loads(params["media"])))]
+        if method in ("answerCallbackQuery", "editMessageReplyMarkup"):
+            return True
+        return message
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(request.query)
+        if request.method == "POST":
+            post = await request.post()
+            params.update((k, v if isinstance(v, str) else "<file>") for k, v in post.items())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self.get_updates(float(params.get("timeout", 0)))})
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+        self.calls[method] = self.calls.get(method, 0) + 1
+        result = self.result(method, params)
+        if self.on_call:
+            self.on_call(method, params, result)
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, port):
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+
+
+class TelegramPlayers:
+    """one player per private chat: starts a quiz, picks the map, answers every question with a random option after
+    thinking for a while"""
+    def __init__(self, api, report, map_name, think, cancel_cmd="/cancel"):
+        self.api = api
+        self.report = report
+        self.map_name = map_name
+        self.think = think
+        self.cancel_cmd = cancel_cmd
+        self.last_action = {}  # chat_id: when the player's latest update went out
+        self.loop = asyncio.get_event_loop()
+        api.on_call = self.on_call
+
+    def user(self, chat_id):
+        return {"id": chat_id, "is_bot": False, "first_name": "player", "username": f"player{chat_id}"}
+
+    def later(self, fn, *args):
+        self.loop.call_later(self.think * random.uniform(0.5, 1.5), fn, *args)
+
+    def say(self, chat_id, text):
+        chat = {"id": chat_id, "type": "private", "username": f"player{chat_id}", "first_name": "player"}
+        self.api.push({"message": {"message_id": next(self.api.message_ids), "date": int(time.time()), "text": text,
+                                   "chat": chat, "from": self.user(chat_id)}})
+        self.last_action[chat_id] = time.perf_counter()
+
+    def press(self, chat_id, message_id, data):
+        message = {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "private"},
+                   "photo": self.api.photo(message_id)}
+        self.api.push({"callback_query": {"id": str(next(self.api.update_ids)), "from": self.user(chat_id),
+                                          "message": message, "chat_instance": str(chat_id), "data": data}})
+        self.last_action[chat_id] = time.perf_counter()
+
+    def start(self, chat_id):
+        self.say(chat_id, "quiz")
+
+    def asked(self, chat_id):
+        self.report.question(time.perf_counter() - self.last_action[chat_id])
+
+    def on_call(self, method, params, result):
+        chat_id = int(params.get("chat_id") or 0)
+        if chat_id not in self.last_action:
+            return
+        text = params.get("text") or params.get("caption") or ""
+        markup = json.loads(params["reply_markup"]) if params.get("reply_markup") else {}
+        if markup.get("inline_keyboard"):  # inline quiz question, a new message or the previous one edited
+            self.asked(chat_id)
+            buttons = [b["callback_data"] for row in markup["inline_keyboard"] for b in row
+                       if not b["callback_data"].endswith(":x")]
+            message_id = result["message_id"] if isinstance(result, dict) else int(params["message_id"])
+            self.later(self.press, chat_id, message_id, random.choice(buttons))
+        elif "what's the callout" in text:  # reply keyboard quiz question
+            self.asked(chat_id)
+            options = [b["text"] if isinstance(b, dict) else b for row in markup["keyboard"] for b in row]
+            self.later(self.say, chat_id, random.choice([o for o in options if o != self.cancel_cmd]))
+        elif text.startswith("Choose a map"):
+            self.later(self.say, chat_id, self.map_name)
+        elif text.endswith("Once more?"):
+            del self.last_action[chat_id]
+            self.report.finish()
+
+
+def telegram_config(args):
+    with open(f"{REPO}/files/tg_config.txt", "r") as of:
+        cfg = json.load(of)
+    cfg["MAIN"].update({"TOKEN": "123:loadtest", "RUN_MODE": args.run_mode, "INLINE_QUIZ": args.inline,
+                        "MAX_CONCURRENT_UPDATES": args.concurrency, "WORKERS": args.workers})
+    cfg["SESSIONS"] = {"BACKEND": args.sessions, "PATH": "files/tg_sessions.db"}
+    cfg["METRICS"] = {"ENABLED": False}
+    with open("files/tg_config.txt", "w") as of:
+        json.dump(cfg, of)
+
+
+def telegram_worker(index, questions, real_limits):
+    """bot of a worker process in workers run mode. Workers are spawned, not forked: load test tweaks of this process
+    don't carry over and are made again here"""
+    if not real_limits:
+        lift_limits()
+    from telegram_r6_callouts_bot import R6CalloutsBot
+    c_bot = R6CalloutsBot(worker=index)
+    c_bot.quiz_questions_amount = questions
+    c_bot.catalog_watcher.start(lambda: c_bot.catalog)
+    return c_bot.bot
+
+
+async def run_telegram(args):
+    from telebot import apihelper
+    api = MockBotApi(rtt=args.rtt)
+    await api.start(args.port)
+    apihelper.API_URL = f"http://127.0.0.1:{args.port}/bot{{0}}/{{1}}"
+    telegram_config(args)
+    import telegram_r6_callouts_bot  # logging setup at import: has to happen inside the sandbox
+    telegram_r6_callouts_bot.worker_bot = functools.partial(telegram_worker, questions=args.questions,
+                                                            real_limits=args.real_limits)
+    if args.run_mode == "workers":  # like __main__ of the bot: no bot in this process
+        bot = None
+        start = functools.partial(telegram_r6_callouts_bot.run_workers, telegram_r6_callouts_bot.load_cfg())
+    else:
+        bot = telegram_r6_callouts_bot.R6CalloutsBot()
+        bot.quiz_questions_amount = args.questions
+        start = bot.start_bot
+
+    def run_bot():
+        asyncio.set_event_loop(asyncio.new_event_loop())  # async and workers runners use the thread's loop
+        start()
+
+    threading.Thread(target=run_bot, name="bot", daemon=True).start()
+    report = Report(args.chats)
+    players = TelegramPlayers(api, report, args.map, args.think, bot.cancel_cmd if bot else "/cancel")
+    loop = asyncio.get_event_loop()
+    for chat_id in range(10 ** 6, 10 ** 6 + args.chats):
+        loop.call_later(random.uniform(0, args.ramp), players.start, chat_id)
+    try:
+        await asyncio.wait_for(report.done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    mode = f"{args.run_mode} mode" + (f", {args.workers} workers" if args.run_mode == "workers" else "")
+    report.print(f"telegram, {mode}, {'inline' if args.inline else 'reply keyboard'} quiz, "
+                 f"{args.chats} chats, {args.questions} questions, {args.sessions} sessions", api.calls)
+    for process in multiprocessing.active_children():  # workers mode. The runner thread won't get to stop them
+        process.terminate()
+
+
+class FakeDiscordHTTP:
+    """stands in for discord.http.HTTPClient of the bot. Calls are answered in process after rtt seconds, sent
+    messages are handed to on_message(channel_id, data) so players can react"""
+    def __init__(self, bot_user, rtt=0.0):
+        self.bot_user = bot_user
+        self.rtt = rtt
+        self.message_ids = itertools.count(10 ** 9)
+        self.calls = {}
+        self.on_message = None
+
+    async def call(self, method):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.rtt:
+            await asyncio.sleep(self.rtt)
+
+    def message(self, channel_id, content, embed=None, attachments=()):
+        data = {"id": str(next(self.message_ids)), "channel_id": str(channel_id), "author": self.bot_user,
+                "content": content or "", "attachments": list(attachments), "embeds": [embed] if embed else [],
+                "edited_timestamp": None, "type": 0, "pinned": False, "mention_everyone": False, "tts": False,
+                "mentions": [], "mention_roles": []}
+        if self.on_message:
+            self.on_message(channel_id, data)
+        return data
+
+    async def send_message(self, channel_id, content, *, embed=None, **kwargs):
+        await self.call("send_message")
+        return self.message(channel_id, content, embed=embed)
+
+    async def send_files(self, channel_id, *, files, content=None, embed=None, **kwargs):
+        await self.call("send_files")
+        attachments = []
+        for f in files:
+            size = len(f.fp.read())  # the upload
+            attachment_id = next(self.message_ids)
+            url = f"https://cdn.discordapp.test/attachments/{channel_id}/{attachment_id}/{f.filename}"
+            attachments.append({"id": str(attachment_id), "size": size, "filename": f.filename, "url": url,
+                                "proxy_url": url})
+        return self.message(channel_id, content, embed=embed, attachments=attachments)
+
+    async def add_reaction(self, channel_id, message_id, emoji):
+        await self.call("add_reaction")
+
+
+class DiscordPlayers:
+    """one player per DM channel: starts a quiz with a command and reacts to every question with a random option
+    after thinking for a while"""
+    def __init__(self, callouts, report, map_name, questions, think):
+        self.callouts = callouts
+        self.bot = callouts.bot
+        self.state = callouts.bot._connection
+        self.report = report
+        self.map_name = map_name
+        self.questions = questions
+        self.think = think
+        self.channels = {}  # channel_id: DMChannel
+        self.last_action = {}  # channel_id: when the player's latest message or reaction went out
+        self.message_ids = itertools.count(1)
+        self.loop = asyncio.get_event_loop()
+
+    def user(self, channel_id):
+        return {"id": str(channel_id + 1), "username": f"player{channel_id}", "discriminator": "0001", "avatar": None}
+
+    def start(self, channel_id):
+        channel = discord.DMChannel(me=self.bot.user, state=self.state,
+                                    data={"id": str(channel_id), "recipients": [self.user(channel_id)]})
+        self.channels[channel_id] = channel
+        content = f"{self.callouts.bot_cmd_prefix}quiz {self.map_name} {self.questions}"
+        data = {"id": str(next(self.message_ids)), "channel_id": str(channel_id), "author": self.user(channel_id),
+                "content": content, "attachments": [], "embeds": [], "edited_timestamp": None, "type": 0,
+                "pinned": False, "mention_everyone": False, "tts": False, "mentions": [], "mention_roles": []}
+        self.last_action[channel_id] = time.perf_counter()
+        self.bot.dispatch("message", discord.Message(state=self.state, channel=channel, data=data))
+
+    def react(self, channel_id, message_id):
+        tally = self.callouts.live_questions.get(message_id)
+        if tally is None:  # question timed out before the player made up their mind
+            return
+        payload = discord.RawReactionActionEvent(
+            {"message_id": message_id, "channel_id": channel_id, "user_id": channel_id + 1},
+            discord.PartialEmoji(name=random.choice(tally.emoji_options)), "REACTION_ADD")
+        self.last_action[channel_id] = time.perf_counter()
+        self.bot.dispatch("raw_reaction_add", payload)
+
+    def on_message(self, channel_id, data):
+        if channel_id not in self.last_action:
+            return
+        content = data["content"]
+        if content.startswith("Question #"):
+            self.report.question(time.perf_counter() - self.last_action[channel_id])
+            self.loop.call_later(self.think * random.uniform(0.5, 1.5), self.react, channel_id, int(data["id"]))
+        elif "Quiz done!" in content or "Quiz stopped" in content:
+            del self.last_action[channel_id]
+            self.report.finish()
+
+
+async def run_discord(args):
+    from discord_r6_callouts_bot import R6Callouts
+    callouts = R6Callouts()
+    callouts.quiz_start_timer = 0
+    state = callouts.bot._connection
+    bot_user = {"id": "1", "username": "r6_callouts_bot", "discriminator": "0001", "avatar": None, "bot": True}
+    state.user = discord.ClientUser(state=state, data=bot_user)
+    http = FakeDiscordHTTP(bot_user, rtt=args.rtt)
+    state.http = callouts.bot.http = http
+    callouts.bot.dispatch("ready")  # starts the background watchers
+    report = Report(args.chats)
+    players = DiscordPlayers(callouts, report, args.map, args.questions, args.think)
+    http.on_message = players.on_message
+    loop = asyncio.get_event_loop()
+    for channel_id in range(10 ** 6, 10 ** 6 + 2 * args.chats, 2):  # user id is channel id + 1
+        loop.call_later(random.uniform(0, args.ramp), players.start, channel_id)
+    try:
+        await asyncio.wait_for(report.done.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        pass
+    report.print(f"discord, DM quizzes, {args.chats} chats, {args.questions} questions", http.calls)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("bot", choices=("telegram", "discord"))
+    parser.add_argument("--chats", type=int, default=1000)
+    parser.add_argument("--questions", type=int, default=5)
+    parser.add_argument("--map", default="KAFE")
+    parser.add_argument("--think", type=float, default=0.2, help="seconds a player takes to answer, on average")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which players start their quizzes")
+    parser.add_argument("--rtt", type=float, default=0.02, help="seconds every API call takes")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--real-limits", action="store_true", help="keep platform rate limits")
+    parser.add_argument("--run-mode", default="async", choices=("async", "polling", "workers"), help="telegram only")
+    parser.add_argument("--workers", type=int, default=2, help="telegram only: worker processes in workers mode")
+    parser.add_argument("--inline", action="store_true", help="telegram only: inline keyboard quiz")
+    parser.add_argument("--sessions", default="memory", choices=("memory", "sqlite"), help="telegram only")
+    parser.add_argument("--concurrency", type=int, default=32, help="telegram only: updates processed at once")
+    parser.add_argument("--port", type=int, default=8791, help="telegram only: mock Bot API port")
+    args = parser.parse_args()
+    sandbox()
+    if not args.real_limits:
+        lift_limits()
+    run = run_telegram if args.bot == "telegram" else run_discord
+    asyncio.get_event_loop().run_until_complete(run(args))
+
+
+if __name__ == "__main__":
+    main()
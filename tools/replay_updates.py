@@ -0,0 +1,62 @@
+import argparse
+import asyncio
+import json
+import time
+import aiohttp
+
+
+"""Local stand-in for Telegram webhook delivery: POSTs recorded updates (one JSON update per line) to the bot
+running with RUN_MODE "webhook" and reports how fast the bot acknowledged them.
+    python tools/replay_updates.py tools/sample_updates.jsonl --url http://127.0.0.1:8443/ --secret <SECRET>
+"""
+
+
+async def post_update(session, url, headers, update, latencies, statuses):
+    start = time.perf_counter()
+    async with session.post(url, json=update, headers=headers) as resp:
+        await resp.read()
+        statuses[resp.status] = statuses.get(resp.status, 0) + 1
+    latencies.append(time.perf_counter() - start)
+
+
+async def replay(updates, url, secret, concurrency, repeat):
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    latencies, statuses = [], {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(update):
+        async with semaphore:
+            await post_update(session, url, headers, update, latencies, statuses)
+
+    async with aiohttp.ClientSession() as session:
+        start = time.perf_counter()
+        jobs = []
+        for i in range(repeat):
+            for update in updates:
+                # every copy needs its own update_id, otherwise the bot can't tell them apart
+                update = dict(update, update_id=update["update_id"] + i * len(updates))
+                jobs.append(bounded(update))
+        await asyncio.gather(*jobs)
+        total = time.perf_counter() - start
+    latencies.sort()
+    print(f"{len(latencies)} updates in {total:.2f} s ({len(latencies) / total:.0f}/s), statuses {statuses}")
+    print(f"ack latency p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("updates_file")
+    parser.add_argument("--url", default="http://127.0.0.1:8443/")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+    with open(args.updates_file, "r") as of:
+        updates = [json.loads(line) for line in of if line.strip()]
+    asyncio.get_event_loop().run_until_complete(replay(updates, args.url, args.secret, args.concurrency,
+                                                       args.repeat))
+
+
+if __name__ == "__main__":
+    main()